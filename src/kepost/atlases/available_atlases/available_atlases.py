@@ -2,12 +2,86 @@
 This file contains the available atlases that can be used in the pipeline.
 """
 
+from collections.abc import Mapping
+from functools import partial
 from pathlib import Path
+from typing import Optional, Union
+
+from kepost.atlases.utils import ATLAS_INDEX_CACHE
 
 # flake8: noqa: E501
 
 
 parent = Path(__file__).resolve().parent
+#: The archive of packed atlases (see :func:`pack_atlases`), shipped in the
+#: distributions in place of the loose atlas files
+ATLAS_ARCHIVE = parent / "atlases.npz"
+#: Where the atlases unpacked from the archive are cached
+ATLAS_STORE_CACHE = ATLAS_INDEX_CACHE.parent / "atlases"
+
+
+def _schaefer_atlas(atlas: str, n_regions: int, n_networks: int) -> dict:
+    """
+    The entry of a Schaefer 2018 atlas (or of its Tian 2020 extension).
+
+    The Schaefer 2018 atlases are shipped at 1mm and 2mm, their Tian 2020
+    extensions at 1mm only.
+    """
+
+    def _path(resolution: float, extension: str) -> Path:
+        return (
+            parent
+            / f"{atlas}/MNI152"
+            / (
+                f"space-MNI152_atlas-{atlas}_res-{resolution:g}mm"
+                f"_den-{n_regions}_div-{n_networks}networks_dseg{extension}"
+            )
+        )
+
+    resolutions = [1.0, 2.0] if atlas == "schaefer2018" else [1.0]
+    return {
+        "nifti": _path(1.0, ".nii.gz"),
+        "resolutions": {
+            resolution: _path(resolution, ".nii.gz") for resolution in resolutions
+        },
+        "description_file": _path(1.0, ".csv"),
+        "region_col": "index",
+        "index_col": 0,
+    }
+
+
+def _single_resolution_atlas(
+    atlas: str, region_col: str, index_col: Optional[int]
+) -> dict:
+    """The entry of an atlas shipped at 1mm only."""
+    stem = f"{atlas}/MNI152/space-MNI152_atlas-{atlas}_res-1mm_dseg"
+    return {
+        "nifti": parent / f"{stem}.nii.gz",
+        "resolutions": {1.0: parent / f"{stem}.nii.gz"},
+        "description_file": parent / f"{stem}.csv",
+        "region_col": region_col,
+        "index_col": index_col,
+    }
+
+
+def schaefer_atlases() -> dict:
+    """
+    The Schaefer 2018 atlases (and their Tian 2020 extensions), keyed by
+    name; each entry is built only when its function is called.
+
+    Returns
+    -------
+    dict
+        The functions building the atlases' entries.
+    """
+    atlases = {}
+    for n_regions in range(100, 1001, 100):
+        for n_networks in [7, 17]:
+            for atlas in ["schaefer2018", "schaefer2018tian2020"]:
+                atlases[f"{atlas}_{n_regions}_{n_networks}"] = partial(
+                    _schaefer_atlas, atlas, n_regions, n_networks
+                )
+    return atlases
 
 
 def generate_schaefer_dict() -> dict:
@@ -19,44 +93,260 @@ def generate_schaefer_dict() -> dict:
     dict
         Dictionary with the Schaefer 2018 atlases.
     """
-    schaefer_dict = {}
-    for n_regions in range(100, 1001, 100):
-        for n_networks in [7, 17]:
-            schaefer_dict[f"schaefer2018_{n_regions}_{n_networks}"] = {
-                "nifti": parent
-                / f"schaefer2018/MNI152/space-MNI152_atlas-schaefer2018_res-1mm_den-{n_regions}_div-{n_networks}networks_dseg.nii.gz",
-                "description_file": parent
-                / f"schaefer2018/MNI152/space-MNI152_atlas-schaefer2018_res-1mm_den-{n_regions}_div-{n_networks}networks_dseg.csv",
-                "region_col": "index",
-                "index_col": 0,
-            }
-            schaefer_dict[f"schaefer2018tian2020_{n_regions}_{n_networks}"] = {
-                "nifti": parent
-                / f"schaefer2018tian2020/MNI152/space-MNI152_atlas-schaefer2018tian2020_res-1mm_den-{n_regions}_div-{n_networks}networks_dseg.nii.gz",
-                "description_file": parent
-                / f"schaefer2018tian2020/MNI152/space-MNI152_atlas-schaefer2018tian2020_res-1mm_den-{n_regions}_div-{n_networks}networks_dseg.csv",
-                "region_col": "index",
-                "index_col": 0,
+    return {key: build() for key, build in schaefer_atlases().items()}
+
+
+def _archive_digest(images: list, description: bytes) -> str:
+    """The checksum of a packed atlas' label images and description."""
+    import hashlib
+
+    digest = hashlib.sha1()
+    for labels in images:
+        digest.update(labels.tobytes())
+    digest.update(description)
+    return digest.hexdigest()
+
+
+def _entry(atlas) -> dict:
+    """An atlas' entry, built first if it is given by its function."""
+    return atlas() if callable(atlas) else atlas
+
+
+def pack_atlases(atlases: Mapping, out_file: Union[str, Path] = ATLAS_ARCHIVE) -> str:
+    """
+    Pack atlases into a single archive: the int16 labels and affine of every
+    image of an atlas (its ``nifti`` and all its ``resolutions``), its
+    description table and metadata, each compressed on its own (so that one
+    atlas is read without the others) and checksummed.
+
+    Parameters
+    ----------
+    atlases : Mapping
+        The atlases to pack, keyed by name (as in ``AVAILABLE_ATLASES``); an
+        entry may be given by the function building it
+    out_file : Union[str, Path], optional
+        The archive, by default :data:`ATLAS_ARCHIVE`
+
+    Returns
+    -------
+    str
+        Path to the archive
+    """
+    import json
+
+    import nibabel as nib
+    import numpy as np
+
+    arrays = {}
+    for key, atlas in atlases.items():
+        entry = _entry(atlas)
+        # every image once, the finest one (``nifti``) being one of the resolutions
+        images = list(
+            dict.fromkeys([entry["nifti"], *entry.get("resolutions", {}).values()])
+        )
+        meta = {
+            "images": [],
+            "nifti": 0,
+            "description_file": Path(entry["description_file"]).name,
+            "region_col": entry["region_col"],
+            "index_col": entry["index_col"],
+        }
+        if "resolutions" in entry:
+            meta["resolutions"] = {
+                str(resolution): images.index(nifti)
+                for resolution, nifti in entry["resolutions"].items()
             }
-    return schaefer_dict
-
-
-AVAILABLE_ATLASES = {
-    "fan2016": {
-        "nifti": parent
-        / "fan2016/MNI152/space-MNI152_atlas-fan2016_res-1mm_dseg.nii.gz",
-        "description_file": parent
-        / "fan2016/MNI152/space-MNI152_atlas-fan2016_res-1mm_dseg.csv",
-        "region_col": "Label",
-        "index_col": None,
-    },
-    "huang2022": {
-        "nifti": parent
-        / "huang2022/MNI152/space-MNI152_atlas-huang2022_res-1mm_dseg.nii.gz",
-        "description_file": parent
-        / "huang2022/MNI152/space-MNI152_atlas-huang2022_res-1mm_dseg.csv",
-        "region_col": "HCPex_label",
-        "index_col": 0,
-    },
-    **generate_schaefer_dict(),
+        packed_labels = []
+        for i, nifti in enumerate(images):
+            img = nib.load(nifti)
+            data = np.asanyarray(img.dataobj)
+            # labels stored as floats (or scaled) carry rounding noise
+            labels = np.rint(data).astype(np.int16)
+            if not np.allclose(labels, data, rtol=0, atol=0.1):
+                raise ValueError(f"The labels of {key} ({nifti}) do not fit in int16.")
+            meta["images"].append(
+                {
+                    "file": Path(nifti).name.split(".")[0] + ".nii",
+                    "sform_code": int(img.header["sform_code"]),
+                    "qform_code": int(img.header["qform_code"]),
+                }
+            )
+            arrays[f"{key}/{i}/labels"] = labels
+            arrays[f"{key}/{i}/affine"] = img.affine
+            packed_labels.append(labels)
+        description = Path(entry["description_file"]).read_bytes()
+        arrays[f"{key}/description"] = np.frombuffer(description, dtype=np.uint8)
+        arrays[f"{key}/meta"] = np.array(json.dumps(meta))
+        arrays[f"{key}/checksum"] = np.array(
+            _archive_digest(packed_labels, description)
+        )
+    np.savez_compressed(out_file, **arrays)
+    return str(out_file)
+
+
+def pack_available_atlases(out_file: Union[str, Path] = ATLAS_ARCHIVE) -> str:
+    """
+    Pack the available atlases whose files exist (see
+    :func:`pack_atlases`), as done before the package is built
+    (``make atlases``, run by ``make dist``).
+
+    Parameters
+    ----------
+    out_file : Union[str, Path], optional
+        The archive, by default :data:`ATLAS_ARCHIVE`
+
+    Returns
+    -------
+    str
+        Path to the archive
+    """
+    atlases = {}
+    for key, atlas in LOOSE_ATLASES.items():
+        entry = _entry(atlas)
+        files = [entry["nifti"], entry["description_file"]]
+        files += list(entry.get("resolutions", {}).values())
+        if all(Path(f).exists() for f in files):
+            atlases[key] = entry
+    return pack_atlases(atlases, out_file)
+
+
+def unpack_atlas(
+    archive: Union[str, Path],
+    key: str,
+    cache_dir: Union[str, Path] = ATLAS_STORE_CACHE,
+) -> dict:
+    """
+    Unpack an atlas from an archive (see :func:`pack_atlases`) to
+    uncompressed NIfTIs (one per resolution) and its description table,
+    unless they are cached already.
+
+    Parameters
+    ----------
+    archive : Union[str, Path]
+        The archive
+    key : str
+        The name of the atlas
+    cache_dir : Union[str, Path], optional
+        The cache directory, by default :data:`ATLAS_STORE_CACHE`
+
+    Returns
+    -------
+    dict
+        The atlas' entry (as in ``AVAILABLE_ATLASES``)
+    """
+    import json
+
+    import nibabel as nib
+    import numpy as np
+
+    from kepost.atlases.utils import _write_cached
+
+    with np.load(archive) as packed:
+        checksum = str(packed[f"{key}/checksum"])
+        meta = json.loads(str(packed[f"{key}/meta"]))
+        out_dir = Path(cache_dir) / f"{key}_{checksum[:12]}"
+        niftis = [out_dir / image["file"] for image in meta["images"]]
+        description_file = out_dir / meta["description_file"]
+        if not all(f.exists() for f in niftis + [description_file]):
+            images = [packed[f"{key}/{i}/labels"] for i in range(len(meta["images"]))]
+            description = packed[f"{key}/description"].tobytes()
+            if _archive_digest(images, description) != checksum:
+                raise ValueError(f"The packed {key} atlas is corrupted ({archive}).")
+            for i, (labels, image) in enumerate(zip(images, meta["images"])):
+                img = nib.Nifti1Image(labels, packed[f"{key}/{i}/affine"])
+                img.set_sform(img.affine, code=image["sform_code"])
+                img.set_qform(img.affine, code=image["qform_code"])
+                _write_cached(niftis[i], lambda out_file: nib.save(img, out_file))
+            _write_cached(
+                description_file,
+                lambda out_file: Path(out_file).write_bytes(description),
+            )
+    entry = {
+        "nifti": niftis[meta["nifti"]],
+        "description_file": description_file,
+        "region_col": meta["region_col"],
+        "index_col": meta["index_col"],
+    }
+    if "resolutions" in meta:
+        entry["resolutions"] = {
+            float(resolution): niftis[i]
+            for resolution, i in meta["resolutions"].items()
+        }
+    return entry
+
+
+class AtlasStore(Mapping):
+    """
+    The available atlases, keyed by name.
+
+    The atlases are listed without being built: an atlas is resolved only
+    when it is looked up, from the archive if it is packed there (see
+    :func:`pack_atlases`), unpacked once to the cache (see
+    :func:`unpack_atlas`), or else from its loose files.
+
+    Parameters
+    ----------
+    atlases : dict
+        The entries of the atlases' loose files, or the functions building
+        them
+    archive : Union[str, Path], optional
+        The archive, by default :data:`ATLAS_ARCHIVE` (if it exists)
+    cache_dir : Union[str, Path], optional
+        The cache directory, by default :data:`ATLAS_STORE_CACHE`
+    """
+
+    def __init__(
+        self,
+        atlases: dict,
+        archive: Optional[Union[str, Path]] = ATLAS_ARCHIVE,
+        cache_dir: Union[str, Path] = ATLAS_STORE_CACHE,
+    ):
+        self._atlases = atlases
+        self._archive = archive
+        self._cache_dir = cache_dir
+        self._packed: Optional[set] = None
+        self._resolved: dict = {}
+
+    @property
+    def packed(self) -> set:
+        """The names of the atlases in the archive."""
+        if self._packed is None:
+            self._packed = set()
+            if self._archive is not None and Path(self._archive).exists():
+                import numpy as np
+
+                with np.load(self._archive) as packed:
+                    self._packed = {
+                        name.rsplit("/", 1)[0]
+                        for name in packed.files
+                        if name.endswith("/checksum")
+                    }
+        return self._packed
+
+    def __getitem__(self, key: str) -> dict:
+        atlas = self._atlases[key]
+        if key not in self._resolved:
+            if key in self.packed:
+                self._resolved[key] = unpack_atlas(self._archive, key, self._cache_dir)
+            else:
+                self._resolved[key] = _entry(atlas)
+        entry = dict(self._resolved[key])
+        if "resolutions" in entry:
+            entry["resolutions"] = dict(entry["resolutions"])
+        return entry
+
+    def __iter__(self):
+        return iter(self._atlases)
+
+    def __len__(self) -> int:
+        return len(self._atlases)
+
+
+#: The loose files of the available atlases (the Schaefer ones built lazily)
+LOOSE_ATLASES = {
+    "fan2016": partial(_single_resolution_atlas, "fan2016", "Label", None),
+    "huang2022": partial(_single_resolution_atlas, "huang2022", "HCPex_label", 0),
+    **schaefer_atlases(),
 }
+
+AVAILABLE_ATLASES = AtlasStore(LOOSE_ATLASES)
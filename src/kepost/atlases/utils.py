@@ -1,10 +1,35 @@
+import os
+from functools import lru_cache
 from pathlib import Path
-from typing import Callable, Union
+from typing import Callable, Optional, Union
 
 import nibabel as nib
 import numpy as np
 import pandas as pd
 
+#: Where label indices of the (standard-space) available atlases are cached
+ATLAS_INDEX_CACHE = (
+    Path(
+        os.getenv(
+            "KEPOST_CACHE",
+            os.path.join(os.getenv("HOME", "~"), ".cache", "kepost"),
+        )
+    ).expanduser()
+    / "atlas_indices"
+)
+#: Where region overlaps between the (standard-space) available atlases are cached
+ATLAS_OVERLAP_CACHE = ATLAS_INDEX_CACHE.parent / "atlas_overlaps"
+#: Grid (MNI152NLin2009cAsym, 1mm) whose voxels the atlas lookup maps point to
+LOOKUP_SHAPE = (193, 229, 193)
+LOOKUP_AFFINE = np.array(
+    [
+        [1.0, 0.0, 0.0, -96.0],
+        [0.0, 1.0, 0.0, -132.0],
+        [0.0, 0.0, 1.0, -78.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+)
+
 GM_5TT_CMDS = [
     "mrconvert {five_tissue_type} {out_file} -force",
     "fslroi {out_file} {out_file} 0 2",
@@ -35,6 +60,940 @@ def get_atlas_properties(atlas: str):
     return nifti, description, region_col, index_col
 
 
+def get_atlas_resolution(atlas: str, voxel_size: float) -> Path:
+    """
+    Get the image of an atlas whose resolution best matches a target grid:
+    the coarsest that is not coarser than the grid's voxels, or else the
+    finest one.
+
+    Parameters
+    ----------
+    atlas : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+    voxel_size : float
+        The (smallest) voxel size of the target grid, in mm.
+
+    Returns
+    -------
+    Path
+        Path to the atlas image.
+
+    Raises
+    ------
+    ValueError
+        If the atlas' resolutions are not listed.
+    """
+    from kepost.atlases.available_atlases.available_atlases import AVAILABLE_ATLASES
+
+    resolutions = AVAILABLE_ATLASES[atlas].get("resolutions")
+    if not resolutions:
+        raise ValueError(
+            f"The resolutions of the {atlas} atlas are not listed (e.g. it was "
+            "unpacked from an archive that does not hold them)."
+        )
+    # a small tolerance, as voxel sizes are rarely stored exactly
+    fitting = [res for res in resolutions if res <= voxel_size * 1.01]
+    return resolutions[max(fitting) if fitting else min(resolutions)]
+
+
+def select_atlas_resolution(atlas_name: str, reference_image: str) -> str:
+    """
+    Get the image of an atlas whose resolution best matches the grid of a
+    reference image (see :func:`get_atlas_resolution`).
+
+    Parameters
+    ----------
+    atlas_name : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+    reference_image : str
+        Path to an image on the target grid.
+
+    Returns
+    -------
+    str
+        Path to the atlas image.
+    """
+    import nibabel as nib
+
+    from kepost.atlases.utils import get_atlas_resolution
+
+    voxel_size = min(nib.load(reference_image).header.get_zooms()[:3])
+    return str(get_atlas_resolution(atlas_name, float(voxel_size)))
+
+
+def get_atlas_key(atlas_nifti: Union[str, Path]) -> tuple[str, str]:
+    """
+    Resolve the atlas of a (native-space) parcellation image from its entities.
+
+    Parameters
+    ----------
+    atlas_nifti : Union[str, Path]
+        Path to the parcellation image.
+
+    Returns
+    -------
+    atlas_key : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+    atlas_name : str
+        The name of the atlas, as used for the derivatives.
+    """
+    from importlib.resources import files
+    from json import loads
+
+    from bids.layout import Config, parse_file_entities
+
+    _pybids_spec = loads(
+        Path(
+            str(files("kepost").joinpath("interfaces/bids/static/kepost.json"))
+        ).read_text()
+    )
+    config = Config(**_pybids_spec)
+
+    entities = parse_file_entities(str(atlas_nifti), config=config)
+    atlas_name = entities["atlas"]
+    if "schaefer2018" in atlas_name:
+        division = entities["division"]
+        den = entities["den"]
+        atlas_key = f"{atlas_name}_{den}_{division.replace('networks','')}"
+        atlas_name = f"{atlas_name}_div-{division}_den-{den}"
+    else:
+        atlas_key = atlas_name
+    return atlas_key, atlas_name
+
+
+def group_labels(
+    atlas_data: np.ndarray, labels: Optional[np.ndarray] = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group the voxels of a label image by region in a single pass.
+
+    Each labelled voxel is matched to its region once and the flat voxel
+    indices are (stably) sorted by region, so the voxels of every region end
+    up as one contiguous slice of ``voxel_index``.
+
+    Parameters
+    ----------
+    atlas_data : np.ndarray
+        The label image.
+    labels : np.ndarray, optional
+        The region labels to group by. By default, all non-zero labels
+        found in ``atlas_data``.
+
+    Returns
+    -------
+    labels : np.ndarray
+        The sorted, unique region labels.
+    voxel_index : np.ndarray
+        Flat (C-order) voxel indices, sorted by region.
+    offsets : np.ndarray
+        Region boundaries within ``voxel_index``; the voxels of
+        ``labels[i]`` are ``voxel_index[offsets[i] : offsets[i + 1]]``.
+    """
+    flat = np.asanyarray(atlas_data).ravel()
+    if labels is None:
+        labels = np.unique(flat[flat != 0])
+    else:
+        labels = np.unique(labels)
+    offsets = np.zeros(len(labels) + 1, dtype=np.intp)
+    if len(labels) == 0:
+        return labels, np.empty(0, dtype=np.intp), offsets
+    segment = np.searchsorted(labels, flat)
+    np.minimum(segment, len(labels) - 1, out=segment)
+    voxel_index = np.flatnonzero(labels[segment] == flat)
+    segment = segment[voxel_index]
+    # numpy's stable sort is a radix sort for 16-bit integers
+    if len(labels) <= np.iinfo(np.uint16).max:
+        segment = segment.astype(np.uint16)
+    voxel_index = voxel_index[np.argsort(segment, kind="stable")]
+    np.cumsum(np.bincount(segment, minlength=len(labels)), out=offsets[1:])
+    return labels, voxel_index, offsets
+
+
+def select_labels(
+    labels: np.ndarray,
+    voxel_index: np.ndarray,
+    offsets: np.ndarray,
+    selection: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Restrict a label index (see :func:`group_labels`) to some region labels.
+
+    Labels of ``selection`` that are missing from the index get an empty
+    region. If all indexed voxels are selected, ``voxel_index`` is returned
+    as is (without a copy).
+
+    Parameters
+    ----------
+    labels, voxel_index, offsets : np.ndarray
+        The label index.
+    selection : np.ndarray
+        The region labels to keep.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        The label index of ``np.unique(selection)``.
+    """
+    selection = np.unique(selection)
+    new_offsets = np.zeros(len(selection) + 1, dtype=np.intp)
+    if len(labels) == 0:
+        return selection, voxel_index[:0], new_offsets
+    position = np.minimum(np.searchsorted(labels, selection), len(labels) - 1)
+    present = labels[position] == selection
+    starts = offsets[position]
+    sizes = np.where(present, offsets[position + 1] - starts, 0)
+    np.cumsum(sizes, out=new_offsets[1:])
+    if new_offsets[-1] == len(voxel_index):
+        return selection, voxel_index, new_offsets
+    gather = np.arange(new_offsets[-1]) + np.repeat(starts - new_offsets[:-1], sizes)
+    return selection, voxel_index[gather], new_offsets
+
+
+def save_label_index(atlas_nifti: Union[str, Path], out_file: str) -> str:
+    """
+    Group the voxels of a label image by region and save the result as an
+    uncompressed ``.npz`` file, so it can be reused through a memory map
+    (see :func:`load_label_index`).
+
+    Parameters
+    ----------
+    atlas_nifti : Union[str, Path]
+        Path to the label image.
+    out_file : str
+        Path to the output ``.npz`` file.
+
+    Returns
+    -------
+    str
+        Path to the output file.
+    """
+    atlas_img = nib.load(atlas_nifti)
+    atlas_data = np.asanyarray(atlas_img.dataobj)  # type: ignore[attr-defined]
+    labels, voxel_index, offsets = group_labels(atlas_data)
+    np.savez(
+        out_file,
+        labels=labels,
+        voxel_index=voxel_index,
+        offsets=offsets,
+        shape=np.array(atlas_data.shape),
+    )
+    return str(out_file)
+
+
+def index_atlas(in_file: str) -> str:
+    """
+    Write the label index of a parcellation image (see
+    :func:`save_label_index`) to the working directory.
+
+    Parameters
+    ----------
+    in_file : str
+        Path to the parcellation image.
+
+    Returns
+    -------
+    str
+        Path to the ``.npz`` label index.
+    """
+    import os
+    from pathlib import Path
+
+    from kepost.atlases.utils import save_label_index
+
+    name = Path(in_file).name.split(".")[0]
+    return save_label_index(in_file, f"{os.getcwd()}/{name}_index.npz")
+
+
+def get_atlas_index(atlas: str, cache_dir: Optional[Union[str, Path]] = None) -> str:
+    """
+    Get the label index of one of the available (standard-space) atlases,
+    computing it only if it is not cached yet.
+
+    The index is cached per installation (see :data:`ATLAS_INDEX_CACHE`, or
+    the ``KEPOST_CACHE`` environment variable) and keyed by the atlas'
+    content, so all subjects parcellated in the atlas' space share it.
+
+    Parameters
+    ----------
+    atlas : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+    cache_dir : Union[str, Path], optional
+        The cache directory, by default :data:`ATLAS_INDEX_CACHE`.
+
+    Returns
+    -------
+    str
+        Path to the ``.npz`` label index.
+    """
+    nifti, _, _, _ = get_atlas_properties(atlas)
+    index_file = Path(cache_dir or ATLAS_INDEX_CACHE) / (
+        f"{atlas}_{_file_digest(nifti)}.npz"
+    )
+    _write_cached(index_file, lambda out_file: save_label_index(nifti, out_file))
+    return str(index_file)
+
+
+def _file_digest(path: Union[str, Path]) -> str:
+    """
+    A short hash of a file's content, computed once per path and modification
+    time (and size).
+    """
+    stat = os.stat(path)
+    return _content_digest(str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=1024)
+def _content_digest(path: str, mtime_ns: int, size: int) -> str:
+    """Hash a file in chunks, so large images are never read at once."""
+    import hashlib
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def _write_cached(out_file: Path, write: Callable) -> None:
+    """
+    Write a cache entry with ``write(path)``, unless it already exists.
+    The entry is written to a temporary file first, as several subjects
+    may race here.
+    """
+    import tempfile
+
+    if out_file.exists():
+        return
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(suffix=out_file.suffix, dir=out_file.parent)
+    os.close(fd)
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def cache_key(in_files: list, **params) -> str:
+    """
+    A key of the content of several files (and of the parameters they are
+    processed with).
+
+    Parameters
+    ----------
+    in_files : list
+        The input files (or lists of files, e.g. a chain of transforms).
+    **params
+        Parameters that change the output.
+
+    Returns
+    -------
+    str
+        The hexadecimal key.
+    """
+    import hashlib
+
+    flat = []
+    for in_file in in_files:
+        flat += in_file if isinstance(in_file, (list, tuple)) else [in_file]
+    digest = hashlib.sha1()
+    for in_file in flat:
+        digest.update(_file_digest(in_file).encode())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def evict_cache(cache_dir: Union[str, Path], max_size: float, keep=()) -> list:
+    """
+    Remove the least recently used entries of a cache directory until it
+    holds at most ``max_size`` GB.
+
+    Parameters
+    ----------
+    cache_dir : Union[str, Path]
+        The cache directory.
+    max_size : float
+        The size of the cache (in GB).
+    keep : iterable, optional
+        Entries that are not removed, e.g. the one just used.
+
+    Returns
+    -------
+    list
+        The removed entries.
+    """
+    keep = {Path(entry) for entry in keep}
+    entries = []
+    for entry in Path(cache_dir).iterdir():
+        try:
+            if entry.is_file():
+                entries.append((entry.stat(), entry))
+        except FileNotFoundError:  # removed by another process
+            continue
+    total = sum(stat.st_size for stat, _ in entries)
+    removed = []
+    for stat, entry in sorted(entries, key=lambda item: item[0].st_mtime):
+        if total <= max_size * 1024**3:
+            break
+        if entry in keep:
+            continue
+        try:
+            entry.unlink()
+        except FileNotFoundError:
+            pass
+        total -= stat.st_size
+        removed.append(entry)
+    return removed
+
+
+def cached_file(
+    key: str,
+    name: str,
+    write: Callable,
+    cache_dir: Union[str, Path],
+    max_size: Optional[float] = None,
+) -> str:
+    """
+    Get an output file from a content-addressed cache, writing it with
+    ``write(path)`` only if it is not cached yet.
+
+    The entry is linked (or copied) to the working directory, so it outlives
+    its eviction. Using an entry marks it as recently used; an entry evicted
+    (by another process) before it is linked is a cache miss, and the output
+    is written again.
+
+    Parameters
+    ----------
+    key : str
+        The key of the output's inputs (see :func:`cache_key`).
+    name : str
+        The file name of the output.
+    write : Callable
+        Writes the output to the given path.
+    cache_dir : Union[str, Path]
+        The cache directory.
+    max_size : float, optional
+        The size of the cache (in GB), by default unbounded.
+
+    Returns
+    -------
+    str
+        Path to the output, in the working directory.
+    """
+    import shutil
+    import tempfile
+
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / f"{key[:16]}_{name}"
+    out_file = Path(os.getcwd()) / name
+    try:
+        os.utime(entry)
+    except FileNotFoundError:
+        # written under its own name, as some tools infer the format from it
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmp_dir:
+            tmp_file = Path(tmp_dir) / name
+            write(str(tmp_file))
+            os.replace(tmp_file, entry)
+    if out_file.exists():
+        out_file.unlink()
+    try:
+        try:
+            os.link(entry, out_file)
+        except FileNotFoundError:
+            raise
+        except OSError:  # e.g. the cache is on another file system
+            shutil.copyfile(entry, out_file)
+    except FileNotFoundError:
+        # evicted since it was used (or written)
+        write(str(out_file))
+        return str(out_file)
+    if max_size is not None:
+        evict_cache(cache_dir, max_size, keep=[entry])
+    return str(out_file)
+
+
+def overlap_matrices(atlases: dict) -> tuple[dict, dict]:
+    """
+    Count the voxels shared by the regions of every pair of atlases.
+
+    The labels of every atlas are resolved once, and each pair of atlases
+    takes a single sparse contingency pass over their labelled voxels, so no
+    per-region masks are built.
+
+    Parameters
+    ----------
+    atlases : dict
+        Label images on a common grid, keyed by name.
+
+    Returns
+    -------
+    labels : dict
+        The sorted, unique (non-zero) region labels of every atlas.
+    overlaps : dict
+        A ``scipy.sparse.csr_matrix`` per pair of atlases ``(a, b)`` (in the
+        order of ``atlases``), whose entry ``[i, j]`` is the number of voxels
+        labelled ``labels[a][i]`` in ``a`` and ``labels[b][j]`` in ``b``.
+    """
+    from itertools import combinations
+
+    from scipy import sparse
+
+    shapes = {np.shape(atlas)[:3] for atlas in atlases.values()}
+    if len(shapes) > 1:
+        raise ValueError(f"The atlases are not on the same grid ({shapes}).")
+    labels, positions = {}, {}
+    for name, atlas in atlases.items():
+        flat = np.asanyarray(atlas).ravel()
+        labels[name] = np.unique(flat[flat != 0])
+        # the position of every voxel's label, -1 outside the atlas
+        if not len(labels[name]):
+            positions[name] = np.full(flat.shape, -1)
+            continue
+        position = np.searchsorted(labels[name], flat)
+        np.minimum(position, len(labels[name]) - 1, out=position)
+        positions[name] = np.where(labels[name][position] == flat, position, -1)
+    overlaps = {}
+    for a, b in combinations(atlases, 2):
+        shared = (positions[a] >= 0) & (positions[b] >= 0)
+        overlaps[(a, b)] = sparse.coo_matrix(
+            (
+                np.ones(np.count_nonzero(shared), dtype=np.int64),
+                (positions[a][shared], positions[b][shared]),
+            ),
+            shape=(len(labels[a]), len(labels[b])),
+        ).tocsr()
+    return labels, overlaps
+
+
+def get_atlas_overlap(
+    atlas_a: str,
+    atlas_b: str,
+    cache_dir: Optional[Union[str, Path]] = None,
+) -> tuple:
+    """
+    Get the region overlaps of two of the available atlases in their
+    original (MNI152NLin2009cAsym) space (see :func:`overlap_matrices`),
+    computing them only if they are not cached yet. If the atlases come on
+    different grids, ``atlas_b`` is resampled (nearest neighbour) onto the
+    grid of ``atlas_a``.
+
+    Parameters
+    ----------
+    atlas_a, atlas_b : str
+        The keys of the atlases in ``AVAILABLE_ATLASES``.
+    cache_dir : Union[str, Path], optional
+        The cache directory, by default :data:`ATLAS_OVERLAP_CACHE`.
+
+    Returns
+    -------
+    overlap : scipy.sparse.csr_matrix
+        The number of voxels shared by every pair of regions.
+    labels_a, labels_b : np.ndarray
+        The region labels of the rows and columns of ``overlap``.
+    """
+    from scipy import sparse
+
+    nifti_a, _, _, _ = get_atlas_properties(atlas_a)
+    nifti_b, _, _, _ = get_atlas_properties(atlas_b)
+    overlap_file = Path(cache_dir or ATLAS_OVERLAP_CACHE) / (
+        f"{atlas_a}_{_file_digest(nifti_a)}_{atlas_b}_{_file_digest(nifti_b)}.npz"
+    )
+
+    def _write(out_file):
+        from scipy.ndimage import affine_transform
+
+        img_a, img_b = nib.load(nifti_a), nib.load(nifti_b)
+        data_a = np.asanyarray(img_a.dataobj)  # type: ignore[attr-defined]
+        data_b = np.asanyarray(img_b.dataobj)  # type: ignore[attr-defined]
+        if data_a.shape != data_b.shape or not np.allclose(
+            img_a.affine, img_b.affine  # type: ignore[attr-defined]
+        ):
+            # some atlases come on other MNI grids; resample onto atlas_a's
+            world_to_b = np.linalg.inv(img_b.affine)  # type: ignore[attr-defined]
+            data_b = affine_transform(
+                data_b,
+                world_to_b @ img_a.affine,  # type: ignore[attr-defined]
+                output_shape=data_a.shape,
+                order=0,
+            )
+        labels, overlaps = overlap_matrices({"a": data_a, "b": data_b})
+        overlap = overlaps[("a", "b")]
+        np.savez(
+            out_file,
+            data=overlap.data,
+            indices=overlap.indices,
+            indptr=overlap.indptr,
+            shape=np.array(overlap.shape),
+            labels_a=labels["a"],
+            labels_b=labels["b"],
+        )
+
+    _write_cached(overlap_file, _write)
+    with np.load(overlap_file) as cached:
+        overlap = sparse.csr_matrix(
+            (cached["data"], cached["indices"], cached["indptr"]),
+            shape=tuple(cached["shape"]),
+        )
+        return overlap, cached["labels_a"], cached["labels_b"]
+
+
+def get_standard_atlas(atlas_name: str) -> tuple[str, str]:
+    """
+    Get one of the available atlases in its original (MNI152NLin2009cAsym)
+    space, along with its cached label index.
+
+    Parameters
+    ----------
+    atlas_name : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+
+    Returns
+    -------
+    atlas_nifti : str
+        Path to the atlas image.
+    atlas_index : str
+        Path to the atlas' label index.
+    """
+    from kepost.atlases.utils import get_atlas_index, get_atlas_properties
+
+    nifti, _, _, _ = get_atlas_properties(atlas_name)
+    return str(nifti), get_atlas_index(atlas_name)
+
+
+def write_lookup_source() -> str:
+    """
+    Write the source image of the atlas lookup maps to the working directory:
+    every voxel of the :data:`LOOKUP_SHAPE` grid holds its flat (C-order)
+    index, plus one.
+
+    Resampling this image (with nearest-neighbour interpolation) to a target
+    grid yields, for every target voxel, the source voxel it is taken from
+    (0 outside of the source's field of view), so that any atlas can then be
+    resampled by a single gather (see :func:`gather_labels`).
+
+    Returns
+    -------
+    str
+        Path to the lookup source image.
+    """
+    import os
+
+    import nibabel as nib
+    import numpy as np
+
+    from kepost.atlases.utils import LOOKUP_AFFINE, LOOKUP_SHAPE
+
+    out_file = f"{os.getcwd()}/lookup_source.nii.gz"
+    index = np.arange(1, np.prod(LOOKUP_SHAPE) + 1, dtype=np.int32)
+    nib.save(nib.Nifti1Image(index.reshape(LOOKUP_SHAPE), LOOKUP_AFFINE), out_file)
+    return out_file
+
+
+def gather_labels(
+    atlas_data: np.ndarray, atlas_affine: np.ndarray, lookup: np.ndarray
+) -> np.ndarray:
+    """
+    Resample a label image through a lookup map (see
+    :func:`write_lookup_source`), with nearest-neighbour interpolation.
+
+    Parameters
+    ----------
+    atlas_data : np.ndarray
+        The label image.
+    atlas_affine : np.ndarray
+        The affine of ``atlas_data``; atlases on another grid than
+        :data:`LOOKUP_SHAPE` are looked up at the voxel nearest to the
+        lookup's (world) coordinates.
+    lookup : np.ndarray
+        The lookup map, on the target grid.
+
+    Returns
+    -------
+    np.ndarray
+        The labels on the grid of ``lookup`` (0 outside of the atlas).
+    """
+    atlas_data = np.asanyarray(atlas_data)
+    lookup = np.rint(np.asanyarray(lookup)).astype(np.int64)
+    inside = lookup > 0
+    source = lookup[inside] - 1
+    out = np.zeros(lookup.shape, dtype=atlas_data.dtype)
+    if atlas_data.shape[:3] == LOOKUP_SHAPE and np.allclose(
+        atlas_affine, LOOKUP_AFFINE
+    ):
+        out[inside] = atlas_data.ravel()[source]
+        return out
+    # the atlas voxel nearest to every looked-up source voxel
+    lookup_to_atlas = np.linalg.inv(atlas_affine) @ LOOKUP_AFFINE
+    ijk = np.stack(np.unravel_index(source, LOOKUP_SHAPE))
+    ijk = np.rint(lookup_to_atlas[:3, :3] @ ijk + lookup_to_atlas[:3, 3:])
+    ijk = ijk.astype(np.intp)
+    valid = np.all((ijk >= 0) & (ijk < np.array(atlas_data.shape[:3])[:, None]), axis=0)
+    values = np.zeros(len(source), dtype=atlas_data.dtype)
+    values[valid] = atlas_data[tuple(ijk[:, valid])]
+    out[inside] = values
+    return out
+
+
+def warp_labels(atlas_nifti: str, lookup_file: str) -> str:
+    """
+    Resample a label image to the grid of a lookup map (see
+    :func:`gather_labels`), in the working directory.
+
+    Parameters
+    ----------
+    atlas_nifti : str
+        Path to the label image (on the lookup's source space).
+    lookup_file : str
+        Path to the lookup map.
+
+    Returns
+    -------
+    str
+        Path to the resampled label image, named after ``atlas_nifti``.
+    """
+    import os
+    from pathlib import Path
+
+    import nibabel as nib
+    import numpy as np
+
+    from kepost.atlases.utils import gather_labels
+
+    atlas_img = nib.load(atlas_nifti)
+    lookup_img = nib.load(lookup_file)
+    labels = gather_labels(
+        np.asanyarray(atlas_img.dataobj),
+        atlas_img.affine,
+        np.asanyarray(lookup_img.dataobj),
+    )
+    header = lookup_img.header.copy()
+    header.set_data_dtype(labels.dtype)
+    out_file = f"{os.getcwd()}/{Path(atlas_nifti).name.split('.')[0]}_trans.nii.gz"
+    nib.save(nib.Nifti1Image(labels, lookup_img.affine, header), out_file)
+    return out_file
+
+
+def warp_atlas(atlas_name: str, lookup_file: str) -> str:
+    """
+    Resample one of the available atlases to the grid of a lookup map (see
+    :func:`warp_labels`), from its resolution that best matches that grid
+    (see :func:`select_atlas_resolution`).
+
+    Parameters
+    ----------
+    atlas_name : str
+        The key of the atlas in ``AVAILABLE_ATLASES``.
+    lookup_file : str
+        Path to the lookup map.
+
+    Returns
+    -------
+    str
+        Path to the resampled atlas.
+    """
+    from kepost.atlases.utils import select_atlas_resolution, warp_labels
+
+    return warp_labels(select_atlas_resolution(atlas_name, lookup_file), lookup_file)
+
+
+def cached_apply_transforms(
+    input_image: str,
+    transforms: Union[str, list],
+    reference_image: str,
+    cache_dir: str,
+    cache_size: Optional[float] = None,
+) -> str:
+    """
+    Resample a label image with ANTs (nearest-neighbour), through the atlas
+    cache (see :func:`cached_file`): the output is keyed by the content of
+    the image, the transforms and the reference.
+
+    Parameters
+    ----------
+    input_image : str
+        Path to the label image.
+    transforms : Union[str, list]
+        The ANTs transform(s).
+    reference_image : str
+        Path to the reference image.
+    cache_dir : str
+        The cache directory.
+    cache_size : float, optional
+        The size of the cache (in GB), by default unbounded.
+
+    Returns
+    -------
+    str
+        Path to the resampled label image.
+    """
+    from pathlib import Path
+
+    from nipype.interfaces.ants import ApplyTransforms
+
+    from kepost.atlases.utils import cache_key, cached_file
+
+    transforms = transforms if isinstance(transforms, list) else [transforms]
+
+    def write(out_file):
+        ApplyTransforms(
+            input_image=input_image,
+            transforms=transforms,
+            reference_image=reference_image,
+            interpolation="NearestNeighbor",
+            dimension=3,
+            output_image=out_file,
+        ).run()
+
+    return cached_file(
+        cache_key([input_image, transforms, reference_image], tool="ants"),
+        f"{Path(input_image).name.split('.')[0]}_trans.nii.gz",
+        write,
+        cache_dir,
+        cache_size,
+    )
+
+
+def fsl_to_itk(in_matrix_file: str, reference: str, in_file: str) -> str:
+    """
+    Convert an FSL (FLIRT) matrix to an ITK transform, so that ANTs can chain
+    it with other transforms into a single resampling.
+
+    Parameters
+    ----------
+    in_matrix_file : str
+        Path to the FSL matrix.
+    reference : str
+        Path to the matrix's reference image.
+    in_file : str
+        Path to the image the matrix moves.
+
+    Returns
+    -------
+    str
+        Path to the ITK transform, in the working directory.
+    """
+    import os
+    from pathlib import Path
+
+    import nitransforms as nt
+
+    out_file = f"{os.getcwd()}/{Path(in_matrix_file).name.split('.')[0]}_itk.txt"
+    nt.linear.load(
+        in_matrix_file, fmt="fsl", reference=reference, moving=in_file
+    ).to_filename(out_file, fmt="itk")
+    return out_file
+
+
+def load_label_index(
+    index_file: Union[str, Path],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, tuple]:
+    """
+    Load a label index written by :func:`save_label_index`.
+
+    The arrays are memory-mapped straight from the (uncompressed) archive,
+    so loading costs nothing until the voxels are actually read.
+
+    Parameters
+    ----------
+    index_file : Union[str, Path]
+        Path to the ``.npz`` label index.
+
+    Returns
+    -------
+    labels, voxel_index, offsets : np.ndarray
+        The label index (see :func:`group_labels`).
+    shape : tuple
+        The shape of the label image.
+    """
+    import zipfile
+
+    arrays = {}
+    with zipfile.ZipFile(index_file) as archive, open(index_file, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename.removesuffix(".npy")
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            # skip the member's local file header
+            f.seek(info.header_offset)
+            header = f.read(30)
+            f.seek(
+                info.header_offset
+                + 30
+                + int.from_bytes(header[26:28], "little")
+                + int.from_bytes(header[28:30], "little")
+            )
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                index_file,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return (
+        arrays["labels"],
+        arrays["voxel_index"],
+        arrays["offsets"],
+        tuple(int(i) for i in arrays["shape"]),
+    )
+
+
+def load_atlas_regions(
+    atlas_nifti: Union[str, Path],
+    atlas_index: Optional[Union[str, Path]] = None,
+) -> tuple[str, pd.DataFrame, pd.Index, tuple, tuple]:
+    """
+    Group the voxels of a (native-space) atlas by the regions of its
+    description, from its label index if given.
+
+    Parameters
+    ----------
+    atlas_nifti : Union[str, Path]
+        Path to the parcellation image.
+    atlas_index : Union[str, Path], optional
+        A label index of ``atlas_nifti`` (see :func:`save_label_index`),
+        used instead of grouping the atlas voxels again.
+
+    Returns
+    -------
+    atlas_name : str
+        The atlas name (see :func:`get_atlas_key`).
+    description : pd.DataFrame
+        The description of the atlas' regions.
+    regions : pd.Index
+        The region labels, in the order of ``description`` (and named after
+        its region column).
+    index : tuple
+        The label index of the regions (see :func:`select_labels`).
+    shape : tuple
+        The shape of the parcellation image.
+    """
+    atlas_key, atlas_name = get_atlas_key(atlas_nifti)
+    _, description, region_col, index_col = get_atlas_properties(atlas_key)
+    description = pd.read_csv(description, index_col=index_col)
+    regions = pd.Index(description[region_col].astype(int), name=region_col)
+    if atlas_index:
+        *index, shape = load_label_index(atlas_index)
+        index = select_labels(*index, regions.to_numpy())
+    else:
+        atlas_img = nib.load(atlas_nifti)
+        atlas_data = np.asanyarray(atlas_img.dataobj)  # type: ignore[attr-defined]
+        shape = atlas_data.shape
+        index = group_labels(atlas_data, regions.to_numpy())
+    return atlas_name, description, regions, index, tuple(shape)
+
+
 def parcellate(
     atlas_description: pd.DataFrame,
     index_col: int,
@@ -42,6 +1001,7 @@ def parcellate(
     region_col: str,
     metric_image: Union[str, Path],
     measure: Callable,
+    atlas_index: Optional[Union[str, Path]] = None,
 ) -> pd.DataFrame:
     """
     Collects a measure for each region of an atlas.
@@ -54,6 +1014,9 @@ def parcellate(
         Path to the metric image.
     measure : Callable
         Measure function.
+    atlas_index : Union[str, Path], optional
+        A label index of ``atlas_nifti`` (see :func:`save_label_index`),
+        used instead of grouping the atlas voxels again.
 
     Returns
     -------
@@ -61,12 +1024,97 @@ def parcellate(
         Dataframe with the measure for each region of the atlas.
     """
     atlas_description = pd.read_csv(atlas_description, index_col=index_col).copy()
-    atlas_description["value"] = np.nan
-    atlas_data = nib.load(atlas_nifti).get_fdata()  # type: ignore[attr-defined]
     metric_data = nib.load(metric_image).get_fdata()  # type: ignore[attr-defined]
-    for i, row in atlas_description.iterrows():
-        region = int(row[region_col])
-        roi_mask = atlas_data == region
-        measure_value = measure(metric_data[roi_mask])
-        atlas_description.loc[i, "value"] = measure_value
+    regions = atlas_description[region_col].astype(int).to_numpy()
+    if atlas_index is not None:
+        labels, voxel_index, offsets = select_labels(
+            *load_label_index(atlas_index)[:3], regions
+        )
+    else:
+        atlas_data = nib.load(atlas_nifti).get_fdata()  # type: ignore[attr-defined]
+        labels, voxel_index, offsets = group_labels(atlas_data, regions)
+    values = metric_data.ravel()[voxel_index]
+    atlas_description["value"] = np.array(
+        [
+            measure(values[offsets[i] : offsets[i + 1]])
+            for i in np.searchsorted(labels, regions)
+        ],
+        dtype=float,
+    )
     return atlas_description
+
+
+def parcellate_volumes(
+    image: Union[str, Path],
+    voxel_index: np.ndarray,
+    offsets: np.ndarray,
+    slab_size: int = 1,
+) -> np.ndarray:
+    """
+    Regional mean signal of every volume of a 4D image.
+
+    The image is read in a single sequential pass through one open file
+    handle, ``slab_size`` volumes at a time, so only one slab is held in memory
+    and a compressed series is decompressed once rather than once per slab
+    (slicing the proxy ``dataobj`` restarts the decompression on every read).
+    Every slab is reduced with the same label grouping (see
+    :func:`group_labels`).
+
+    Parameters
+    ----------
+    image : Union[str, Path]
+        Path to the 4D image (e.g. a preprocessed DWI series).
+    voxel_index, offsets : np.ndarray
+        The label grouping of an atlas on the grid of ``image``.
+    slab_size : int, optional
+        Number of volumes read at once, by default 1
+
+    Returns
+    -------
+    np.ndarray
+        A regions x volumes matrix of NaN-ignoring means.
+    """
+    img = nib.load(image)
+    dataobj = img.dataobj  # type: ignore[attr-defined]
+    shape = dataobj.shape
+    n_volumes = shape[3] if len(shape) > 3 else 1
+    sizes = np.diff(offsets)
+    non_empty = sizes > 0
+    starts = offsets[:-1][non_empty]
+    signal = np.full((len(sizes), n_volumes), np.nan)
+    if not non_empty.any():
+        return signal
+    # NIfTI stores voxels in Fortran order, so each volume is a contiguous run
+    # of the file and the C-order voxel index is remapped onto that run
+    grid = shape[:3]
+    file_index = np.ravel_multi_index(
+        np.unravel_index(voxel_index, grid), grid, order="F"
+    )
+    volume_size = int(np.prod(grid))
+    dtype = dataobj.dtype
+    with nib.openers.ImageOpener(img.get_filename(), "rb") as fobj:
+        fobj.seek(dataobj.offset)
+        for first in range(0, n_volumes, slab_size):
+            last = min(first + slab_size, n_volumes)
+            count = volume_size * (last - first)
+            slab = np.frombuffer(fobj.read(count * dtype.itemsize), dtype=dtype)
+            values = slab.reshape(volume_size, last - first, order="F")[file_index]
+            values = values.astype(float) * dataobj.slope + dataobj.inter
+            isnan = np.isnan(values)
+            sums = np.add.reduceat(np.where(isnan, 0, values), starts, axis=0)
+            counts = np.add.reduceat(~isnan, starts, axis=0, dtype=np.intp)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                signal[non_empty, first:last] = sums / counts
+    return signal
+    for first in range(0, n_volumes, slab_size):
+        last = min(first + slab_size, n_volumes)
+        slab = np.asarray(
+            dataobj[..., first:last] if len(shape) > 3 else dataobj, dtype=float
+        )
+        values = slab.reshape(-1, last - first)[voxel_index]
+        isnan = np.isnan(values)
+        sums = np.add.reduceat(np.where(isnan, 0, values), starts, axis=0)
+        counts = np.add.reduceat(~isnan, starts, axis=0, dtype=np.intp)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            signal[non_empty, first:last] = sums / counts
+    return signal
@@ -319,6 +319,10 @@ class nipype(_Config):
 class execution(_Config):
     """Configure run-level settings."""
 
+    atlas_cache_dir = None
+    """A (possibly shared) directory where the atlases resampled to native spaces are cached across runs and sessions, keyed by the content of their inputs (no caching if None)."""
+    atlas_cache_size = 10.0
+    """Size (in GB) of the atlas cache, above which the least recently used atlases are evicted."""
     keprep_dir = None
     """An existing path to the dataset, which must be an output of KePrep."""
     keprep_database_dir = None
@@ -353,6 +357,7 @@ class execution(_Config):
     _layout = None
 
     _paths = (
+        "atlas_cache_dir",
         "keprep_dir",
         "keprep_database_dir",
         "fs_license_file",
@@ -428,7 +433,29 @@ class workflow(_Config):
     dipy_reconstruction_sigma = None
     """Sigma parameter for the RESTORE algorithm. If none provided, sigma will be estimated."""
     parcellate_gm = True
-    """Whether to apply gray matter masking to atlases prior to parcellation."""
+    """Whether to also parcellate within the gray matter (`label-GM`), i.e. the voxels of the whole-brain atlas whose GM probability (in `dwi` space) is at least `gm_probseg_threshold`."""
+    parcellation_space = "dwi"
+    """Space in which to parcellate the diffusion maps. Available spaces are: `dwi` (coregistered atlases), `MNI152NLin2009cAsym` (normalized maps and the atlases' cached voxel indices)."""
+    parcellation_measures: list = ["all"]
+    """Measure(s) to compute for every region. Available measures are: `all`, `zfmean`, `madmedian`, `qfmean`, `iqrmean`, `nanmean`, `nanmedian`, `nanstd`, `n_voxels`, `weighted_mean`, `weighted_median`, `weighted_std` (weighted by the GM probabilistic segmentation), and any measure added with :func:`~kepost.workflows.diffusion.procedures.parcellations.available_measures.register_measure`."""
+    bootstrap_measures: list = []
+    """Measure(s) to estimate bootstrap confidence intervals for (none by default)."""
+    bootstrap_n_resamples = 1000
+    """Number of bootstrap resamples."""
+    bootstrap_confidence = 0.95
+    """Confidence level of the bootstrap intervals."""
+    parcellation_sample_size = 0
+    """Maximal number of voxel values to sample (seeded, without replacement) per region and metric, kept as `desc-samples` derivatives to evaluate new measures without the images (0 to keep none)."""
+    parcellate_volumes = False
+    """Whether to extract the regional mean signal of every DWI volume (in `dwi` space only)."""
+    uncompressed_tensor_maps = False
+    """Whether the dipy tensor fit writes its parameter maps uncompressed, for the parcellation to memory-map rather than decompress (the derivatives sinks compress them)."""
+    atlas_lookup = False
+    """Whether to warp the atlases by gathering their labels through nearest-neighbour lookup maps, computed once per subject (MNI to T1w) and session (MNI to DWI), rather than with one ANTs and one FSL resampling per atlas."""
+    batch_atlases = False
+    """Whether to parcellate all of a session's atlases in a single task, loading every metric image once and filling the atlases' tables in `omp_nthreads` threads."""
+    parcellation_format = "pickle"
+    """File format of the parcellation derivatives. Available formats are: `pickle`, `parquet` (requires ``pyarrow``)."""
     response_algorithm = "dhollander"
     """Algorithm to estimate the response function."""
     fod_algorithm = "msmt_csd"
@@ -415,6 +415,11 @@ class TckMapInputSpec(MRTrix3BaseInputSpec):
         argstr="-upsample %d",
         desc="upsample the output image by this factor",
     )
+    tck_weights_in = File(
+        exists=True,
+        argstr="-tck_weights_in %s",
+        desc="input track weights as produced by SIFT2 algorithm.",
+    )
     force = traits.Bool(
         argstr="-force",
         desc="force overwrite of output files",
@@ -5,20 +5,25 @@ def plot_n_voxels_in_atlas(wholebrain: str, gm_cropped: str):
     Parameters
     ----------
     wholebrain : str
-        Path to the whole brain parcellation.
+        Path to the whole brain parcellation (or its ``.npz`` label index).
     gm_cropped : str
-        Path to the grey matter cropped parcellation.
+        Path to the grey matter cropped parcellation (or its label index).
     """
     import os
     from pathlib import Path
 
     import matplotlib.pyplot as plt
     import nibabel as nib
+    import numpy as np
     import pandas as pd
     import seaborn as sns
     from bids.layout import parse_file_entities
 
-    from kepost.atlases.utils import get_atlas_properties
+    from kepost.atlases.utils import (
+        get_atlas_properties,
+        group_labels,
+        load_label_index,
+    )
 
     atlas_name = parse_file_entities(wholebrain)["atlas"]
     if "schaefer2018" in atlas_name:
@@ -26,12 +31,19 @@ def plot_n_voxels_in_atlas(wholebrain: str, gm_cropped: str):
         atlas_name = atlas_name_part[0].replace("_atlas_name_", "")
     _, description, region_col, index_col = get_atlas_properties(atlas_name)
     df = pd.read_csv(description, index_col=index_col)
-    wb = nib.load(wholebrain).get_fdata().astype(int)  # type: ignore[attr-defined]
-    gm = nib.load(gm_cropped).get_fdata().astype(int)  # type: ignore[attr-defined]
-    for column, data in zip(["Uncropped", "GM-cropped"], [wb, gm]):
-        for i, row in df.iterrows():
-            roi = row[region_col]
-            df.loc[i, f"{column}"] = (data == roi).sum()
+    for column, parcellation in zip(
+        ["Uncropped", "GM-cropped"], [wholebrain, gm_cropped]
+    ):
+        if str(parcellation).endswith(".npz"):
+            labels, _, offsets, _ = load_label_index(parcellation)
+        else:
+            img = nib.load(parcellation)
+            data = np.asanyarray(img.dataobj)  # type: ignore[attr-defined]
+            labels, _, offsets = group_labels(data.astype(int))
+        n_voxels = pd.Series(np.diff(offsets), index=labels.astype(int))
+        df[column] = n_voxels.reindex(
+            df[region_col].astype(int), fill_value=0
+        ).to_numpy()
     df_long = df.melt(id_vars=[region_col], value_vars=["Uncropped", "GM-cropped"])
     sns.set_context("talk")
     sns.set_style("whitegrid")
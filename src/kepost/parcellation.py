@@ -0,0 +1,91 @@
+"""
+Parcellation of in-memory arrays, without NIfTI files or nipype nodes.
+
+The same engine as the workflows' parcellation nodes: the voxels of every
+region are grouped once (see :func:`kepost.atlases.utils.group_labels`) and
+all the measures are computed for all the regions at once (see
+:func:`~kepost.workflows.diffusion.procedures.parcellations.available_measures.compute_measures`).
+
+Examples
+--------
+>>> from kepost import parcellation
+>>> table = parcellation.compute(
+...     {"fa": fa_data, "md": md_data}, atlas_data, measures=["nanmean", "nanstd"]
+... )
+>>> table[("fa", "nanmean")]
+"""
+
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from kepost.atlases.utils import group_labels
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    SegmentedValues,
+    compute_measures,
+)
+
+
+def compute(
+    metric_arrays: Union[np.ndarray, dict],
+    label_array: np.ndarray,
+    measures: Optional[Union[str, list]] = None,
+    regions: Optional[np.ndarray] = None,
+    weights: Optional[np.ndarray] = None,
+) -> pd.DataFrame:
+    """
+    Compute (registered) measures of metric arrays within every region of a
+    label array.
+
+    Parameters
+    ----------
+    metric_arrays : Union[np.ndarray, dict]
+        A metric array, or several keyed by name, on the grid of
+        ``label_array``
+    label_array : np.ndarray
+        The label (atlas) array; 0 is background
+    measures : Union[str, list], optional
+        The measures to compute (see
+        :func:`~kepost.workflows.diffusion.procedures.parcellations.available_measures.get_measures`),
+        by default all
+    regions : np.ndarray, optional
+        The region labels to report, by default all the non-zero labels of
+        ``label_array``; regions without voxels get NaN measures
+    weights : np.ndarray, optional
+        Per-voxel weights (e.g. a GM probabilistic segmentation) used by the
+        weighted measures, on the grid of ``label_array``; without them, the
+        weighted measures are left out of "all" (and NaN if requested)
+
+    Returns
+    -------
+    pd.DataFrame
+        A regions x measures table, or regions x (metric, measure) if several
+        metric arrays are given
+    """
+    arrays = metric_arrays if isinstance(metric_arrays, dict) else {None: metric_arrays}
+    shape = np.shape(label_array)[:3]
+    named_arrays = [(f"{name or 'metric'} array", a) for name, a in arrays.items()]
+    if weights is not None:
+        named_arrays.append(("weights", weights))
+    for name, array in named_arrays:
+        if np.shape(array)[:3] != shape:
+            raise ValueError(
+                f"The {name} (shape {np.shape(array)}) is not on the grid of the "
+                f"label array (shape {np.shape(label_array)})."
+            )
+    labels, voxel_index, offsets = group_labels(label_array, regions)
+    if weights is not None:
+        weights = np.asanyarray(weights).ravel()[voxel_index]
+    tables = {}
+    for name, array in arrays.items():
+        segments = SegmentedValues(
+            np.asanyarray(array).ravel()[voxel_index], offsets, weights
+        )
+        tables[name] = pd.DataFrame(
+            compute_measures(segments, measures),
+            index=pd.Index(labels, name="region"),
+        )
+    if not isinstance(metric_arrays, dict):
+        return tables[None]
+    return pd.concat(tables, axis=1, names=["metric", "measure"])
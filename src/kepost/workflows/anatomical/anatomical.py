@@ -3,13 +3,14 @@ Module for the anatomical postprocessing workflow.
 """
 
 from nipype.interfaces import utility as niu
+from nipype.interfaces.ants import ApplyTransforms
 from nipype.interfaces.ants.base import Info as ANTsInfo
 from nipype.interfaces.fsl import Info as FSLInfo
 from nipype.pipeline import engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
 from kepost import config
-from kepost.atlases.utils import get_atlas_properties
+from kepost.atlases.utils import write_lookup_source
 from kepost.interfaces.reports.viz import OverlayRPT
 from kepost.interfaces.utils.vis import plot_n_voxels_in_atlas
 from kepost.workflows.anatomical.descriptions.anatomical import (
@@ -29,6 +30,11 @@ def init_anatomical_wf(
 ):
     """
     Initialize the anatomical postprocessing workflow.
+
+    The ``atlases`` iterable is the atlas fan-out boundary: only its
+    descendants (the registration and GM cropping of every atlas, along with
+    their reports) are replicated per atlas. The 5TT image is computed once
+    per subject, and is passed on next to (not downstream of) the atlases.
     """
 
     atlases_unique = config.workflow.atlases.copy()
@@ -64,7 +70,6 @@ def init_anatomical_wf(
                 "mni_to_native_transform",
                 "gm_probabilistic_segmentation",
                 "probseg_threshold",
-                "atlas_name",
                 "subject_id",
             ]
         ),
@@ -83,34 +88,20 @@ def init_anatomical_wf(
                 "whole_brain_parcellation",
                 "gm_cropped_parcellation",
                 "five_tissue_type",
+                "t1w_lookup",
             ]
         ),
         name="outputnode",
     )
-    get_atlas_info_node = pe.Node(
-        niu.Function(
-            input_names=["atlas"],
-            output_names=["nifti", "description", "region_col", "index_col"],
-            function=get_atlas_properties,
-        ),
-        name="get_atlas_info",
-    )
     workflow.connect(
         [
             (
-                inputnode,
+                atlases_node,
                 outputnode,
                 [
                     ("atlas_name", "atlas_name"),
                 ],
             ),
-            (
-                atlases_node,
-                get_atlas_info_node,
-                [
-                    ("atlas_name", "atlas"),
-                ],
-            ),
         ]
     )
 
@@ -126,15 +117,12 @@ def init_anatomical_wf(
                         "mni_to_native_transform",
                         "inputnode.mni_to_native_transform",
                     ),
-                    ("atlas_name", "inputnode.atlas_name"),
                 ],
             ),
             (
-                get_atlas_info_node,
+                atlases_node,
                 registration_wf,
-                [
-                    ("nifti", "inputnode.atlas_nifti_file"),
-                ],
+                [("atlas_name", "inputnode.atlas_name")],
             ),
             (
                 registration_wf,
@@ -148,6 +136,43 @@ def init_anatomical_wf(
             ),
         ]
     )
+    if config.workflow.atlas_lookup:
+        # the MNI voxel of every T1w voxel, computed once for all the atlases
+        lookup_source = pe.Node(
+            niu.Function(
+                input_names=[],
+                output_names=["out_file"],
+                function=write_lookup_source,
+            ),
+            name="lookup_source",
+        )
+        t1w_lookup = pe.Node(
+            interface=ApplyTransforms(
+                interpolation="NearestNeighbor",
+                dimension=3,
+                default_value=0,
+            ),
+            name="t1w_lookup",
+        )
+        workflow.connect(
+            [
+                (lookup_source, t1w_lookup, [("out_file", "input_image")]),
+                (
+                    inputnode,
+                    t1w_lookup,
+                    [
+                        ("mni_to_native_transform", "transforms"),
+                        ("t1w_preproc", "reference_image"),
+                    ],
+                ),
+                (
+                    t1w_lookup,
+                    registration_wf,
+                    [("output_image", "inputnode.t1w_lookup")],
+                ),
+                (t1w_lookup, outputnode, [("output_image", "t1w_lookup")]),
+            ]
+        )
     gm_cropping_wf = init_gm_cropping_wf()
     atlas_reg = pe.Node(interface=OverlayRPT(), name="atlas_registration_report")
     n_voxels_report = pe.Node(
@@ -280,9 +305,13 @@ def init_anatomical_wf(
                         "t1w_preproc",
                         "inputnode.t1w_preproc",
                     ),
-                    ("atlas_name", "inputnode.atlas_name"),
                 ],
             ),
+            (
+                atlases_node,
+                derivatives_wf,
+                [("atlas_name", "inputnode.atlas_name")],
+            ),
             (
                 registration_wf,
                 derivatives_wf,
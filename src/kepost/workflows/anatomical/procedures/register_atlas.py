@@ -3,6 +3,13 @@ from nipype.interfaces.ants import ApplyTransforms
 from nipype.pipeline import engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
+from kepost import config
+from kepost.atlases.utils import (
+    cached_apply_transforms,
+    select_atlas_resolution,
+    warp_labels,
+)
+
 
 def init_registration_wf(
     name: str = "atlas_registration",
@@ -14,6 +21,19 @@ def init_registration_wf(
     ----------
     name : str, optional
         The name of the workflow, by default "registration"
+
+    Notes
+    -----
+    The atlas is resampled from its resolution that best matches the T1w
+    grid (see :func:`~kepost.atlases.utils.select_atlas_resolution`); the
+    DWI-space atlases are resampled from MNI on their own, at the DWI grid's
+    resolution (see the atlas coregistration workflow). With
+    ``config.workflow.atlas_lookup``, the atlas is gathered through the
+    subject's lookup map (the ``t1w_lookup`` input) instead of being
+    resampled with the ANTs transforms. Otherwise, with
+    ``config.execution.atlas_cache_dir``, the resampled atlases are reused
+    across runs and subjects' sessions (see
+    :func:`~kepost.atlases.utils.cached_file`).
     """
     workflow = Workflow(name=name)
     inputnode = pe.Node(
@@ -22,7 +42,7 @@ def init_registration_wf(
                 "t1w_preproc",
                 "mni_to_native_transform",
                 "atlas_name",
-                "atlas_nifti_file",
+                "t1w_lookup",
             ]
         ),
         name="inputnode",
@@ -31,25 +51,95 @@ def init_registration_wf(
         interface=niu.IdentityInterface(fields=["whole_brain_parcellation"]),
         name="outputnode",
     )
-    apply_transforms = pe.Node(
-        interface=ApplyTransforms(
-            interpolation="NearestNeighbor",
-            dimension=3,
+    select_resolution = pe.Node(
+        niu.Function(
+            input_names=["atlas_name", "reference_image"],
+            output_names=["atlas_nifti"],
+            function=select_atlas_resolution,
         ),
-        name="apply_transforms",
+        name="select_resolution",
     )
-
     workflow.connect(
         [
             (
                 inputnode,
-                apply_transforms,
+                select_resolution,
                 [
-                    ("atlas_nifti_file", "input_image"),
-                    ("mni_to_native_transform", "transforms"),
+                    ("atlas_name", "atlas_name"),
                     ("t1w_preproc", "reference_image"),
                 ],
             ),
+        ]
+    )
+    if config.workflow.atlas_lookup:
+        apply_transforms = pe.Node(
+            niu.Function(
+                input_names=["atlas_nifti", "lookup_file"],
+                output_names=["output_image"],
+                function=warp_labels,
+            ),
+            name="gather_labels",
+        )
+        workflow.connect(
+            [
+                (
+                    select_resolution,
+                    apply_transforms,
+                    [("atlas_nifti", "atlas_nifti")],
+                ),
+                (
+                    inputnode,
+                    apply_transforms,
+                    [("t1w_lookup", "lookup_file")],
+                ),
+            ]
+        )
+    elif config.execution.atlas_cache_dir:
+        apply_transforms = pe.Node(
+            niu.Function(
+                input_names=[
+                    "input_image",
+                    "transforms",
+                    "reference_image",
+                    "cache_dir",
+                    "cache_size",
+                ],
+                output_names=["output_image"],
+                function=cached_apply_transforms,
+                imports=["from typing import Optional, Union"],
+            ),
+            name="apply_transforms",
+        )
+        apply_transforms.inputs.cache_dir = str(config.execution.atlas_cache_dir)
+        apply_transforms.inputs.cache_size = config.execution.atlas_cache_size
+    else:
+        apply_transforms = pe.Node(
+            interface=ApplyTransforms(
+                interpolation="NearestNeighbor",
+                dimension=3,
+            ),
+            name="apply_transforms",
+        )
+    if not config.workflow.atlas_lookup:
+        workflow.connect(
+            [
+                (
+                    select_resolution,
+                    apply_transforms,
+                    [("atlas_nifti", "input_image")],
+                ),
+                (
+                    inputnode,
+                    apply_transforms,
+                    [
+                        ("mni_to_native_transform", "transforms"),
+                        ("t1w_preproc", "reference_image"),
+                    ],
+                ),
+            ]
+        )
+    workflow.connect(
+        [
             (
                 apply_transforms,
                 outputnode,
@@ -20,6 +20,9 @@ from kepost.interfaces.reports import AboutSummary, SubjectSummary
 from kepost.workflows.anatomical import init_anatomical_wf
 from kepost.workflows.descriptions import BASE_POSTDESC, BASE_WORKFLOW_DESCRIPTION
 from kepost.workflows.diffusion.diffusion import init_diffusion_wf
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    get_measures,
+)
 
 # from niworkflows.interfaces.bids import BIDSInfo, DerivativesDataSink
 
@@ -50,6 +53,11 @@ def init_kepost_wf():
                 """
             )
     config.workflow.atlases = atlases
+    # validated only: "all" is resolved at parcellation time, as the weighted
+    # measures are only computed where the voxels are weighted
+    get_measures(config.workflow.parcellation_measures)
+    if config.workflow.bootstrap_measures:
+        get_measures(config.workflow.bootstrap_measures)
 
     ver = Version(config.environment.version)
     kepost_wf = Workflow(name=f"kepost_{ver.major}_{ver.minor}_wf")
@@ -271,6 +279,10 @@ def init_single_subject_wf(subject_id: str, name: str):
                             "native_to_mni_transform",
                             "inputnode.native_to_mni_transform",
                         ),
+                        (
+                            "mni_to_native_transform",
+                            "inputnode.mni_to_native_transform",
+                        ),
                     ],
                 ),
                 (
@@ -279,20 +291,17 @@ def init_single_subject_wf(subject_id: str, name: str):
                     [
                         (
                             "outputnode.whole_brain_parcellation",
-                            "inputnode.whole_brain_t1w_parcellation",
-                        ),
-                        (
-                            "outputnode.gm_cropped_parcellation",
-                            "inputnode.gm_cropped_t1w_parcellation",
+                            "atlas_inputnode.whole_brain_t1w_parcellation",
                         ),
                         (
                             "outputnode.atlas_name",
-                            "inputnode.atlas_name",
+                            "atlas_inputnode.atlas_name",
                         ),
                         (
                             "outputnode.five_tissue_type",
                             "inputnode.five_tissue_type",
                         ),
+                        ("outputnode.t1w_lookup", "inputnode.t1w_lookup"),
                     ],
                 ),
             ]
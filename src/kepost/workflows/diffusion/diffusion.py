@@ -4,6 +4,7 @@ from nipype.pipeline import engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
 from kepost import config
+from kepost.atlases.utils import get_standard_atlas
 from kepost.interfaces.bids.bids import DerivativesDataSink
 from kepost.interfaces.reports.viz import OverlayRPT
 from kepost.workflows.diffusion.descriptions.diffusion import (
@@ -15,8 +16,8 @@ from kepost.workflows.diffusion.descriptions.tensor_estimation import (
 )
 from kepost.workflows.diffusion.procedures import (
     init_coregistration_wf,
-    init_parcellations_wf,
     init_qc_wf,
+    init_session_parcellations_wf,
     init_tensor_estimation_wf,
     init_tissue_coregistration_wf,
     init_tractography_wf,
@@ -27,6 +28,14 @@ from kepost.workflows.diffusion.procedures.tensor_estimations.dipy.dipy import (
 from kepost.workflows.diffusion.procedures.tensor_estimations.mrtrix3.mrtrix3 import (
     TENSOR_PARAMETERS as mrtrix3_parameters,
 )
+from kepost.workflows.diffusion.procedures.tractography.tractography import (
+    format_algorithm,
+    tractography_algorithms,
+    tractography_maps,
+)
+
+#: Inputs of the diffusion workflow that differ per atlas
+ATLAS_INPUTS = ["atlas_name", "whole_brain_t1w_parcellation"]
 
 
 def init_diffusion_wf(
@@ -42,6 +51,14 @@ def init_diffusion_wf(
     prefix : str, optional
         The name of the workflow, by default "dwi_postprocess"
 
+    Notes
+    -----
+    The per-atlas inputs (:data:`ATLAS_INPUTS`) are received by the
+    ``atlas_inputnode``, the atlas fan-out boundary of the workflow: only the
+    nodes downstream of it (the atlas coregistration and the parcellations)
+    are replicated per atlas, while the tensor fits, QC, FODs and
+    tractography run once per session.
+
     Returns
     -------
     Workflow
@@ -55,7 +72,6 @@ def init_diffusion_wf(
         interface=niu.IdentityInterface(
             fields=[
                 "base_directory",
-                "atlas_name",
                 "dwi_reference",
                 "dwi_nifti",
                 "dwi_bval",
@@ -64,8 +80,6 @@ def init_diffusion_wf(
                 "dwi_mask",
                 "dwi_to_t1w_transform",
                 "t1w_to_dwi_transform",
-                "whole_brain_t1w_parcellation",
-                "gm_cropped_t1w_parcellation",
                 "dipy_fit_method",
                 "t1w_preproc",
                 "t1w_brain_mask",
@@ -74,7 +88,9 @@ def init_diffusion_wf(
                 "csf_probabilistic_segmentation",
                 "five_tissue_type",
                 "native_to_mni_transform",
+                "mni_to_native_transform",
                 "eddy_qc",
+                "t1w_lookup",
             ]
         ),
         name="inputnode",
@@ -89,12 +105,15 @@ def init_diffusion_wf(
     inputnode.inputs.dwi_to_t1w_transform = dwi_data["dwi_to_t1w_transform"]
     inputnode.inputs.eddy_qc = dwi_data["eddy_qc"]
     inputnode.inputs.dipy_fit_method = config.workflow.dipy_reconstruction_method
+    atlas_inputnode = pe.Node(
+        interface=niu.IdentityInterface(fields=ATLAS_INPUTS),
+        name="atlas_inputnode",
+    )
 
     outputnode = pe.Node(
         interface=niu.IdentityInterface(
             fields=[
                 "whole_brain_parcellation",
-                "gm_cropped_parcellation",
             ]
         ),
         name="outputnode",
@@ -112,16 +131,23 @@ def init_diffusion_wf(
                         "t1w_to_dwi_transform",
                         "inputnode.t1w_to_dwi_transform",
                     ),
+                    ("base_directory", "inputnode.base_directory"),
+                    ("t1w_lookup", "inputnode.t1w_lookup"),
                     (
-                        "whole_brain_t1w_parcellation",
-                        "inputnode.whole_brain_parcellation",
+                        "mni_to_native_transform",
+                        "inputnode.mni_to_native_transform",
                     ),
+                ],
+            ),
+            (
+                atlas_inputnode,
+                coregister_wf,
+                [
                     (
-                        "gm_cropped_t1w_parcellation",
-                        "inputnode.gm_cropped_parcellation",
+                        "whole_brain_t1w_parcellation",
+                        "inputnode.whole_brain_parcellation",
                     ),
                     ("atlas_name", "inputnode.atlas_name"),
-                    ("base_directory", "inputnode.base_directory"),
                 ],
             ),
             (
@@ -132,10 +158,6 @@ def init_diffusion_wf(
                         "outputnode.whole_brain_parcellation",
                         "whole_brain_parcellation",
                     ),
-                    (
-                        "outputnode.gm_cropped_parcellation",
-                        "gm_cropped_parcellation",
-                    ),
                 ],
             ),
         ]
@@ -255,120 +277,123 @@ def init_diffusion_wf(
             ),
         ]
     )
-    dipy_parcellations_wf = init_parcellations_wf(
-        inputs=dipy_parameters, software="dipy"
-    )
-    mrtrix3_parcellations_wf = init_parcellations_wf(
-        inputs=mrtrix3_parameters, software="mrtrix3"
+    # parcellate either the native maps or the ones normalized to the atlases' space
+    standard_space = config.workflow.parcellation_space != "dwi"
+    maps_prefix = "standard_" if standard_space else ""
+    # the tractography-derived maps are only available in the native space
+    tract_maps = [] if standard_space else tractography_maps()
+    parcellations_wf = init_session_parcellations_wf(
+        inputs={"dipy": dipy_parameters, "mrtrix3": mrtrix3_parameters},
     )
+    parcellating_wfs = [parcellations_wf]
+    if tract_maps:
+        # parcellated apart from the tensor maps (with the same atlas index),
+        # so that their parcellation does not wait for the tractography
+        tract_parcellations_wf = init_session_parcellations_wf(
+            inputs={"mrtrix3": tract_maps},
+            volumes=False,
+            name="tract_parcellations_wf",
+        )
+        parcellating_wfs.append(tract_parcellations_wf)
+    for parcellating_wf in parcellating_wfs:
+        workflow.connect(
+            [
+                (
+                    inputnode,
+                    parcellating_wf,
+                    [
+                        ("base_directory", "inputnode.base_directory"),
+                        ("dwi_nifti", "inputnode.source_file"),
+                        ("dwi_nifti", "inputnode.dwi_nifti"),
+                    ],
+                ),
+                (
+                    atlas_inputnode,
+                    parcellating_wf,
+                    [("atlas_name", "inputnode.atlas_name")],
+                ),
+                (
+                    tensor_estimation_wf,
+                    parcellating_wf,
+                    [("outputnode.acq_label", "inputnode.acq_label")],
+                ),
+            ]
+        )
     workflow.connect(
         [
-            (
-                inputnode,
-                dipy_parcellations_wf,
-                [
-                    ("base_directory", "inputnode.base_directory"),
-                    ("dwi_nifti", "inputnode.source_file"),
-                    ("atlas_name", "inputnode.atlas_name"),
-                ],
-            ),
-            (
-                inputnode,
-                mrtrix3_parcellations_wf,
-                [
-                    ("base_directory", "inputnode.base_directory"),
-                    ("dwi_nifti", "inputnode.source_file"),
-                    ("atlas_name", "inputnode.atlas_name"),
-                ],
-            ),
-            (
-                tensor_estimation_wf,
-                dipy_parcellations_wf,
-                [
-                    (f"dipy_tensor_wf.outputnode.{param}", f"inputnode.{param}")
-                    for param in dipy_parameters
-                ],
-            ),
-            (
-                tensor_estimation_wf,
-                mrtrix3_parcellations_wf,
-                [
-                    (f"mrtrix3_tensor_wf.outputnode.{param}", f"inputnode.{param}")
-                    for param in mrtrix3_parameters
-                ],
-            ),
             (
                 tensor_estimation_wf,
-                dipy_parcellations_wf,
+                parcellations_wf,
                 [
                     (
-                        "outputnode.acq_label",
-                        "inputnode.acq_label",
+                        f"dipy_tensor_wf.outputnode.{maps_prefix}{param}",
+                        f"inputnode.dipy_{param}",
                     )
-                ],
-            ),
-            (
-                tensor_estimation_wf,
-                mrtrix3_parcellations_wf,
-                [
+                    for param in dipy_parameters
+                ]
+                + [
                     (
-                        "outputnode.acq_label",
-                        "inputnode.acq_label",
+                        f"mrtrix3_tensor_wf.outputnode.{maps_prefix}{param}",
+                        f"inputnode.mrtrix3_{param}",
                     )
+                    for param in mrtrix3_parameters
                 ],
             ),
         ]
     )
-    if config.workflow.parcellate_gm:
-        workflow.connect(
-            [
-                (
-                    coregister_wf,
-                    dipy_parcellations_wf,
-                    [
-                        (
-                            "outputnode.gm_cropped_parcellation",
-                            "inputnode.atlas_nifti",
-                        ),
-                    ],
-                ),
-                (
-                    coregister_wf,
-                    mrtrix3_parcellations_wf,
-                    [
-                        (
-                            "outputnode.gm_cropped_parcellation",
-                            "inputnode.atlas_nifti",
-                        ),
-                    ],
-                ),
-            ]
+    if standard_space:
+        standard_atlas_node = pe.Node(
+            niu.Function(
+                input_names=["atlas_name"],
+                output_names=["atlas_nifti", "atlas_index"],
+                function=get_standard_atlas,
+            ),
+            name="get_standard_atlas",
         )
-    else:
         workflow.connect(
             [
                 (
-                    coregister_wf,
-                    dipy_parcellations_wf,
-                    [
-                        (
-                            "outputnode.whole_brain_parcellation",
-                            "inputnode.atlas_nifti",
-                        ),
-                    ],
+                    atlas_inputnode,
+                    standard_atlas_node,
+                    [("atlas_name", "atlas_name")],
                 ),
                 (
-                    coregister_wf,
-                    mrtrix3_parcellations_wf,
+                    standard_atlas_node,
+                    parcellations_wf,
                     [
-                        (
-                            "outputnode.whole_brain_parcellation",
-                            "inputnode.atlas_nifti",
-                        ),
+                        ("atlas_nifti", "inputnode.atlas_nifti"),
+                        ("atlas_index", "inputnode.atlas_index"),
                     ],
                 ),
             ]
         )
+    else:
+        # the GM probseg both weights the weighted measures and crops the
+        # whole-brain parcellation to the GM (see config.workflow.parcellate_gm)
+        for parcellating_wf in parcellating_wfs:
+            workflow.connect(
+                [
+                    (
+                        tissue_coreg_wf,
+                        parcellating_wf,
+                        [("outputnode.gm_probseg_dwiref", "inputnode.gm_probseg")],
+                    ),
+                    (
+                        coregister_wf,
+                        parcellating_wf,
+                        [
+                            (
+                                "outputnode.whole_brain_parcellation",
+                                "inputnode.atlas_nifti",
+                            ),
+                            (
+                                "outputnode.whole_brain_parcellation_index",
+                                "inputnode.atlas_index",
+                            ),
+                        ],
+                    ),
+                ]
+            )
 
     tractography_wf = init_tractography_wf()
     workflow.connect(
@@ -392,6 +417,42 @@ def init_diffusion_wf(
             ),
         ]
     )
+    if tract_maps:
+        workflow.connect(
+            [
+                (
+                    tractography_wf,
+                    tract_parcellations_wf,
+                    [("outputnode.afd", "inputnode.mrtrix3_afd")],
+                ),
+            ]
+        )
+        algorithms = [format_algorithm(a) for a in tractography_algorithms()]
+        for kind in ["tdi", "sift2_tdi"]:
+            split_maps = pe.Node(
+                niu.Split(splits=[1] * len(algorithms), squeeze=True),
+                name=f"split_{kind}_maps",
+            )
+            workflow.connect(
+                [
+                    (
+                        tractography_wf,
+                        split_maps,
+                        [(f"outputnode.{kind}_maps", "inlist")],
+                    ),
+                    (
+                        split_maps,
+                        tract_parcellations_wf,
+                        [
+                            (
+                                f"out{i + 1}",
+                                f"inputnode.mrtrix3_{kind.replace('_', '')}{algorithm}",
+                            )
+                            for i, algorithm in enumerate(algorithms)
+                        ],
+                    ),
+                ]
+            )
     return workflow
 
 
@@ -4,6 +4,7 @@ from kepost.workflows.diffusion.procedures.coregisterations import (  # noqa: F4
 )
 from kepost.workflows.diffusion.procedures.parcellations.parcellations import (  # noqa: F401
     init_parcellations_wf,
+    init_session_parcellations_wf,
 )
 from kepost.workflows.diffusion.procedures.quality_control.quality_control import (  # noqa: F401
     init_qc_wf,
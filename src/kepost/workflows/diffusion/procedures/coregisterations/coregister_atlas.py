@@ -1,8 +1,17 @@
 from nipype.interfaces import fsl
 from nipype.interfaces import utility as niu
+from nipype.interfaces.ants import ApplyTransforms
 from nipype.pipeline import engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
+from kepost import config
+from kepost.atlases.utils import (
+    cached_apply_transforms,
+    fsl_to_itk,
+    index_atlas,
+    select_atlas_resolution,
+    warp_atlas,
+)
 from kepost.interfaces.bids import DerivativesDataSink
 from kepost.interfaces.bids.utils import get_entity
 from kepost.workflows.diffusion.descriptions.coregisterations import (
@@ -27,6 +36,16 @@ def init_coregistration_wf(
     -------
     Workflow
         The coregistration workflow
+
+    Notes
+    -----
+    Unless ``config.workflow.atlas_lookup``, the atlas is resampled from
+    MNI to the DWI grid at once, chaining the
+    subject's MNI-to-T1w transform with the session's T1w-to-DWI matrix (as
+    an ITK transform, see :func:`~kepost.atlases.utils.fsl_to_itk`), from its
+    resolution that best matches the DWI grid (see
+    :func:`~kepost.atlases.utils.select_atlas_resolution`). The T1w-space
+    atlas (``whole_brain_parcellation``) only names the derivatives.
     """
     workflow = Workflow(name=name)
     workflow.__desc__ = COREGISTERATIONS_WORKFLOW_DESCRIPTION
@@ -39,7 +58,8 @@ def init_coregistration_wf(
                 "t1w_to_dwi_transform",
                 "atlas_name",
                 "whole_brain_parcellation",
-                "gm_cropped_parcellation",
+                "t1w_lookup",
+                "mni_to_native_transform",
             ]
         ),
         name="inputnode",
@@ -48,7 +68,7 @@ def init_coregistration_wf(
         interface=niu.IdentityInterface(
             fields=[
                 "whole_brain_parcellation",
-                "gm_cropped_parcellation",
+                "whole_brain_parcellation_index",
                 "t1w_in_dwi_space",
                 "dwi_brain_mask",
             ]
@@ -114,15 +134,141 @@ def init_coregistration_wf(
             ),
         ]
     )
-    # run apply transforms on both parcellations, naming them appropriately
-    apply_transforms_wholebrain = pe.Node(
-        fsl.ApplyXFM(interp="nearestneighbour", apply_xfm=True),
-        name="apply_transforms_wholebrain",
-    )
-    apply_transforms_gm_cropped = pe.Node(
-        fsl.ApplyXFM(interp="nearestneighbour", apply_xfm=True),
-        name="apply_transforms_gm_cropped",
-    )
+    # only the whole-brain parcellation is resampled; it is cropped to the GM
+    # in memory, at parcellation time
+    if config.workflow.atlas_lookup:
+        # the MNI voxel of every DWI voxel (through the T1w one), computed once
+        # per session; every atlas is then gathered from its MNI image
+        dwi_lookup = pe.Node(
+            fsl.ApplyXFM(interp="nearestneighbour", apply_xfm=True),
+            name="dwi_lookup",
+        )
+        apply_transforms_wholebrain = pe.Node(
+            niu.Function(
+                input_names=["atlas_name", "lookup_file"],
+                output_names=["out_file"],
+                function=warp_atlas,
+            ),
+            name="gather_wholebrain",
+        )
+        workflow.connect(
+            [
+                (
+                    inputnode,
+                    dwi_lookup,
+                    [
+                        ("t1w_lookup", "in_file"),
+                        ("dwi_reference", "reference"),
+                        ("t1w_to_dwi_transform", "in_matrix_file"),
+                    ],
+                ),
+                (
+                    dwi_lookup,
+                    apply_transforms_wholebrain,
+                    [("out_file", "lookup_file")],
+                ),
+                (
+                    inputnode,
+                    apply_transforms_wholebrain,
+                    [("atlas_name", "atlas_name")],
+                ),
+            ]
+        )
+        wholebrain_output = "out_file"
+    else:
+        # a single resampling, from the atlas resolution matching the DWI grid
+        select_resolution = pe.Node(
+            niu.Function(
+                input_names=["atlas_name", "reference_image"],
+                output_names=["atlas_nifti"],
+                function=select_atlas_resolution,
+            ),
+            name="select_resolution",
+        )
+        t1w_to_dwi_itk = pe.Node(
+            niu.Function(
+                input_names=["in_matrix_file", "reference", "in_file"],
+                output_names=["out_file"],
+                function=fsl_to_itk,
+            ),
+            name="t1w_to_dwi_itk",
+        )
+        # ANTs applies the last transform first: DWI to T1w, then T1w to MNI
+        mni_to_dwi_transforms = pe.Node(
+            niu.Merge(numinputs=2, ravel_inputs=True),
+            name="mni_to_dwi_transforms",
+        )
+        if config.execution.atlas_cache_dir:
+            # reused across runs and sessions sharing the same inputs
+            apply_transforms_wholebrain = pe.Node(
+                niu.Function(
+                    input_names=[
+                        "input_image",
+                        "transforms",
+                        "reference_image",
+                        "cache_dir",
+                        "cache_size",
+                    ],
+                    output_names=["output_image"],
+                    function=cached_apply_transforms,
+                    imports=["from typing import Optional, Union"],
+                ),
+                name="apply_transforms_wholebrain",
+            )
+            apply_transforms_wholebrain.inputs.cache_dir = str(
+                config.execution.atlas_cache_dir
+            )
+            apply_transforms_wholebrain.inputs.cache_size = (
+                config.execution.atlas_cache_size
+            )
+        else:
+            apply_transforms_wholebrain = pe.Node(
+                ApplyTransforms(interpolation="NearestNeighbor", dimension=3),
+                name="apply_transforms_wholebrain",
+            )
+        workflow.connect(
+            [
+                (
+                    inputnode,
+                    select_resolution,
+                    [
+                        ("atlas_name", "atlas_name"),
+                        ("dwi_reference", "reference_image"),
+                    ],
+                ),
+                (
+                    inputnode,
+                    t1w_to_dwi_itk,
+                    [
+                        ("t1w_to_dwi_transform", "in_matrix_file"),
+                        ("dwi_reference", "reference"),
+                        ("t1w_preproc", "in_file"),
+                    ],
+                ),
+                (
+                    inputnode,
+                    mni_to_dwi_transforms,
+                    [("mni_to_native_transform", "in1")],
+                ),
+                (t1w_to_dwi_itk, mni_to_dwi_transforms, [("out_file", "in2")]),
+                (
+                    select_resolution,
+                    apply_transforms_wholebrain,
+                    [("atlas_nifti", "input_image")],
+                ),
+                (
+                    mni_to_dwi_transforms,
+                    apply_transforms_wholebrain,
+                    [("out", "transforms")],
+                ),
+                (
+                    inputnode,
+                    apply_transforms_wholebrain,
+                    [("dwi_reference", "reference_image")],
+                ),
+            ]
+        )
+        wholebrain_output = "output_image"
     apply_transforms_t1w = pe.Node(
         fsl.ApplyXFM(
             apply_xfm=True,
@@ -138,13 +284,6 @@ def init_coregistration_wf(
         name="ds_wholebrain",
     )
 
-    ds_gm_cropped = pe.Node(
-        interface=DerivativesDataSink(
-            **workflow_entities["gm_cropped_parcellation"],
-            copy=True,
-        ),
-        name="ds_gm_cropped",
-    )
     ds_t1w = pe.Node(
         interface=DerivativesDataSink(
             **workflow_entities["t1w_in_dwi_space"],
@@ -154,24 +293,6 @@ def init_coregistration_wf(
     )
     workflow.connect(
         [
-            (
-                inputnode,
-                apply_transforms_wholebrain,
-                [
-                    ("whole_brain_parcellation", "in_file"),
-                    ("dwi_reference", "reference"),
-                    ("t1w_to_dwi_transform", "in_matrix_file"),
-                ],
-            ),
-            (
-                inputnode,
-                apply_transforms_gm_cropped,
-                [
-                    ("gm_cropped_parcellation", "in_file"),
-                    ("dwi_reference", "reference"),
-                    ("t1w_to_dwi_transform", "in_matrix_file"),
-                ],
-            ),
             (
                 inputnode,
                 apply_transforms_t1w,
@@ -221,7 +342,7 @@ def init_coregistration_wf(
                 apply_transforms_wholebrain,
                 ds_wholebrain,
                 [
-                    ("out_file", "in_file"),
+                    (wholebrain_output, "in_file"),
                 ],
             ),
             (
@@ -232,63 +353,58 @@ def init_coregistration_wf(
                 ],
             ),
             (
-                get_atlas_name_node,
-                ds_gm_cropped,
-                [
-                    ("atlas_name", "atlas"),
-                ],
-            ),
-            (
-                get_atlas_den_node,
-                ds_gm_cropped,
-                [
-                    ("atlas_den", "den"),
-                ],
-            ),
-            (
-                get_atlas_div_node,
-                ds_gm_cropped,
-                [
-                    ("atlas_division", "division"),
-                ],
-            ),
-            (
-                apply_transforms_gm_cropped,
-                ds_gm_cropped,
+                inputnode,
+                ds_t1w,
                 [
-                    ("out_file", "in_file"),
+                    ("base_directory", "base_directory"),
+                    ("dwi_reference", "source_file"),
                 ],
             ),
             (
-                ds_gm_cropped,
                 outputnode,
+                ds_t1w,
                 [
-                    ("out_file", "gm_cropped_parcellation"),
+                    ("t1w_in_dwi_space", "in_file"),
                 ],
             ),
+        ]
+    )
+    # index the voxels of each region once, for all downstream consumers
+    index_node = pe.Node(
+        niu.Function(
+            input_names=["in_file"],
+            output_names=["out_file"],
+            function=index_atlas,
+        ),
+        name="index_whole_brain_parcellation",
+    )
+    ds_index = pe.Node(
+        interface=DerivativesDataSink(
+            **workflow_entities["wholebrain_parcellation_index"],
+            copy=True,
+        ),
+        name="ds_whole_brain_parcellation_index",
+    )
+    workflow.connect(
+        [
             (
-                inputnode,
-                ds_gm_cropped,
-                [
-                    ("base_directory", "base_directory"),
-                    ("dwi_reference", "source_file"),
-                ],
+                apply_transforms_wholebrain,
+                index_node,
+                [(wholebrain_output, "in_file")],
             ),
+            (index_node, ds_index, [("out_file", "in_file")]),
             (
                 inputnode,
-                ds_t1w,
+                ds_index,
                 [
                     ("base_directory", "base_directory"),
                     ("dwi_reference", "source_file"),
                 ],
             ),
-            (
-                outputnode,
-                ds_t1w,
-                [
-                    ("t1w_in_dwi_space", "in_file"),
-                ],
-            ),
+            (get_atlas_name_node, ds_index, [("atlas_name", "atlas")]),
+            (get_atlas_den_node, ds_index, [("atlas_den", "den")]),
+            (get_atlas_div_node, ds_index, [("atlas_division", "division")]),
+            (ds_index, outputnode, [("out_file", "whole_brain_parcellation_index")]),
         ]
     )
     return workflow
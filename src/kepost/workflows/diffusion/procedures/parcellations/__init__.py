@@ -1,3 +1,14 @@
+from kepost.workflows.diffusion.procedures.parcellations.aggregate import (  # noqa: F401
+    aggregate_parcellations,
+)
+from kepost.workflows.diffusion.procedures.parcellations.dataset import (  # noqa: F401
+    read_parcellations,
+)
 from kepost.workflows.diffusion.procedures.parcellations.parcellations import (  # noqa: F401
     init_parcellations_wf,
+    init_session_parcellations_wf,
+)
+from kepost.workflows.diffusion.procedures.parcellations.samples import (  # noqa: F401
+    evaluate_samples,
+    read_samples,
 )
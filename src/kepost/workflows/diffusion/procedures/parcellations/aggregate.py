@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+
+from kepost.workflows.diffusion.procedures.parcellations.dataset import (
+    PARCELLATION_COLUMNS,
+    _import_pyarrow,
+    to_long_format,
+)
+
+#: Glob pattern (relative to the derivatives directory) of all parcellations
+PARCELLATION_FILES_GLOB = (
+    "sub-*/**/software-*/subtype-parcellations/atlas-*/*_meas-*_parc.{extension}"
+)
+#: Columns the cohort tables are indexed by
+COHORT_INDEX = [
+    "subject",
+    "session",
+    "acquisition",
+    "label",
+    "metric",
+    "measure",
+    "region",
+]
+#: Name of the file keeping track of the aggregated derivatives
+MANIFEST_NAME = "manifest.json"
+
+
+def _file_entities(path: Union[str, Path]) -> dict:
+    """
+    Parse the BIDS and kepost entities of a derivative file.
+    """
+    from importlib.resources import files
+
+    from bids.layout import Config, parse_file_entities
+
+    spec = json.loads(
+        Path(
+            str(files("kepost").joinpath("interfaces/bids/static/kepost.json"))
+        ).read_text()
+    )
+    return {
+        **parse_file_entities(str(path)),
+        **parse_file_entities(str(path), config=Config(**spec)),
+    }
+
+
+def _fingerprint(path: Path, detect: str) -> dict:
+    """
+    Describe a file's current state, by its modification time and size or by
+    a hash of its content.
+    """
+    if detect == "hash":
+        return {"sha1": hashlib.sha1(path.read_bytes()).hexdigest()}
+    stat = path.stat()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _read_long(path: Path) -> pd.DataFrame:
+    """
+    Read a session's parcellation file as a long table
+    (see :data:`PARCELLATION_COLUMNS`).
+    """
+    from kepost.atlases.utils import get_atlas_key, get_atlas_properties
+
+    if path.suffix == ".parquet":
+        _, _, pq = _import_pyarrow()
+        return pq.read_table(path, columns=PARCELLATION_COLUMNS).to_pandas()
+    entities = _file_entities(path)
+    atlas_key, atlas_name = get_atlas_key(path)
+    _, description, region_col, index_col = get_atlas_properties(atlas_key)
+    description_columns = pd.read_csv(description, index_col=index_col, nrows=0)
+    table = pd.read_pickle(path)
+    measures = [c for c in table.columns if c not in description_columns.columns]
+    return to_long_format(
+        table.set_index(region_col)[measures],
+        subject=entities.get("subject"),
+        session=entities.get("session"),
+        atlas=atlas_name,
+        software=entities.get("reconstruction_software"),
+        metric=entities.get("measure"),
+        label=entities.get("label", "WholeBrain"),
+    )
+
+
+def _cohort_file(out_dir: Path, atlas: str, software: str, output_format: str):
+    extension = "parquet" if output_format == "parquet" else "pkl"
+    return out_dir / f"atlas-{atlas}_software-{software}_parc.{extension}"
+
+
+def _read_cohort(path: Path, output_format: str) -> pd.DataFrame:
+    if not path.exists():
+        return pd.DataFrame(columns=PARCELLATION_COLUMNS + ["acquisition", "source"])
+    if output_format == "parquet":
+        _, _, pq = _import_pyarrow()
+        return pq.read_table(path).to_pandas().reset_index()
+    return pd.read_pickle(path).reset_index()
+
+
+def _write_cohort(table: pd.DataFrame, path: Path, output_format: str) -> str:
+    table = table.sort_values(COHORT_INDEX, kind="stable").set_index(COHORT_INDEX)
+    duplicated = table.index.duplicated(keep=False)
+    if duplicated.any():
+        raise ValueError(
+            f"Parcellation files {sorted(set(table.loc[duplicated, 'source']))} "
+            f"would share rows of {path.name}."
+        )
+    tmp_file = path.with_name(f".{path.name}.tmp")
+    if output_format == "parquet":
+        pa, _, pq = _import_pyarrow()
+        pq.write_table(pa.Table.from_pandas(table), tmp_file)
+    else:
+        table.to_pickle(tmp_file)
+    os.replace(tmp_file, path)
+    return str(path)
+
+
+def aggregate_parcellations(
+    derivatives_dir: Union[str, Path],
+    out_dir: Optional[Union[str, Path]] = None,
+    detect: str = "mtime",
+    output_format: str = "pickle",
+) -> dict:
+    """
+    Maintain one cohort-level parcellation table per atlas and software.
+
+    Only the sessions' parcellation files that are new or changed since the
+    last aggregation (see ``detect``) are read; their rows replace the
+    previous ones in the cohort tables, and the rows of deleted files are
+    dropped. Rows are indexed by :data:`COHORT_INDEX`, so sessions with
+    several acquisitions are kept apart; files that would still share rows
+    (e.g. runs of the same acquisition) are rejected. The state of the
+    aggregated files is kept in a manifest
+    (:data:`MANIFEST_NAME`) next to the cohort tables.
+
+    Parameters
+    ----------
+    derivatives_dir : Union[str, Path]
+        The kepost derivatives directory
+    out_dir : Union[str, Path], optional
+        Where to keep the cohort tables, by default
+        ``{derivatives_dir}/group/parcellations``
+    detect : str, optional
+        How to detect changed files: "mtime" (modification time and size) or
+        "hash" (content hash), by default "mtime"
+    output_format : str, optional
+        Either "pickle" or "parquet" (requires ``pyarrow``), by default
+        "pickle"
+
+    Returns
+    -------
+    dict
+        The path of every cohort table, keyed by (atlas, software)
+
+    Raises
+    ------
+    ValueError
+        If ``detect`` is unknown, or if several parcellation files share rows
+    """
+    if detect not in ["mtime", "hash"]:
+        raise ValueError(f"Unknown change detection {detect}.")
+    derivatives_dir = Path(derivatives_dir)
+    out_dir = Path(out_dir or derivatives_dir / "group" / "parcellations")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_file = out_dir / MANIFEST_NAME
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+
+    current = {}
+    for extension in ["pkl", "parquet"]:
+        for path in derivatives_dir.glob(
+            PARCELLATION_FILES_GLOB.format(extension=extension)
+        ):
+            if "_desc-" in path.name:
+                # summaries and per-volume signal
+                continue
+            current[path.relative_to(derivatives_dir).as_posix()] = path
+
+    updated, removed = {}, {}
+    for source, path in current.items():
+        fingerprint = _fingerprint(path, detect)
+        previous = manifest.get(source, {})
+        if any(previous.get(key) != value for key, value in fingerprint.items()):
+            updated[source] = fingerprint
+    for source in set(manifest) - set(current):
+        removed[source] = manifest[source]
+
+    new_rows = {}
+    for source in updated:
+        long = _read_long(current[source])
+        long["acquisition"] = _file_entities(current[source]).get("acquisition")
+        long["source"] = source
+        atlas, software = long["atlas"].iloc[0], long["software"].iloc[0]
+        new_rows.setdefault((atlas, software), []).append(long)
+        updated[source].update(atlas=atlas, software=software)
+    stale = set(updated) | set(removed)
+    groups = set(new_rows) | {
+        (entry["atlas"], entry["software"])
+        for source, entry in manifest.items()
+        if source in stale
+    }
+    for atlas, software in groups:
+        cohort_file = _cohort_file(out_dir, atlas, software, output_format)
+        table = _read_cohort(cohort_file, output_format)
+        tables = [table[~table["source"].isin(stale)]]
+        tables += new_rows.get((atlas, software), [])
+        table = pd.concat([t for t in tables if len(t)] or tables, ignore_index=True)
+        _write_cohort(table, cohort_file, output_format)
+
+    for source in removed:
+        del manifest[source]
+    manifest.update(updated)
+    tmp_file = manifest_file.with_name(f".{MANIFEST_NAME}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp_file, manifest_file)
+    return {
+        (entry["atlas"], entry["software"]): str(
+            _cohort_file(out_dir, entry["atlas"], entry["software"], output_format)
+        )
+        for entry in manifest.values()
+    }
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    SegmentedValues,
+)
+from kepost.workflows.diffusion.procedures.parcellations.summaries import (
+    merge_summaries,
+    summarize_regions,
+    summary_measures,
+)
+
+
+def build_atoms(atlases: list) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Partition the voxels of several atlases (on the same grid) into atoms:
+    the sets of voxels that share the same label in every atlas.
+
+    Parameters
+    ----------
+    atlases : list
+        The label images
+
+    Returns
+    -------
+    voxel_index : np.ndarray
+        Flat (C-order) voxel indices, sorted by atom
+    offsets : np.ndarray
+        Atom boundaries within ``voxel_index`` (see
+        :func:`kepost.atlases.utils.group_labels`)
+    atom_labels : np.ndarray
+        An atoms x atlases array of the label tuple of every atom
+    """
+    flat = [np.asanyarray(atlas).ravel() for atlas in atlases]
+    shapes = {np.shape(atlas)[:3] for atlas in atlases}
+    if len(shapes) > 1:
+        raise ValueError(f"The atlases are not on the same grid ({shapes}).")
+    labelled = np.flatnonzero(np.any([atlas != 0 for atlas in flat], axis=0))
+    # encode the label tuples one atlas at a time, compressing the codes
+    # after every step so they never overflow
+    codes = np.zeros(len(labelled), dtype=np.int64)
+    for atlas in flat:
+        labels, inverse = np.unique(atlas[labelled], return_inverse=True)
+        _, codes = np.unique(codes * len(labels) + inverse, return_inverse=True)
+    order = np.argsort(codes, kind="stable")
+    voxel_index = labelled[order]
+    counts = np.bincount(codes, minlength=codes.max() + 1 if len(codes) else 0)
+    offsets = np.zeros(len(counts) + 1, dtype=np.intp)
+    np.cumsum(counts, out=offsets[1:])
+    atom_labels = np.stack([atlas[voxel_index[offsets[:-1]]] for atlas in flat], axis=1)
+    return voxel_index, offsets, atom_labels
+
+
+def summarize_atoms(
+    metric_data: np.ndarray, voxel_index: np.ndarray, offsets: np.ndarray
+) -> pd.DataFrame:
+    """
+    Mergeable summaries (see
+    :func:`~kepost.workflows.diffusion.procedures.parcellations.summaries.summarize_regions`)
+    of every atom.
+    """
+    segments = SegmentedValues(np.asanyarray(metric_data).ravel()[voxel_index], offsets)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return summarize_regions(segments)
+
+
+def rollup_atoms(summaries: pd.DataFrame, atom_labels: np.ndarray) -> list:
+    """
+    Roll the summaries of the atoms up to the regions of every atlas.
+
+    Counts, means and standard deviations are exact; medians (and the other
+    percentiles) are merged from the atoms' quantile sketches.
+
+    Parameters
+    ----------
+    summaries : pd.DataFrame
+        The atoms x summaries table (see :func:`summarize_atoms`)
+    atom_labels : np.ndarray
+        The atoms x atlases label tuples (see :func:`build_atoms`)
+
+    Returns
+    -------
+    list
+        One regions x (summaries and measures) table per atlas
+    """
+    tables = []
+    for labels in np.asarray(atom_labels).T:
+        keep = labels != 0
+        merged = merge_summaries(summaries[keep], labels[keep])
+        merged.index.name = "region"
+        tables.append(pd.concat([merged, summary_measures(merged)], axis=1))
+    return tables
+
+
+def parcellate_atlases(metric_data: np.ndarray, atlases: dict) -> dict:
+    """
+    Parcellate a metric image with several atlases at once, summarizing its
+    voxels once per atom (see :func:`build_atoms`) rather than once per atlas.
+
+    Parameters
+    ----------
+    metric_data : np.ndarray
+        The metric image
+    atlases : dict
+        The label images (on the grid of ``metric_data``), keyed by name
+
+    Returns
+    -------
+    dict
+        A regions x (summaries and measures) table per atlas
+    """
+    shapes = {np.shape(atlas)[:3] for atlas in atlases.values()}
+    if shapes != {np.shape(metric_data)[:3]}:
+        raise ValueError(
+            f"The atlases ({shapes}) are not on the grid of the metric image "
+            f"({np.shape(metric_data)})."
+        )
+    voxel_index, offsets, atom_labels = build_atoms(list(atlases.values()))
+    summaries = summarize_atoms(metric_data, voxel_index, offsets)
+    return dict(zip(atlases, rollup_atoms(summaries, atom_labels)))
@@ -1,3 +1,6 @@
+from functools import cached_property
+from typing import Callable, Optional, Union
+
 import numpy as np
 from scipy.stats import median_abs_deviation
 
@@ -119,3 +122,451 @@ AVAILABLE_MEASURES = {
     "nanstd": np.nanstd,
     "n_voxels": n_voxels,
 }
+
+
+class SegmentedValues:
+    """
+    The values of several regions, stored as contiguous segments of one array.
+
+    The values of region ``i`` are ``values[offsets[i] : offsets[i + 1]]``
+    (see :func:`kepost.atlases.utils.group_labels`). All order statistics
+    (medians, MADs, percentiles) are taken from a single within-segment sort,
+    which is computed lazily and shared by all segmented measures.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The label-grouped values.
+    offsets : np.ndarray
+        The segment boundaries within ``values``.
+    weights : np.ndarray, optional
+        Per-voxel weights (e.g. partial volumes), aligned with ``values``.
+        By default, all voxels weigh the same and the weighted measures are
+        not defined (see :func:`compute_measures`).
+    presorted : bool, optional
+        Whether the values are already sorted within each segment (NaNs
+        last), by default False; if so, they are not sorted again.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        offsets: np.ndarray,
+        weights: Optional[np.ndarray] = None,
+        presorted: bool = False,
+    ):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        self.presorted = presorted
+        self.weighted = weights is not None
+        self.weights = (
+            np.ones_like(self.values)
+            if weights is None
+            else np.asarray(weights, dtype=np.float64)
+        )
+
+    @cached_property
+    def n_segments(self) -> int:
+        return len(self.offsets) - 1
+
+    @cached_property
+    def segment_ids(self) -> np.ndarray:
+        return np.repeat(np.arange(self.n_segments), np.diff(self.offsets))
+
+    @cached_property
+    def isnan(self) -> np.ndarray:
+        return np.isnan(self.values)
+
+    @cached_property
+    def counts(self) -> np.ndarray:
+        """Number of non-NaN values in each segment."""
+        return self.sum(~self.isnan, dtype=np.intp)
+
+    @cached_property
+    def sort_order(self) -> np.ndarray:
+        """The permutation sorting the values within each segment (NaNs last)."""
+        if self.presorted:
+            return np.arange(len(self.values))
+        return np.lexsort((self.values, self.segment_ids))
+
+    @cached_property
+    def sorted_values(self) -> np.ndarray:
+        """The values, sorted within each segment (NaNs last)."""
+        if self.presorted:
+            return self.values
+        return self.values[self.sort_order]
+
+    @cached_property
+    def valid_weights(self) -> np.ndarray:
+        """The weights, zeroed where either the value or the weight is NaN."""
+        return np.where(
+            self.isnan | np.isnan(self.weights), 0, np.maximum(self.weights, 0)
+        )
+
+    def sum(self, values: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """Sum per-voxel ``values`` (aligned with ``self.values``) per segment."""
+        return _segment_sum(values, self.offsets, dtype=dtype)
+
+    def masked_nanmean(self, keep: np.ndarray) -> np.ndarray:
+        """Mean of the (raster-ordered) values selected by ``keep`` per segment."""
+        kept_offsets = np.zeros_like(self.offsets)
+        np.cumsum(self.sum(keep, dtype=np.intp), out=kept_offsets[1:])
+        return _segment_sum(self.values[keep], kept_offsets) / np.diff(kept_offsets)
+
+    def take_sorted(self, positions: np.ndarray) -> np.ndarray:
+        """Sorted values at ``positions`` (clipped, for empty segments)."""
+        if not len(self.values):
+            return np.full(np.shape(positions), np.nan)
+        return self.sorted_values[np.clip(positions, 0, len(self.values) - 1)]
+
+    def sorted_median(self, starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """Median of ``counts`` sorted values starting at positions ``starts``."""
+        lower = self.take_sorted(starts + np.maximum(counts - 1, 0) // 2)
+        upper = self.take_sorted(starts + np.maximum(counts // 2, 0))
+        return np.where(counts > 0, (lower + upper) / 2, np.nan)
+
+    @cached_property
+    def median(self) -> np.ndarray:
+        return self.sorted_median(self.offsets[:-1], self.counts)
+
+    def percentile(self, q: float) -> np.ndarray:
+        """Per-segment ``np.nanpercentile`` (linear interpolation)."""
+        n = self.counts
+        virtual = (n - 1) * (q / 100)
+        previous = np.floor(virtual)
+        following = previous + 1
+        above = virtual >= n - 1
+        previous[above] = -1
+        following[above] = -1
+        gamma = virtual - previous
+        starts = self.offsets[:-1]
+        last = np.maximum(n - 1, 0)
+        a = self.take_sorted(
+            starts + np.where(previous < 0, last, previous).astype(int)
+        )
+        b = self.take_sorted(
+            starts + np.where(following < 0, last, following).astype(int)
+        )
+        diff_b_a = b - a
+        result = np.where(
+            gamma >= 0.5, b - diff_b_a * (1 - gamma), a + diff_b_a * gamma
+        )
+        return np.where(n > 0, result, np.nan)
+
+    def median_abs_deviation(self, center: np.ndarray) -> np.ndarray:
+        """
+        Per-segment median of ``|x - center|`` over the non-NaN values.
+
+        Within a sorted segment, the deviations decrease up to ``center`` and
+        increase after it, so their order statistics are found by merging
+        the two monotone halves (a vectorized binary search) instead of
+        sorting the deviations again.
+        """
+        n = self.counts
+        if not len(self.values):
+            return np.full(self.n_segments, np.nan)
+        starts = self.offsets[:-1]
+        center_ = center[self.segment_ids]
+        deviations = np.abs(self.sorted_values - center_)
+        n_left = self.sum(self.sorted_values < center_, dtype=np.intp)
+        n_right = n - n_left
+
+        def left(i):
+            # i-th smallest deviation among the values below the center
+            return deviations[np.clip(starts + n_left - 1 - i, 0, len(deviations) - 1)]
+
+        def right(j):
+            # j-th smallest deviation among the values above the center
+            return deviations[np.clip(starts + n_left + j, 0, len(deviations) - 1)]
+
+        def kth(k):
+            # number of values taken from the left half among the k+1 smallest
+            lo = np.maximum(0, k + 1 - n_right)
+            hi = np.minimum(k + 1, n_left)
+            while np.any(active := lo < hi):
+                i = (lo + hi) // 2
+                more_left = right(k - i) > left(i)
+                lo = np.where(active & more_left, i + 1, lo)
+                hi = np.where(active & ~more_left, i, hi)
+            j = k + 1 - lo
+            return np.maximum(
+                np.where(lo > 0, left(lo - 1), -np.inf),
+                np.where(j > 0, right(j - 1), -np.inf),
+            )
+
+        k = np.maximum(n - 1, 0)
+        mad = (kth(k // 2) + kth(np.minimum(n // 2, k))) / 2
+        return np.where(n > 0, mad, np.nan)
+
+
+def _segment_sum(values: np.ndarray, offsets: np.ndarray, dtype=np.float64):
+    """
+    Sum contiguous segments of ``values``, allowing for empty segments.
+
+    Segments are summed with a single ``np.add.reduceat``. For floats, this
+    sums sequentially rather than pairwise (as numpy's per-region reductions
+    do), so sums-based measures match the per-region functions to rounding
+    only. The MAD and quantile cutoffs compare values with order statistics
+    of the sorted segments, which are exact, so their voxel selections match
+    the per-region functions exactly.
+    """
+    values = np.asarray(values, dtype=dtype)
+    sums = np.zeros(len(offsets) - 1, dtype=dtype)
+    non_empty = np.flatnonzero(np.diff(offsets) > 0)
+    if len(non_empty):
+        sums[non_empty] = np.add.reduceat(values, offsets[:-1][non_empty])
+    return sums
+
+
+def segmented_zfmean(segments: SegmentedValues, threshold=3) -> np.ndarray:
+    """
+    Z Filtered Mean of every segment (see :func:`zfmean`).
+    """
+    m = segmented_nanmean(segments)[segments.segment_ids]
+    s = segmented_nanstd(segments)[segments.segment_ids]
+    z_scores = np.abs((segments.values - m) / s)
+    return segments.masked_nanmean(z_scores < threshold)
+
+
+def segmented_madmedian(segments: SegmentedValues, threshold=3) -> np.ndarray:
+    """
+    Median of MAD-filtered data of every segment (see :func:`madmedian`).
+    """
+    m = segments.median
+    mad = segments.median_abs_deviation(m)
+    center = m[segments.segment_ids]
+    # the kept values are a contiguous run of each sorted segment
+    keep = (
+        np.abs(segments.sorted_values - center)
+        < (threshold * mad)[segments.segment_ids]
+    )
+    n_kept = segments.sum(keep, dtype=np.intp)
+    n_before = segments.sum(~keep & (segments.sorted_values < center), dtype=np.intp)
+    return segments.sorted_median(segments.offsets[:-1] + n_before, n_kept)
+
+
+def segmented_qfmean(
+    segments: SegmentedValues, lower_quantile=10, upper_quantile=90
+) -> np.ndarray:
+    """
+    Quantile Filtered Mean of every segment (see :func:`qfmean`).
+    """
+    lower = segments.percentile(lower_quantile)[segments.segment_ids]
+    upper = segments.percentile(upper_quantile)[segments.segment_ids]
+    return segments.masked_nanmean(
+        (segments.values > lower) & (segments.values < upper)
+    )
+
+
+def segmented_iqrmean(segments: SegmentedValues) -> np.ndarray:
+    """
+    IQR Filtered Mean of every segment (see :func:`iqrmean`).
+    """
+    q75 = segments.percentile(75)[segments.segment_ids]
+    q25 = segments.percentile(25)[segments.segment_ids]
+    return segments.masked_nanmean((segments.values >= q25) & (segments.values <= q75))
+
+
+def segmented_nanmean(segments: SegmentedValues) -> np.ndarray:
+    """
+    Mean of every segment, ignoring NaNs.
+    """
+    return segments.sum(np.where(segments.isnan, 0, segments.values)) / segments.counts
+
+
+def segmented_nanmedian(segments: SegmentedValues) -> np.ndarray:
+    """
+    Median of every segment, ignoring NaNs.
+    """
+    return segments.median
+
+
+def segmented_nanstd(segments: SegmentedValues) -> np.ndarray:
+    """
+    Standard deviation of every segment, ignoring NaNs.
+    """
+    avg = segmented_nanmean(segments)[segments.segment_ids]
+    deviations = np.where(segments.isnan, 0, segments.values - avg)
+    var = segments.sum(deviations * deviations) / segments.counts
+    return np.sqrt(np.where(segments.counts > 0, var, np.nan))
+
+
+def segmented_weighted_mean(segments: SegmentedValues) -> np.ndarray:
+    """
+    Weighted mean of every segment, ignoring NaNs.
+    """
+    weights = segments.valid_weights
+    weighted = np.where(weights > 0, segments.values * weights, 0)
+    return segments.sum(weighted) / segments.sum(weights)
+
+
+def segmented_weighted_std(segments: SegmentedValues) -> np.ndarray:
+    """
+    Weighted standard deviation of every segment, ignoring NaNs.
+    """
+    weights = segments.valid_weights
+    avg = segmented_weighted_mean(segments)[segments.segment_ids]
+    deviations = np.where(weights > 0, segments.values - avg, 0)
+    return np.sqrt(segments.sum(weights * deviations**2) / segments.sum(weights))
+
+
+def segmented_weighted_median(segments: SegmentedValues) -> np.ndarray:
+    """
+    Weighted median of every segment, ignoring NaNs: the smallest value
+    for which the cumulative weight reaches half the segment's weight.
+    """
+    sorted_weights = segments.valid_weights[segments.sort_order]
+    cumulative = np.concatenate([[0], np.cumsum(sorted_weights)])
+    before = cumulative[segments.offsets[:-1]]
+    totals = cumulative[segments.offsets[1:]] - before
+    position = np.searchsorted(cumulative[1:], before + totals / 2, side="left")
+    position = np.minimum(position, segments.offsets[1:] - 1)
+    return np.where(totals > 0, segments.take_sorted(position), np.nan)
+
+
+def segmented_n_voxels(segments: SegmentedValues) -> np.ndarray:
+    """
+    Number of (non-NaN) voxels of every segment.
+    """
+    return segments.counts
+
+
+SEGMENTED_MEASURES = {
+    "zfmean": segmented_zfmean,
+    "madmedian": segmented_madmedian,
+    "qfmean": segmented_qfmean,
+    "iqrmean": segmented_iqrmean,
+    "nanmean": segmented_nanmean,
+    "nanmedian": segmented_nanmedian,
+    "nanstd": segmented_nanstd,
+    "n_voxels": segmented_n_voxels,
+}
+
+#: All registered measures: a segmented (all regions at once) and/or a scalar
+#: (one region at a time) implementation for every measure name
+MEASURES_REGISTRY: dict = {}
+
+
+def register_measure(
+    name: str,
+    segmented: Optional[Callable] = None,
+    scalar: Optional[Callable] = None,
+    overwrite: bool = False,
+    weighted: bool = False,
+):
+    """
+    Register a parcellation measure.
+
+    Parameters
+    ----------
+    name : str
+        The name of the measure (its column in the parcellation tables).
+    segmented : Callable, optional
+        A function of a :class:`SegmentedValues`, returning one value per
+        segment (region). Used whenever available.
+    scalar : Callable, optional
+        A function of a region's values, returning a single value. Used as a
+        fallback when no segmented implementation is given.
+    overwrite : bool, optional
+        Whether to replace an already registered measure, by default False.
+    weighted : bool, optional
+        Whether the measure depends on per-voxel weights, by default False.
+        Weighted measures are NaN for unweighted values.
+    """
+    if segmented is None and scalar is None:
+        raise ValueError(
+            f"Measure '{name}' needs a segmented or a scalar implementation."
+        )
+    if name in MEASURES_REGISTRY and not overwrite:
+        raise ValueError(f"Measure '{name}' is already registered.")
+    MEASURES_REGISTRY[name] = {
+        "segmented": segmented,
+        "scalar": scalar,
+        "weighted": weighted,
+    }
+
+
+def get_measures(
+    measures: Optional[Union[str, list]] = None, weighted: bool = True
+) -> list:
+    """
+    Resolve (and validate) the names of the measures to compute.
+
+    Parameters
+    ----------
+    measures : Union[str, list], optional
+        Measure name(s), or "all" (the default) for all registered measures.
+    weighted : bool, optional
+        Whether the values are weighted, by default True; if not, "all"
+        leaves the weighted measures out.
+
+    Returns
+    -------
+    list
+        The measure names.
+    """
+    if (measures is None) or (measures == "all") or (measures == ["all"]):
+        return [
+            name
+            for name, measure in MEASURES_REGISTRY.items()
+            if weighted or not measure["weighted"]
+        ]
+    measures = [measures] if isinstance(measures, str) else list(measures)
+    unknown = [measure for measure in measures if measure not in MEASURES_REGISTRY]
+    if unknown:
+        raise ValueError(
+            f"Measure(s) {unknown} not available. "
+            f"Please choose from: {list(MEASURES_REGISTRY)}."
+        )
+    return measures
+
+
+def compute_measures(
+    segments: SegmentedValues, measures: Optional[Union[str, list]] = None
+) -> dict:
+    """
+    Compute measures for all segments (regions), using each measure's
+    segmented implementation when it has one. Weighted measures of
+    unweighted values are NaN (and left out of "all").
+
+    Parameters
+    ----------
+    segments : SegmentedValues
+        The label-grouped values of a metric image.
+    measures : Union[str, list], optional
+        The measures to compute (see :func:`get_measures`), by default all.
+
+    Returns
+    -------
+    dict
+        One array of per-segment values per measure.
+    """
+    results = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for name in get_measures(measures, weighted=segments.weighted):
+            measure = MEASURES_REGISTRY[name]
+            if measure["weighted"] and not segments.weighted:
+                values = np.full(segments.n_segments, np.nan)
+            elif measure["segmented"] is not None:
+                values = measure["segmented"](segments)
+            else:
+                values = [
+                    measure["scalar"](segments.values[start:stop])
+                    for start, stop in zip(segments.offsets[:-1], segments.offsets[1:])
+                ]
+            results[name] = np.asarray(values, dtype=float)
+    return results
+
+
+for _name, _scalar in AVAILABLE_MEASURES.items():
+    register_measure(_name, segmented=SEGMENTED_MEASURES[_name], scalar=_scalar)
+#: Partial-volume weighted measures (with uniform weights, they reduce to
+#: the unweighted mean, standard deviation and lower median), only defined
+#: for weighted values
+WEIGHTED_MEASURES = {
+    "weighted_mean": segmented_weighted_mean,
+    "weighted_median": segmented_weighted_median,
+    "weighted_std": segmented_weighted_std,
+}
+for _name, _segmented in WEIGHTED_MEASURES.items():
+    register_measure(_name, segmented=_segmented, weighted=True)
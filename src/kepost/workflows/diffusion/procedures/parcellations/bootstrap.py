@@ -0,0 +1,94 @@
+import warnings
+from typing import Optional, Union
+
+import numpy as np
+
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    SegmentedValues,
+    compute_measures,
+)
+
+#: Upper bound on the number of resampled values evaluated at once
+MAX_BATCH_VALUES = 2**24
+
+
+def bootstrap_measures(
+    segments: SegmentedValues,
+    measures: Union[str, list],
+    n_resamples: int = 1000,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+    max_batch_values: int = MAX_BATCH_VALUES,
+) -> dict:
+    """
+    Percentile bootstrap confidence intervals of measures, for all segments
+    (regions) at once.
+
+    The resamples of all regions are drawn together, and a batch of
+    resamples is evaluated as a single :class:`SegmentedValues` (one segment
+    per resample and region), so each measure runs on arrays rather than in a
+    per-region loop. The draws are positions within each region's sorted
+    values, and counting how often each position is drawn yields every
+    resample already sorted, so the order statistics of a batch need no
+    further sorting.
+
+    Parameters
+    ----------
+    segments : SegmentedValues
+        The label-grouped values of a metric image
+    measures : Union[str, list]
+        The (registered) measures to bootstrap
+    n_resamples : int, optional
+        Number of bootstrap resamples, by default 1000
+    confidence : float, optional
+        Confidence level of the intervals, by default 0.95
+    seed : int, optional
+        Seed of the random number generator, by default None
+    max_batch_values : int, optional
+        Maximal number of resampled values held in memory at once
+
+    Returns
+    -------
+    dict
+        A (lower, upper) pair of per-segment arrays per measure
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.diff(segments.offsets)
+    n_values = int(sizes.sum())
+    starts = np.repeat(segments.offsets[:-1], sizes)
+    highs = np.repeat(sizes, sizes)
+    sorted_weights = (
+        segments.weights[segments.sort_order] if segments.weighted else None
+    )
+    batch_size = max(1, min(n_resamples, max_batch_values // max(n_values, 1)))
+    resampled: dict = {}
+    for first in range(0, n_resamples, batch_size):
+        n_batch = min(batch_size, n_resamples - first)
+        # the values of resample b of region i form segment b * n_regions + i
+        drawn = np.tile(starts, n_batch) + rng.integers(0, np.tile(highs, n_batch))
+        drawn += np.repeat(np.arange(n_batch) * n_values, n_values)
+        counts = np.bincount(drawn, minlength=n_batch * n_values)
+        positions = np.repeat(np.arange(n_batch * n_values), counts) % n_values
+        offsets = np.zeros(n_batch * segments.n_segments + 1, dtype=np.intp)
+        np.cumsum(np.tile(sizes, n_batch), out=offsets[1:])
+        batch = SegmentedValues(
+            segments.sorted_values[positions],
+            offsets,
+            sorted_weights[positions] if segments.weighted else None,
+            presorted=True,
+        )
+        for name, values in compute_measures(batch, measures).items():
+            resampled.setdefault(name, []).append(
+                values.reshape(n_batch, segments.n_segments)
+            )
+    tail = (1 - confidence) / 2 * 100
+    intervals = {}
+    with warnings.catch_warnings():
+        # regions without (non-NaN) voxels have no interval
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for name, values in resampled.items():
+            lower, upper = np.nanpercentile(
+                np.concatenate(values), [tail, 100 - tail], axis=0
+            )
+            intervals[name] = (lower, upper)
+    return intervals
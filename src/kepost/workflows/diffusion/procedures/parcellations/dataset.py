@@ -0,0 +1,184 @@
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+#: Columns of the long ("tidy") parcellation tables written in parquet format
+PARCELLATION_COLUMNS = [
+    "subject",
+    "session",
+    "atlas",
+    "label",
+    "software",
+    "metric",
+    "measure",
+    "region",
+    "value",
+]
+#: Glob pattern (relative to the derivatives directory) of parquet parcellations
+PARCELLATION_GLOB = (
+    "sub-{subject}/**/software-{software}/subtype-parcellations/"
+    "atlas-{atlas}/*_meas-{metric}_parc.parquet"
+)
+
+
+def _import_pyarrow():
+    """
+    Import the (optional) pyarrow dependency with an informative error.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "Parquet parcellations require pyarrow. "
+            "Install it with `pip install kepost[parquet]`."
+        ) from e
+    return pa, ds, pq
+
+
+def to_long_format(
+    table: pd.DataFrame,
+    subject: str,
+    session: str,
+    atlas: str,
+    software: str,
+    metric: str,
+    label: str = "WholeBrain",
+) -> pd.DataFrame:
+    """
+    Convert a regions x measures table to the long parcellation schema.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        A table indexed by region, with one column per measure
+    subject : str
+        The subject label
+    session : str
+        The session label
+    atlas : str
+        The atlas name
+    software : str
+        The reconstruction software
+    metric : str
+        The parcellated metric
+    label : str, optional
+        The voxels the atlas was restricted to ("WholeBrain" or "GM"), by
+        default "WholeBrain"
+
+    Returns
+    -------
+    pd.DataFrame
+        A table with the columns in :data:`PARCELLATION_COLUMNS`
+    """
+    long = (
+        table.rename_axis(index="region", columns="measure")
+        .stack(future_stack=True)
+        .rename("value")
+        .reset_index()
+        .sort_values(["measure", "region"], kind="stable")
+    )
+    long["region"] = long["region"].astype("int64")
+    long["value"] = long["value"].astype("float64")
+    for column, value in zip(
+        ["subject", "session", "atlas", "label", "software", "metric"],
+        [subject, session, atlas, label, software, metric],
+    ):
+        long[column] = value
+    return long[PARCELLATION_COLUMNS].reset_index(drop=True)
+
+
+def write_parcellations(long: pd.DataFrame, out_file: str) -> str:
+    """
+    Write a long parcellation table as parquet.
+
+    Parameters
+    ----------
+    long : pd.DataFrame
+        A table with the columns in :data:`PARCELLATION_COLUMNS`
+    out_file : str
+        The output path
+
+    Returns
+    -------
+    str
+        The output path
+    """
+    pa, _, pq = _import_pyarrow()
+    pq.write_table(
+        pa.Table.from_pandas(long[PARCELLATION_COLUMNS], preserve_index=False),
+        out_file,
+    )
+    return out_file
+
+
+def read_parcellations(
+    derivatives_dir: str,
+    subject: Optional[str] = None,
+    software: Optional[str] = None,
+    atlas: Optional[str] = None,
+    metric: Optional[str] = None,
+    measure: Optional[str] = None,
+    label: Optional[str] = None,
+    columns: Optional[list] = None,
+    summaries: bool = False,
+) -> pd.DataFrame:
+    """
+    Read parquet parcellations of a whole cohort as a single table.
+
+    The entities given are used both to narrow down the files that are
+    opened (through the derivatives layout) and as a filter pushed down
+    to the parquet reader.
+
+    Parameters
+    ----------
+    derivatives_dir : str
+        The kepost derivatives directory
+    subject, software, atlas, metric, measure, label : str, optional
+        Values to select, by default all
+    columns : list, optional
+        Columns to read, by default :data:`PARCELLATION_COLUMNS`
+    summaries : bool, optional
+        Whether to read the region summaries (``desc-summary``) instead of
+        the parcellations, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        The selected rows of the cohort's parcellations
+    """
+    _, ds, _ = _import_pyarrow()
+    pattern = PARCELLATION_GLOB.format(
+        subject=subject or "*",
+        software=software or "*",
+        atlas=atlas or "*",
+        metric=metric or "*",
+    )
+    # the other descriptions (samples, per-volume signal) have other schemas
+    files = sorted(
+        str(f)
+        for f in Path(derivatives_dir).glob(pattern)
+        if ("_desc-summary_" in f.name if summaries else "_desc-" not in f.name)
+    )
+    if not files:
+        return pd.DataFrame(columns=columns or PARCELLATION_COLUMNS)
+    selection = {
+        "subject": subject,
+        "software": software,
+        "atlas": atlas,
+        "metric": metric,
+        "measure": measure,
+        "label": label,
+    }
+    expression = None
+    for column, value in selection.items():
+        if value is None:
+            continue
+        condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    dataset = ds.dataset(files, format="parquet")
+    return dataset.to_table(
+        columns=columns or PARCELLATION_COLUMNS, filter=expression
+    ).to_pandas()
@@ -1,81 +1,615 @@
+from typing import Optional
+
 from nipype.interfaces import utility as niu
 from nipype.pipeline import engine as pe
 from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
+from kepost import config
 from kepost.interfaces.bids import DerivativesDataSink
 from kepost.workflows.diffusion.procedures.utils.derivatives import (
     DIFFUSION_WF_OUTPUT_ENTITIES,
 )
 
+#: The options of a parcellation (see :func:`parcellate_arrays`) and their
+#: defaults
+PARCELLATION_OPTIONS = {
+    "output_format": "pickle",
+    "measures": None,
+    "gm_threshold": None,
+    "bootstrap": None,
+    "n_resamples": 1000,
+    "confidence": 0.95,
+    "seed": None,
+    "sample_size": 0,
+}
+
+
+def parcellation_options(options: Optional[dict] = None) -> dict:
+    """
+    Complete parcellation options with their defaults (see
+    :data:`PARCELLATION_OPTIONS`).
+
+    Parameters
+    ----------
+    options : dict, optional
+        Some of the parcellation options
+
+    Returns
+    -------
+    dict
+        All the parcellation options
+
+    Raises
+    ------
+    ValueError
+        If an option is unknown
+    """
+    unknown = set(options or {}).difference(PARCELLATION_OPTIONS)
+    if unknown:
+        raise ValueError(
+            f"Unknown parcellation option(s): {sorted(unknown)}. Available "
+            f"options are: {list(PARCELLATION_OPTIONS)}."
+        )
+    return {**PARCELLATION_OPTIONS, **(options or {})}
+
 
-def parcellate_all_measures(in_file: str, atlas_nifti: str):
+def load_metric_array(in_file: str):
     """
-    Parcellate the brain using a specific atlas
+    Load a metric image as a 3D array; 4D images (e.g. FODs) are loaded
+    through their first volume (for FODs, the l=0 term, i.e. the AFD).
 
     Parameters
     ----------
     in_file : str
-        The input file
+        The metric image
+
+    Returns
+    -------
+    np.ndarray
+        The 3D metric array
+    """
+    import nibabel as nib
+    import numpy as np
+
+    dataobj = nib.load(in_file).dataobj
+    return np.asanyarray(dataobj[..., 0] if len(dataobj.shape) > 3 else dataobj)
+
+
+def parcellate_arrays(
+    metric_arrays,
+    softwares: list,
+    metrics: list,
+    atlas_nifti: str,
+    atlas_index: Optional[str] = None,
+    source_file: Optional[str] = None,
+    gm_probseg: Optional[str] = None,
+    options: Optional[dict] = None,
+    out_dir: Optional[str] = None,
+):
+    """
+    Parcellate several in-memory metric images with a single atlas, loading
+    the atlas only once.
+
+    Parameters
+    ----------
+    metric_arrays : iterable
+        The 3D metric arrays (on the grid of ``atlas_nifti``); an iterator is
+        consumed one array at a time
+    softwares : list
+        The reconstruction software of each metric image
+    metrics : list
+        The name of each metric image
+    atlas_nifti : str
+        The (native-space) parcellation image
+    atlas_index : str, optional
+        A label index of ``atlas_nifti`` (see
+        :func:`kepost.atlases.utils.save_label_index`), used instead of
+        grouping the atlas voxels again
+    source_file : str, optional
+        The image the subject and session labels are taken from
+        (required for the parquet format)
+    gm_probseg : str, optional
+        A gray matter probabilistic segmentation (on the grid of the metric
+        images), used as voxel weights by the weighted measures
+    options : dict, optional
+        The parcellation options, by default those of
+        :data:`PARCELLATION_OPTIONS`:
+
+        - ``output_format``: either "pickle" (wide tables) or "parquet" (long
+          tables, see :data:`PARCELLATION_COLUMNS`)
+        - ``measures``: the (registered) measures to compute, by default all
+        - ``gm_threshold``: if given (along with ``gm_probseg``), every metric
+          image is also parcellated within the voxels whose GM probability is
+          at least ``gm_threshold`` (the "GM" label, next to the
+          "WholeBrain" one), reusing the same grouping of the atlas voxels
+        - ``bootstrap``: measures to add bootstrap confidence intervals to
+          (as ``{measure}_ci_lower`` and ``{measure}_ci_upper`` columns), by
+          default none
+        - ``n_resamples`` and ``confidence``: the number of bootstrap
+          resamples and the confidence level of their intervals
+        - ``seed``: the seed of the bootstrap's (and sampling's) random
+          number generator
+        - ``sample_size``: if positive, keep a seeded sample of at most
+          ``sample_size`` voxel values per region (see
+          :func:`~kepost.workflows.diffusion.procedures.parcellations.samples.sample_regions`)
+    out_dir : str, optional
+        Where to write the tables, by default the working directory
+
+    Returns
+    -------
+    out_file : str
+        A regions x (label, software, metric, measure) table
+    out_files : list
+        One regions x measures table per metric image (and label)
+    summary_files : list
+        One regions x summaries table per metric image (and label, see
+        :func:`~kepost.workflows.diffusion.procedures.parcellations.summaries.rollup`)
     atlas_name : str
         The atlas name
+    sample_files : list
+        One table of sampled voxel values per metric image (and label, see
+        :data:`~kepost.workflows.diffusion.procedures.parcellations.samples.SAMPLE_COLUMNS`),
+        if ``sample_size`` is positive
     """
     import os
-    from importlib.resources import files
-    from json import loads
-    from pathlib import Path
 
+    import nibabel as nib
+    import numpy as np
     import pandas as pd
-    from bids.layout import Config, parse_file_entities
 
-    from kepost.atlases.utils import get_atlas_properties, parcellate
+    from kepost.atlases.utils import load_atlas_regions
     from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
-        AVAILABLE_MEASURES,
+        SegmentedValues,
+        compute_measures,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.bootstrap import (
+        bootstrap_measures,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.dataset import (
+        _import_pyarrow,
+        to_long_format,
+        write_parcellations,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+        parcellation_options,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.samples import (
+        sample_regions,
+        samples_table,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.summaries import (
+        summarize_regions,
     )
 
-    def resource_filename(package, resource):
-        return str(files(package).joinpath(resource))
+    options = parcellation_options(options)
+    out_dir = out_dir or os.getcwd()
+    atlas_name, df, regions, (labels, voxel_index, offsets), atlas_shape = (
+        load_atlas_regions(atlas_nifti, atlas_index)
+    )
+    segments = np.searchsorted(labels, regions)
+
+    # the voxels (and weights) of every region, per label
+    groupings = {"WholeBrain": (voxel_index, offsets, None)}
+    if gm_probseg:
+        gm_data = np.asanyarray(nib.load(gm_probseg).dataobj)
+        if gm_data.shape[:3] != atlas_shape[:3]:
+            raise ValueError(
+                f"{gm_probseg} (shape {gm_data.shape}) is not on the grid of "
+                f"{atlas_nifti} (shape {atlas_shape})."
+            )
+        weights = gm_data.ravel()[voxel_index]
+        groupings["WholeBrain"] = (voxel_index, offsets, weights)
+        if options["gm_threshold"] is not None:
+            keep = weights >= options["gm_threshold"]
+            gm_offsets = np.zeros_like(offsets)
+            np.cumsum(
+                SegmentedValues(weights, offsets).sum(keep, dtype=np.intp),
+                out=gm_offsets[1:],
+            )
+            groupings["GM"] = (voxel_index[keep], gm_offsets, weights[keep])
+
+    tables, summaries, samples = {}, {}, {}
+    sampler = np.random.default_rng(options["seed"])
+    for metric_data, software, metric in zip(metric_arrays, softwares, metrics):
+        if np.shape(metric_data)[:3] != atlas_shape[:3]:
+            raise ValueError(
+                f"The {software} {metric} map (shape {np.shape(metric_data)}) is "
+                f"not on the grid of {atlas_nifti} (shape {atlas_shape})."
+            )
+        metric_data = np.asanyarray(metric_data).ravel()
+        for label, (label_index, label_offsets, weights) in groupings.items():
+            values = SegmentedValues(metric_data[label_index], label_offsets, weights)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                summary = summarize_regions(values).iloc[segments]
+            table = {
+                measure_name: measure_values[segments]
+                for measure_name, measure_values in compute_measures(
+                    values, options["measures"]
+                ).items()
+            }
+            if options["bootstrap"]:
+                intervals = bootstrap_measures(
+                    values,
+                    options["bootstrap"],
+                    options["n_resamples"],
+                    options["confidence"],
+                    options["seed"],
+                )
+                for measure_name, (lower, upper) in intervals.items():
+                    table[f"{measure_name}_ci_lower"] = lower[segments]
+                    table[f"{measure_name}_ci_upper"] = upper[segments]
+            tables[(label, software, metric)] = pd.DataFrame(table, index=regions)
+            summaries[(label, software, metric)] = summary.set_axis(regions)
+            if options["sample_size"] > 0:
+                samples[(label, software, metric)] = samples_table(
+                    sample_regions(values, options["sample_size"], sampler), labels
+                )
+    if options["output_format"] == "parquet":
+        from bids.layout import parse_file_entities
+
+        entities = parse_file_entities(source_file)
+
+        def _write(table, label, software, metric, out_file):
+            long = to_long_format(
+                table,
+                subject=entities.get("subject"),
+                session=entities.get("session"),
+                atlas=atlas_name,
+                software=software,
+                metric=metric,
+                label=label,
+            )
+            return write_parcellations(long, out_file), long
 
-    _pybids_spec = loads(
-        Path(
-            resource_filename("kepost", "interfaces/bids/static/kepost.json")
-        ).read_text()
+        out_files, long_tables = [], []
+        for (label, software, metric), table in tables.items():
+            metric_file, long = _write(
+                table,
+                label,
+                software,
+                metric,
+                f"{out_dir}/{label}_{software}_{metric}_parcellations.parquet",
+            )
+            out_files.append(metric_file)
+            long_tables.append(long)
+        out_file = write_parcellations(
+            pd.concat(long_tables, ignore_index=True),
+            f"{out_dir}/parcellations.parquet",
+        )
+        summary_files = [
+            _write(
+                summary,
+                label,
+                software,
+                metric,
+                f"{out_dir}/{label}_{software}_{metric}_summaries.parquet",
+            )[0]
+            for (label, software, metric), summary in summaries.items()
+        ]
+        pa, _, pq = _import_pyarrow()
+        sample_files = []
+        for (label, software, metric), sample in samples.items():
+            sample_file = f"{out_dir}/{label}_{software}_{metric}_samples.parquet"
+            pq.write_table(
+                pa.Table.from_pandas(sample, preserve_index=False), sample_file
+            )
+            sample_files.append(sample_file)
+        return out_file, out_files, summary_files, atlas_name, sample_files
+
+    parcellations = pd.concat(
+        tables, axis=1, names=["label", "software", "metric", "measure"]
     )
-    config = Config(**_pybids_spec)
+    out_file = f"{out_dir}/parcellations.pkl"
+    parcellations.to_pickle(out_file)
 
-    entities = parse_file_entities(atlas_nifti, config=config)
-    atlas_name = entities["atlas"]
-    if "schaefer2018" in atlas_name:
-        division = entities["division"]
-        den = entities["den"]
-        # atlas_name_part = [i for i in Path(atlas_nifti).parts if "_atlas_name_" in i]
-        # atlas_name = atlas_name_part[0].replace("_atlas_name_", "")
-        atlas_key = f"{atlas_name}_{den}_{division.replace('networks','')}"
-        atlas_name = f"{atlas_name}_div-{division}_den-{den}"
-    else:
-        atlas_key = atlas_name
-    _, description, region_col, index_col = get_atlas_properties(atlas_key)
-    df = pd.read_csv(description, index_col=index_col).copy()
-    for measure_name, measure_func in AVAILABLE_MEASURES.items():
-        df[measure_name] = parcellate(
-            atlas_description=description,
-            index_col=index_col,
+    out_files, summary_files = [], []
+    for (label, software, metric), table in tables.items():
+        metric_df = df.copy()
+        for measure_name in table.columns:
+            metric_df[measure_name] = table[measure_name].to_numpy()
+        metric_file = f"{out_dir}/{label}_{software}_{metric}_parcellations.pkl"
+        metric_df.to_pickle(metric_file)
+        out_files.append(metric_file)
+        summary_file = f"{out_dir}/{label}_{software}_{metric}_summaries.pkl"
+        summaries[(label, software, metric)].to_pickle(summary_file)
+        summary_files.append(summary_file)
+    sample_files = []
+    for (label, software, metric), sample in samples.items():
+        sample_file = f"{out_dir}/{label}_{software}_{metric}_samples.pkl"
+        sample.to_pickle(sample_file)
+        sample_files.append(sample_file)
+    return out_file, out_files, summary_files, atlas_name, sample_files
+
+
+def parcellate_metrics(
+    in_files: list,
+    softwares: list,
+    metrics: list,
+    atlas_nifti: str,
+    atlas_index: Optional[str] = None,
+    source_file: Optional[str] = None,
+    gm_probseg: Optional[str] = None,
+    options: Optional[dict] = None,
+):
+    """
+    Parcellate several metric images with a single atlas, loading each
+    image (and the atlas) only once.
+
+    Parameters
+    ----------
+    in_files : list
+        The metric images (see :func:`load_metric_array`)
+
+    See :func:`parcellate_arrays` for the other parameters and the outputs.
+    """
+    from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+        load_metric_array,
+        parcellate_arrays,
+    )
+
+    return parcellate_arrays(
+        (load_metric_array(in_file) for in_file in in_files),
+        softwares=softwares,
+        metrics=metrics,
+        atlas_nifti=atlas_nifti,
+        atlas_index=atlas_index,
+        source_file=source_file,
+        gm_probseg=gm_probseg,
+        options=options,
+    )
+
+
+def parcellate_arrays_atlases(
+    metric_arrays,
+    softwares: list,
+    metrics: list,
+    atlas_niftis: list,
+    atlas_indices: Optional[list] = None,
+    source_file: Optional[str] = None,
+    gm_probseg: Optional[str] = None,
+    options: Optional[dict] = None,
+    n_threads: int = 1,
+):
+    """
+    Parcellate several in-memory metric images with several atlases, filling
+    the atlases' tables in a pool of threads (the numpy reductions and sorts
+    release the GIL).
+
+    Parameters
+    ----------
+    metric_arrays : iterable
+        The 3D metric arrays (on the grid of the atlases)
+    atlas_niftis : list
+        The (native-space) parcellation images
+    atlas_indices : list, optional
+        A label index of every atlas (see
+        :func:`kepost.atlases.utils.save_label_index`)
+    n_threads : int, optional
+        Number of atlases parcellated at once, by default 1
+
+    See :func:`parcellate_arrays` for the other parameters.
+
+    Returns
+    -------
+    out_file : list
+        One regions x (label, software, metric, measure) table per atlas
+    out_files : list
+        The regions x measures tables of every atlas, metric image and label
+    summary_files : list
+        The regions x summaries tables, in the order of ``out_files``
+    atlas_name : list
+        The atlas of every table in ``out_files``
+    sample_files : list
+        The tables of sampled voxel values, in the order of ``out_files`` (if
+        the ``sample_size`` option is positive)
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    from kepost.atlases.utils import get_atlas_key
+    from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+        parcellate_arrays,
+    )
+
+    metric_arrays = list(metric_arrays)
+    atlas_indices = atlas_indices or [None] * len(atlas_niftis)
+
+    def _parcellate(atlas_nifti, atlas_index):
+        out_dir = f"{os.getcwd()}/{get_atlas_key(atlas_nifti)[1]}"
+        os.makedirs(out_dir, exist_ok=True)
+        return parcellate_arrays(
+            metric_arrays,
+            softwares=softwares,
+            metrics=metrics,
             atlas_nifti=atlas_nifti,
-            region_col=region_col,
-            metric_image=in_file,
-            measure=measure_func,  # type: ignore[arg-type]
-        )["value"]
-    out_file = f"{os.getcwd()}/parcellations.pkl"
-    df.to_pickle(out_file)
+            atlas_index=atlas_index,
+            source_file=source_file,
+            gm_probseg=gm_probseg,
+            options=options,
+            out_dir=out_dir,
+        )
+
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        results = list(pool.map(_parcellate, atlas_niftis, atlas_indices))
+    return (
+        [out_file for out_file, *_ in results],
+        [f for _, out_files, *_ in results for f in out_files],
+        [f for _, _, summary_files, *_ in results for f in summary_files],
+        [atlas_name for _, out_files, _, atlas_name, _ in results for _ in out_files],
+        [f for *_, sample_files in results for f in sample_files],
+    )
+
+
+def parcellate_metrics_atlases(
+    in_files: list,
+    softwares: list,
+    metrics: list,
+    atlas_niftis: list,
+    atlas_indices: Optional[list] = None,
+    source_file: Optional[str] = None,
+    gm_probseg: Optional[str] = None,
+    options: Optional[dict] = None,
+    n_threads: int = 1,
+):
+    """
+    Parcellate several metric images with all of a session's atlases, loading
+    each image only once.
+
+    Parameters
+    ----------
+    in_files : list
+        The metric images (see :func:`load_metric_array`)
+
+    See :func:`parcellate_arrays_atlases` for the other parameters and the
+    outputs.
+    """
+    from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+        load_metric_array,
+        parcellate_arrays_atlases,
+    )
+
+    return parcellate_arrays_atlases(
+        [load_metric_array(in_file) for in_file in in_files],
+        softwares=softwares,
+        metrics=metrics,
+        atlas_niftis=atlas_niftis,
+        atlas_indices=atlas_indices,
+        source_file=source_file,
+        gm_probseg=gm_probseg,
+        options=options,
+        n_threads=n_threads,
+    )
+
+
+def parcellate_volumes_signal(
+    dwi_nifti: str,
+    atlas_nifti: str,
+    atlas_index: Optional[str] = None,
+    output_format: str = "pickle",
+    slab_size: int = 1,
+):
+    """
+    Extract the regional mean signal of every volume of a DWI series
+    (e.g. to detect slice dropouts and regional signal decay), streaming the
+    series one slab of volumes at a time.
+
+    Parameters
+    ----------
+    dwi_nifti : str
+        The 4D DWI series (on the grid of the atlas)
+    atlas_nifti : str
+        The (native-space) parcellation image
+    atlas_index : str, optional
+        A label index of ``atlas_nifti`` (see
+        :func:`kepost.atlases.utils.save_label_index`), used instead of
+        grouping the atlas voxels again
+    output_format : str, optional
+        Either "pickle" or "parquet", by default "pickle"
+    slab_size : int, optional
+        Number of volumes read at once, by default 1
+
+    Returns
+    -------
+    out_file : str
+        A regions x volumes table
+    atlas_name : str
+        The atlas name
+    """
+    import os
+
+    import nibabel as nib
+    import numpy as np
+    import pandas as pd
+
+    from kepost.atlases.utils import load_atlas_regions, parcellate_volumes
+
+    atlas_name, _, regions, (labels, voxel_index, offsets), atlas_shape = (
+        load_atlas_regions(atlas_nifti, atlas_index)
+    )
+    dwi_shape = nib.load(dwi_nifti).shape
+    if dwi_shape[:3] != atlas_shape[:3]:
+        raise ValueError(
+            f"{dwi_nifti} (shape {dwi_shape}) is not on the grid of "
+            f"{atlas_nifti} (shape {atlas_shape})."
+        )
+    signal = parcellate_volumes(dwi_nifti, voxel_index, offsets, slab_size)
+    table = pd.DataFrame(
+        signal[np.searchsorted(labels, regions)],
+        index=regions,
+        columns=pd.RangeIndex(signal.shape[1], name="volume"),
+    )
+    if output_format == "parquet":
+        from kepost.workflows.diffusion.procedures.parcellations.dataset import (
+            _import_pyarrow,
+        )
+
+        pa, _, pq = _import_pyarrow()
+        out_file = f"{os.getcwd()}/volumes_signal.parquet"
+        table.columns = table.columns.astype(str)
+        pq.write_table(pa.Table.from_pandas(table.reset_index()), out_file)
+        return out_file, atlas_name
+    out_file = f"{os.getcwd()}/volumes_signal.pkl"
+    table.to_pickle(out_file)
     return out_file, atlas_name
 
 
-def init_parcellations_wf(
-    inputs: list, software: str, name: str = "parcellations_wf"
+def configure_parcellation_node(node: pe.Node) -> list:
+    """
+    Set the configured parcellation options (format, measures, GM label,
+    bootstrap and sampling, see :data:`PARCELLATION_OPTIONS`) of a node
+    wrapping :func:`parcellate_arrays`.
+
+    Parameters
+    ----------
+    node : pe.Node
+        The parcellation node
+
+    Returns
+    -------
+    list
+        The labels the node parcellates, in the order of its outputs
+    """
+    options = {
+        "output_format": config.workflow.parcellation_format,
+        "measures": config.workflow.parcellation_measures,
+        "bootstrap": config.workflow.bootstrap_measures,
+        "n_resamples": config.workflow.bootstrap_n_resamples,
+        "confidence": config.workflow.bootstrap_confidence,
+        "seed": config.seeds.numpy,
+        "sample_size": config.workflow.parcellation_sample_size,
+    }
+    # both label sets are parcellated from the whole-brain (native) atlas
+    labels = ["WholeBrain"]
+    if config.workflow.parcellate_gm and config.workflow.parcellation_space == "dwi":
+        options["gm_threshold"] = config.workflow.gm_probseg_threshold
+        labels.append("GM")
+    node.inputs.options = options
+    return labels
+
+
+def _init_parcellations_wf(
+    name: str, fields: list, softwares: list, metrics: list, volumes: bool = True
 ) -> Workflow:
     """
-    Workflow to parcellate the brain
+    Build a parcellation workflow around a single batched parcellation node,
+    either of one atlas (within the atlas iterable) or of all of a session's
+    atlases (see ``config.workflow.batch_atlases``), joined upstream of it.
+
+    Parameters
+    ----------
+    name : str
+        The name of the workflow
+    fields : list
+        The inputnode field holding each metric image
+    softwares : list
+        The reconstruction software of each metric image
+    metrics : list
+        The name of each metric image
+    volumes : bool, optional
+        Whether to also extract the regional signal of the DWI volumes (see
+        ``config.workflow.parcellate_volumes``), by default True
     """
-    workflow = Workflow(name=f"{software}_{name}")
+    workflow = Workflow(name=name)
     inputnode = pe.Node(
         niu.IdentityInterface(
             fields=[
@@ -84,59 +618,285 @@ def init_parcellations_wf(
                 "source_file",
                 "atlas_name",
                 "atlas_nifti",
+                "atlas_index",
+                "gm_probseg",
+                "dwi_nifti",
             ]
-            + inputs
+            + fields
         ),
         name="inputnode",
     )
-
-    nodes = {}
-    for i, p in enumerate(inputs):
-        nodes[f"parcellate_node_{i}"] = pe.Node(
+    outputnode = pe.Node(
+        niu.IdentityInterface(fields=["parcellations"]),
+        name="outputnode",
+    )
+    listify_metrics = pe.Node(
+        niu.Merge(len(fields)),
+        name="listify_metrics",
+    )
+    parcellation_inputs = [
+        "in_files",
+        "softwares",
+        "metrics",
+        "source_file",
+        "gm_probseg",
+        "options",
+    ]
+    parcellation_outputs = [
+        "out_file",
+        "out_files",
+        "summary_files",
+        "atlas_name",
+        "sample_files",
+    ]
+    batched = config.workflow.batch_atlases
+    if batched:
+        # gather the atlases of the iterable, so that the metric images are
+        # loaded once for all of them
+        join_atlases = pe.JoinNode(
+            niu.IdentityInterface(fields=["atlas_nifti", "atlas_index"]),
+            joinsource="atlases",
+            joinfield=["atlas_nifti", "atlas_index"],
+            name="join_atlases",
+        )
+        parcellate_node = pe.Node(
             niu.Function(
-                input_names=["in_file", "atlas_nifti"],
-                output_names=["out_file", "atlas_name"],
-                function=parcellate_all_measures,
+                input_names=["atlas_niftis", "atlas_indices", "n_threads"]
+                + parcellation_inputs,
+                output_names=parcellation_outputs,
+                function=parcellate_metrics_atlases,
+                imports=["from typing import Optional"],
             ),
-            name=f"parcellate_node_{i}",
+            name="parcellate_node",
+            n_procs=config.nipype.omp_nthreads,
         )
-        nodes[f"ds_parcellation_node_{i}"] = pe.Node(
+        parcellate_node.inputs.n_threads = config.nipype.omp_nthreads
+        n_atlases = len(config.workflow.atlases)
+    else:
+        parcellate_node = pe.Node(
+            niu.Function(
+                input_names=["atlas_nifti", "atlas_index"] + parcellation_inputs,
+                output_names=parcellation_outputs,
+                function=parcellate_metrics,
+                imports=["from typing import Optional"],
+            ),
+            name="parcellate_node",
+        )
+        n_atlases = 1
+    parcellate_node.inputs.softwares = softwares
+    parcellate_node.inputs.metrics = metrics
+    labels = configure_parcellation_node(parcellate_node)
+    sink_iterfield = ["in_file", "reconstruction_software", "measure", "label"]
+    if batched:
+        sink_iterfield.append("atlas")
+    ds_parcellation_node = pe.MapNode(
+        DerivativesDataSink(  # type: ignore[arg-type]
+            **DIFFUSION_WF_OUTPUT_ENTITIES.get("parcellations"),
+            dismiss_entities="direction",
+            copy=True,
+        ),
+        iterfield=sink_iterfield,
+        name="ds_parcellation_node",
+    )
+    ds_summary_node = pe.MapNode(
+        DerivativesDataSink(  # type: ignore[arg-type]
+            **DIFFUSION_WF_OUTPUT_ENTITIES.get("parcellation_summaries"),
+            dismiss_entities="direction",
+            copy=True,
+        ),
+        iterfield=sink_iterfield,
+        name="ds_summary_node",
+    )
+    ds_nodes = [ds_parcellation_node, ds_summary_node]
+    if config.workflow.parcellation_sample_size > 0:
+        ds_samples_node = pe.MapNode(
             DerivativesDataSink(  # type: ignore[arg-type]
-                **DIFFUSION_WF_OUTPUT_ENTITIES.get("parcellations"),
-                reconstruction_software=software,
+                **DIFFUSION_WF_OUTPUT_ENTITIES.get("parcellation_samples"),
                 dismiss_entities="direction",
-                measure=p,
                 copy=True,
             ),
-            name=f"ds_parcellation_node_{i}",
+            iterfield=sink_iterfield,
+            name="ds_samples_node",
         )
+        ds_nodes.append(ds_samples_node)
+    # the outputs are ordered by atlas (when batched), metric image, then label
+    sunk = [
+        (software, metric, label)
+        for _ in range(n_atlases)
+        for software, metric in zip(softwares, metrics)
+        for label in labels
+    ]
+    for ds_node in ds_nodes:
+        ds_node.inputs.reconstruction_software = [software for software, _, _ in sunk]
+        ds_node.inputs.measure = [metric for _, metric, _ in sunk]
+        ds_node.inputs.label = [label for _, _, label in sunk]
+        if config.workflow.parcellation_format == "parquet":
+            ds_node.inputs.extension = ".parquet"
+        if config.workflow.parcellation_space != "dwi":
+            ds_node.inputs.space = config.workflow.parcellation_space
         workflow.connect(
             [
                 (
                     inputnode,
-                    nodes[f"parcellate_node_{i}"],
-                    [(p, "in_file")],
+                    ds_node,
+                    [
+                        ("acq_label", "acquisition"),
+                        ("source_file", "source_file"),
+                        ("base_directory", "base_directory"),
+                    ],
                 ),
+            ]
+        )
+    atlas_inputs = [
+        ("atlas_nifti", "atlas_nifti"),
+        ("atlas_index", "atlas_index"),
+    ]
+    if batched:
+        workflow.connect(
+            [
+                (inputnode, join_atlases, atlas_inputs),
+                (
+                    join_atlases,
+                    parcellate_node,
+                    [
+                        ("atlas_nifti", "atlas_niftis"),
+                        ("atlas_index", "atlas_indices"),
+                    ],
+                ),
+            ]
+        )
+    else:
+        workflow.connect([(inputnode, parcellate_node, atlas_inputs)])
+    workflow.connect(
+        [
+            (
+                inputnode,
+                listify_metrics,
+                [(field, f"in{i+1}") for i, field in enumerate(fields)],
+            ),
+            (
+                listify_metrics,
+                parcellate_node,
+                [("out", "in_files")],
+            ),
+            (
+                inputnode,
+                parcellate_node,
+                [
+                    ("gm_probseg", "gm_probseg"),
+                    ("source_file", "source_file"),
+                ],
+            ),
+        ]
+    )
+    outputs = {
+        "out_file": [(outputnode, "parcellations")],
+        "out_files": [(ds_parcellation_node, "in_file")],
+        "summary_files": [(ds_summary_node, "in_file")],
+        "atlas_name": [(ds_node, "atlas") for ds_node in ds_nodes],
+    }
+    if config.workflow.parcellation_sample_size > 0:
+        outputs["sample_files"] = [(ds_samples_node, "in_file")]
+    for output, destinations in outputs.items():
+        for node, field in destinations:
+            workflow.connect(parcellate_node, output, node, field)
+    if (
+        volumes
+        and config.workflow.parcellate_volumes
+        and config.workflow.parcellation_space == "dwi"
+    ):
+        volumes_node = pe.Node(
+            niu.Function(
+                input_names=[
+                    "dwi_nifti",
+                    "atlas_nifti",
+                    "atlas_index",
+                    "output_format",
+                ],
+                output_names=["out_file", "atlas_name"],
+                function=parcellate_volumes_signal,
+                imports=["from typing import Optional"],
+            ),
+            name="volumes_node",
+        )
+        volumes_node.inputs.output_format = config.workflow.parcellation_format
+        ds_volumes_node = pe.Node(
+            DerivativesDataSink(  # type: ignore[arg-type]
+                **DIFFUSION_WF_OUTPUT_ENTITIES.get("volumes_signal"),
+                dismiss_entities="direction",
+                copy=True,
+            ),
+            name="ds_volumes_node",
+        )
+        if config.workflow.parcellation_format == "parquet":
+            ds_volumes_node.inputs.extension = ".parquet"
+        workflow.connect(
+            [
                 (
                     inputnode,
-                    nodes[f"parcellate_node_{i}"],
-                    [("atlas_nifti", "atlas_nifti")],
+                    volumes_node,
+                    [
+                        ("dwi_nifti", "dwi_nifti"),
+                        ("atlas_nifti", "atlas_nifti"),
+                        ("atlas_index", "atlas_index"),
+                    ],
                 ),
                 (
-                    nodes[f"parcellate_node_{i}"],
-                    nodes[f"ds_parcellation_node_{i}"],
+                    volumes_node,
+                    ds_volumes_node,
                     [("out_file", "in_file"), ("atlas_name", "atlas")],
                 ),
                 (
                     inputnode,
-                    nodes[f"ds_parcellation_node_{i}"],
+                    ds_volumes_node,
                     [
                         ("acq_label", "acquisition"),
-                        ("source_file", "source_file"),
+                        ("dwi_nifti", "source_file"),
                         ("base_directory", "base_directory"),
                     ],
                 ),
             ]
         )
-
     return workflow
+
+
+def init_parcellations_wf(
+    inputs: list, software: str, name: str = "parcellations_wf"
+) -> Workflow:
+    """
+    Workflow to parcellate the brain
+    """
+    return _init_parcellations_wf(
+        name=f"{software}_{name}",
+        fields=inputs,
+        softwares=[software] * len(inputs),
+        metrics=inputs,
+    )
+
+
+def init_session_parcellations_wf(
+    inputs: dict, volumes: bool = True, name: str = "parcellations_wf"
+) -> Workflow:
+    """
+    Workflow to parcellate all of a session's metric images in a single task.
+
+    Parameters
+    ----------
+    inputs : dict
+        The metric names, keyed by reconstruction software. Each metric is
+        expected at the ``{software}_{metric}`` field of the inputnode.
+    volumes : bool, optional
+        Whether to also extract the regional signal of the DWI volumes (see
+        ``config.workflow.parcellate_volumes``), by default True
+    name : str, optional
+        The name of the workflow, by default "parcellations_wf"
+    """
+    softwares = [software for software, metrics in inputs.items() for _ in metrics]
+    metrics = [metric for metrics in inputs.values() for metric in metrics]
+    return _init_parcellations_wf(
+        name=name,
+        fields=[f"{software}_{metric}" for software, metric in zip(softwares, metrics)],
+        softwares=softwares,
+        metrics=metrics,
+        volumes=volumes,
+    )
@@ -0,0 +1,208 @@
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    SegmentedValues,
+    compute_measures,
+)
+
+#: Default maximal number of voxel values sampled per region
+SAMPLE_SIZE = 512
+#: Columns of a session's sample tables
+SAMPLE_COLUMNS = ["region", "value", "weight"]
+#: Glob pattern (relative to the derivatives directory) of the sample tables
+SAMPLES_GLOB = (
+    "sub-{subject}/**/software-{software}/subtype-parcellations/"
+    "atlas-{atlas}/*_desc-samples_*meas-{metric}_parc.{extension}"
+)
+
+
+def sample_regions(
+    segments: SegmentedValues,
+    size: int = SAMPLE_SIZE,
+    seed: Optional[Union[int, np.random.Generator]] = None,
+) -> SegmentedValues:
+    """
+    Draw a uniform sample, without replacement, of at most ``size`` non-NaN
+    values of every segment (region).
+
+    Every value is given a random priority and the ``size`` lowest of every
+    segment are kept, which samples like a reservoir does, but for all
+    segments at once.
+
+    Parameters
+    ----------
+    segments : SegmentedValues
+        The label-grouped values of a metric image
+    size : int, optional
+        The maximal number of values kept per segment, by default
+        :data:`SAMPLE_SIZE`
+    seed : Union[int, np.random.Generator], optional
+        Seed (or generator) of the random priorities
+
+    Returns
+    -------
+    SegmentedValues
+        The sampled values (and weights), in their original order within
+        every segment
+    """
+    rng = np.random.default_rng(seed)
+    valid = np.flatnonzero(~segments.isnan)
+    counts = segments.counts
+    order = np.lexsort((rng.random(len(valid)), segments.segment_ids[valid]))
+    starts = np.cumsum(counts) - counts
+    ranks = np.arange(len(valid)) - np.repeat(starts, counts)
+    # the valid values are grouped by segment, and so are the kept ones
+    keep = np.sort(valid[order[ranks < size]])
+    offsets = np.zeros(segments.n_segments + 1, dtype=np.intp)
+    np.cumsum(np.minimum(counts, size), out=offsets[1:])
+    return SegmentedValues(
+        segments.values[keep],
+        offsets,
+        segments.weights[keep] if segments.weighted else None,
+    )
+
+
+def samples_table(samples: SegmentedValues, regions: np.ndarray) -> pd.DataFrame:
+    """
+    Store sampled values as a compact (float32) long table.
+
+    Parameters
+    ----------
+    samples : SegmentedValues
+        The sampled values (see :func:`sample_regions`)
+    regions : np.ndarray
+        The region label of every segment
+
+    Returns
+    -------
+    pd.DataFrame
+        A table with the columns in :data:`SAMPLE_COLUMNS`; the weights of
+        unweighted samples are NaN
+    """
+    return pd.DataFrame(
+        {
+            "region": np.asarray(regions)[samples.segment_ids].astype(np.int32),
+            "value": samples.values.astype(np.float32),
+            "weight": (
+                samples.weights.astype(np.float32) if samples.weighted else np.nan
+            ),
+        },
+        columns=SAMPLE_COLUMNS,
+    )
+
+
+def read_samples(
+    derivatives_dir: Union[str, Path],
+    subject: Optional[str] = None,
+    software: Optional[str] = None,
+    atlas: Optional[str] = None,
+    metric: Optional[str] = None,
+    label: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Read the sampled voxel values of a whole cohort as a single table.
+
+    Parameters
+    ----------
+    derivatives_dir : Union[str, Path]
+        The kepost derivatives directory
+    subject, software, atlas, metric, label : str, optional
+        Values to select, by default all
+
+    Returns
+    -------
+    pd.DataFrame
+        The samples, along with the subject, session, atlas, label, software
+        and metric they were drawn for
+    """
+    from kepost.workflows.diffusion.procedures.parcellations.aggregate import (
+        _file_entities,
+    )
+    from kepost.workflows.diffusion.procedures.parcellations.dataset import (
+        _import_pyarrow,
+    )
+
+    keys = ["subject", "session", "atlas", "label", "software", "metric"]
+    tables = []
+    for extension in ["pkl", "parquet"]:
+        pattern = SAMPLES_GLOB.format(
+            subject=subject or "*",
+            software=software or "*",
+            atlas=atlas or "*",
+            metric=metric or "*",
+            extension=extension,
+        )
+        for path in sorted(Path(derivatives_dir).glob(pattern)):
+            entities = _file_entities(path)
+            columns = {
+                "subject": entities.get("subject"),
+                "session": entities.get("session"),
+                "atlas": entities.get("atlas"),
+                "label": entities.get("label", "WholeBrain"),
+                "software": entities.get("reconstruction_software"),
+                "metric": entities.get("measure"),
+            }
+            if label is not None and columns["label"] != label:
+                continue
+            if extension == "parquet":
+                _, _, pq = _import_pyarrow()
+                table = pq.read_table(path).to_pandas()
+            else:
+                table = pd.read_pickle(path)
+            tables.append(table.assign(**columns))
+    if not tables:
+        return pd.DataFrame(columns=keys + SAMPLE_COLUMNS)
+    return pd.concat(tables, ignore_index=True)[keys + SAMPLE_COLUMNS]
+
+
+def evaluate_samples(
+    samples: pd.DataFrame, measures: Optional[Union[str, list]] = None
+) -> pd.DataFrame:
+    """
+    Evaluate (registered) measures on sampled voxel values, for all the
+    sessions, metrics and regions of a table at once.
+
+    Groups whose weights are all NaN (see :func:`samples_table`) are
+    unweighted: their weighted measures are NaN, and left out altogether
+    when no group is weighted.
+
+    Parameters
+    ----------
+    samples : pd.DataFrame
+        Sampled values (see :func:`read_samples`); every column but ``value``
+        and ``weight`` identifies a group of values
+    measures : Union[str, list], optional
+        The measures to evaluate, by default all
+
+    Returns
+    -------
+    pd.DataFrame
+        A groups x measures table
+    """
+    keys = [column for column in samples.columns if column not in ["value", "weight"]]
+    grouped = samples.groupby(keys, sort=True, dropna=False)
+    index = grouped.size().index
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    sizes = np.bincount(codes, minlength=grouped.ngroups)
+    weighted = grouped["weight"].count().to_numpy() > 0
+    values = samples["value"].to_numpy()[order]
+    weights = samples["weight"].to_numpy()[order]
+    tables = []
+    for is_weighted in [True, False] if weighted.any() else [False]:
+        groups = np.flatnonzero(weighted == is_weighted)
+        rows = (weighted == is_weighted)[codes[order]]
+        offsets = np.zeros(len(groups) + 1, dtype=np.intp)
+        np.cumsum(sizes[groups], out=offsets[1:])
+        segments = SegmentedValues(
+            values[rows], offsets, weights[rows] if is_weighted else None
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tables.append(
+                pd.DataFrame(compute_measures(segments, measures), index=index[groups])
+            )
+    return pd.concat(tables).reindex(index)
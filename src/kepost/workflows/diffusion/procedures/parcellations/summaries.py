@@ -0,0 +1,173 @@
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    SegmentedValues,
+)
+
+#: Percentiles kept as the (fixed-size) quantile sketch of every region
+SKETCH_PERCENTILES = np.arange(0, 101)
+SKETCH_COLUMNS = [f"p{p}" for p in SKETCH_PERCENTILES]
+#: Columns of a summaries table; all but the sketch merge exactly
+SUMMARY_COLUMNS = ["count", "sum", "sumsq", "min", "max"] + SKETCH_COLUMNS
+
+
+def summarize_regions(segments: SegmentedValues) -> pd.DataFrame:
+    """
+    Mergeable summaries of every segment (region): the number of non-NaN
+    voxels, their sum, sum of squares, minimum, maximum and percentiles.
+
+    Parameters
+    ----------
+    segments : SegmentedValues
+        The label-grouped values of a metric image
+
+    Returns
+    -------
+    pd.DataFrame
+        A segments x :data:`SUMMARY_COLUMNS` table
+    """
+    values = np.where(segments.isnan, 0, segments.values)
+    counts = segments.counts
+    starts = segments.offsets[:-1]
+    summaries = {
+        "count": counts,
+        "sum": segments.sum(values),
+        "sumsq": segments.sum(values * values),
+        "min": np.where(counts > 0, segments.take_sorted(starts), np.nan),
+        "max": np.where(counts > 0, segments.take_sorted(starts + counts - 1), np.nan),
+    }
+    for column, percentile in zip(SKETCH_COLUMNS, SKETCH_PERCENTILES):
+        summaries[column] = segments.percentile(percentile)
+    return pd.DataFrame(summaries, columns=SUMMARY_COLUMNS)
+
+
+def _merge_sketches(sketches: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Approximate the percentiles of the union of several regions from their
+    sketches, treating every sketch point as ``count / len(sketch)`` voxels.
+    """
+    keep = counts > 0
+    if not keep.any():
+        return np.full(len(SKETCH_PERCENTILES), np.nan)
+    if keep.sum() == 1:
+        return sketches[keep][0]
+    points = sketches[keep].ravel()
+    weights = np.repeat(counts[keep] / sketches.shape[1], sketches.shape[1])
+    order = np.argsort(points, kind="stable")
+    points, weights = points[order], weights[order]
+    positions = (np.cumsum(weights) - weights / 2) / weights.sum()
+    merged = np.interp(SKETCH_PERCENTILES / 100, positions, points)
+    merged[0], merged[-1] = points[0], points[-1]
+    return merged
+
+
+def merge_summaries(summaries: pd.DataFrame, groups) -> pd.DataFrame:
+    """
+    Merge region summaries into coarser groups of regions.
+
+    Counts, sums, sums of squares, minima and maxima merge exactly; the
+    quantile sketches merge approximately.
+
+    Parameters
+    ----------
+    summaries : pd.DataFrame
+        A regions x :data:`SUMMARY_COLUMNS` table
+    groups : array-like or list of array-likes
+        The group of every region (row) of ``summaries``, as accepted by
+        :meth:`pandas.DataFrame.groupby`
+
+    Returns
+    -------
+    pd.DataFrame
+        A groups x :data:`SUMMARY_COLUMNS` table
+    """
+    grouped = summaries.groupby(groups, sort=True)
+    merged = pd.concat(
+        [
+            grouped[["count", "sum", "sumsq"]].sum(),
+            grouped["min"].min(),
+            grouped["max"].max(),
+        ],
+        axis=1,
+    )
+    # merge the sketches group by group, on plain arrays
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(merged)))])
+    sketches = summaries[SKETCH_COLUMNS].to_numpy()[order]
+    counts = summaries["count"].to_numpy()[order]
+    merged_sketches = pd.DataFrame(
+        [
+            _merge_sketches(sketches[start:stop], counts[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ],
+        index=merged.index,
+        columns=SKETCH_COLUMNS,
+    )
+    return pd.concat([merged, merged_sketches], axis=1)[SUMMARY_COLUMNS]
+
+
+def summary_measures(summaries: pd.DataFrame) -> pd.DataFrame:
+    """
+    Derive measures from (possibly merged) summaries.
+
+    Parameters
+    ----------
+    summaries : pd.DataFrame
+        A table with the columns in :data:`SUMMARY_COLUMNS`
+
+    Returns
+    -------
+    pd.DataFrame
+        The number of voxels, mean, standard deviation and median of every
+        row (the median is approximate for merged rows)
+    """
+    counts = summaries["count"].to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = summaries["sum"].to_numpy() / counts
+        var = np.maximum(summaries["sumsq"].to_numpy() / counts - mean**2, 0)
+    return pd.DataFrame(
+        {
+            "n_voxels": counts,
+            "nanmean": mean,
+            "nanstd": np.sqrt(var),
+            "nanmedian": summaries["p50"].to_numpy(),
+        },
+        index=summaries.index,
+    )
+
+
+def rollup(summaries: pd.DataFrame, atlas: str, by: Union[str, list]) -> pd.DataFrame:
+    """
+    Summarize an atlas' regions by columns of its description file
+    (e.g. ``network`` or ``hemisphere`` for the Schaefer atlases), without
+    reading any image.
+
+    Parameters
+    ----------
+    summaries : pd.DataFrame
+        A table of region summaries, indexed by the atlas' region labels
+    atlas : str
+        The key of the atlas in ``AVAILABLE_ATLASES``
+    by : Union[str, list]
+        The description column(s) to group the regions by
+
+    Returns
+    -------
+    pd.DataFrame
+        The merged summaries and the measures derived from them, per group
+    """
+    from kepost.atlases.utils import get_atlas_properties
+
+    _, description, region_col, index_col = get_atlas_properties(atlas)
+    df = pd.read_csv(description, index_col=index_col)
+    by = [by] if isinstance(by, str) else list(by)
+    groups = df.set_index(df[region_col].astype(int))[by].reindex(
+        summaries.index.astype(int)
+    )
+    merged = merge_summaries(summaries, [groups[column].to_numpy() for column in by])
+    merged.index.names = by
+    return pd.concat([merged, summary_measures(merged)], axis=1)
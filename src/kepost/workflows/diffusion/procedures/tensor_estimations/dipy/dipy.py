@@ -10,6 +10,7 @@ from kepost.interfaces.bids.utils import gen_acq_label
 from kepost.interfaces.dipy import ReconstDTI
 from kepost.workflows.diffusion.procedures.tensor_estimations.dipy.utils import (
     estimate_sigma,
+    fit_tensor,
 )
 from kepost.workflows.diffusion.procedures.utils.derivatives import (
     DIFFUSION_WF_OUTPUT_ENTITIES,
@@ -55,7 +56,10 @@ def init_dipy_tensor_wf(
         name="inputnode",
     )
     outputnode = pe.Node(
-        interface=niu.IdentityInterface(fields=TENSOR_PARAMETERS),
+        interface=niu.IdentityInterface(
+            fields=TENSOR_PARAMETERS
+            + [f"standard_{param}" for param in TENSOR_PARAMETERS]
+        ),
         name="outputnode",
     )
     acq_label = pe.Node(
@@ -66,7 +70,27 @@ def init_dipy_tensor_wf(
         ),
         name="acq_label",
     )
-    tensor_wf = pe.Node(interface=ReconstDTI(), name="dipy_tensor_wf")
+    if config.workflow.uncompressed_tensor_maps:
+        # the maps are written uncompressed for the parcellation, and
+        # compressed by the sinks, off the parcellation's path
+        tensor_wf = pe.Node(
+            niu.Function(
+                input_names=[
+                    "in_file",
+                    "in_bvec",
+                    "in_bval",
+                    "mask_file",
+                    "fit_method",
+                    "sigma",
+                ],
+                output_names=[f"{param}_file" for param in TENSOR_PARAMETERS],
+                function=fit_tensor,
+                imports=["from typing import Optional"],
+            ),
+            name="dipy_tensor_wf",
+        )
+    else:
+        tensor_wf = pe.Node(interface=ReconstDTI(), name="dipy_tensor_wf")
     listify_tensor_params = pe.Node(
         interface=niu.Merge(numinputs=len(TENSOR_PARAMETERS)),
         name="listify_tensor_params",
@@ -83,6 +107,8 @@ def init_dipy_tensor_wf(
         name="ds_tensor_wf",
     )
     ds_tensor_wf.inputs.measure = TENSOR_PARAMETERS
+    if config.workflow.uncompressed_tensor_maps:
+        ds_tensor_wf.inputs.compress = True
 
     if config.workflow.dipy_reconstruction_method.lower() in ["rt", "restore"]:
         estimate_sigma_node = pe.Node(
@@ -142,6 +168,10 @@ def init_dipy_tensor_wf(
         iterfield=["input_image"],
         name="normalize_tensor_wf",
     )
+    split_standard_params = pe.Node(
+        niu.Split(splits=[1] * len(TENSOR_PARAMETERS), squeeze=True),
+        name="split_standard_params",
+    )
     ds_tensor_mni_wf = pe.MapNode(
         interface=DerivativesDataSink(  # type: ignore[arg-type]
             **DIFFUSION_WF_OUTPUT_ENTITIES.get("dti_derived_parameters"),
@@ -179,9 +209,12 @@ def init_dipy_tensor_wf(
                 [(f"{param}_file", param) for param in TENSOR_PARAMETERS],
             ),
             (
-                outputnode,
+                tensor_wf,
                 listify_tensor_params,
-                [(param, f"in{i+1}") for i, param in enumerate(TENSOR_PARAMETERS)],
+                [
+                    (f"{param}_file", f"in{i+1}")
+                    for i, param in enumerate(TENSOR_PARAMETERS)
+                ],
             ),
             (
                 listify_tensor_params,
@@ -249,6 +282,19 @@ def init_dipy_tensor_wf(
                 ],
             ),
             (acq_label, ds_tensor_mni_wf, [("acq_label", "acquisition")]),
+            (
+                normalize_tensor_wf,
+                split_standard_params,
+                [("output_image", "inlist")],
+            ),
+            (
+                split_standard_params,
+                outputnode,
+                [
+                    (f"out{i+1}", f"standard_{param}")
+                    for i, param in enumerate(TENSOR_PARAMETERS)
+                ],
+            ),
             (
                 coregister_tensor_wf,
                 normalize_tensor_wf,
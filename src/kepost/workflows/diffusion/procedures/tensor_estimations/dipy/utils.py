@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 def estimate_sigma(in_file: str, in_mask: str) -> float:
     """
     Estimate the sigma value (1.5267 * std(background_noise))
@@ -19,3 +22,78 @@ def estimate_sigma(in_file: str, in_mask: str) -> float:
     mask = nib.load(in_mask).get_fdata().astype(bool)  # type: ignore[attr-defined]
     background = data[~mask]
     return 1.5267 * np.std(background)
+
+
+def fit_tensor(
+    in_file: str,
+    in_bvec: str,
+    in_bval: str,
+    mask_file: Optional[str] = None,
+    fit_method: str = "WLS",
+    sigma: Optional[float] = None,
+):
+    """
+    Fit the diffusion tensor and write its derived parameters uncompressed.
+
+    Uncompressed maps are memory-mapped by the parcellation instead of being
+    decompressed again; the derivatives sinks compress them in their own
+    tasks, off the parcellation's path.
+
+    Parameters
+    ----------
+    in_file : str
+        The DWI series
+    in_bvec : str
+        The b-vectors file
+    in_bval : str
+        The b-values file
+    mask_file : str, optional
+        The brain mask to fit the tensor within
+    fit_method : str, optional
+        The method to fit the tensor, by default "WLS"
+    sigma : float, optional
+        The standard deviation of the noise (for the RESTORE and NLLS fits)
+
+    Returns
+    -------
+    fa_file, ga_file, md_file, ad_file, rd_file : str
+        The tensor-derived parameter maps
+    """
+    import os
+
+    import nibabel as nib
+    import numpy as np
+    from dipy.io.image import load_nifti, load_nifti_data
+    from dipy.reconst.dti import (
+        axial_diffusivity,
+        fractional_anisotropy,
+        geodesic_anisotropy,
+        mean_diffusivity,
+        radial_diffusivity,
+    )
+    from dipy.workflows.reconst import ReconstDtiFlow
+
+    data, affine = load_nifti(in_file)
+    mask = load_nifti_data(mask_file).astype(bool) if mask_file else None
+    optional_args = {}
+    if fit_method in ["RT", "restore", "RESTORE", "NLLS"]:
+        optional_args["sigma"] = sigma
+    # the same fit (and parameters) as ReconstDtiFlow, see ReconstDTI
+    tenfit, _ = ReconstDtiFlow().get_fitted_tensor(
+        data, mask, in_bval, in_bvec, fit_method=fit_method, optional_args=optional_args
+    )
+    del data
+    fa = np.clip(np.nan_to_num(fractional_anisotropy(tenfit.evals)), 0, 1)
+    parameters = {
+        "fa": fa,
+        "ga": geodesic_anisotropy(tenfit.evals),
+        "md": mean_diffusivity(tenfit.evals),
+        "ad": axial_diffusivity(tenfit.evals),
+        "rd": radial_diffusivity(tenfit.evals),
+    }
+    map_files = []
+    for param, values in parameters.items():
+        map_file = f"{os.getcwd()}/{param}.nii"
+        nib.save(nib.Nifti1Image(values.astype(np.float32), affine), map_file)
+        map_files.append(map_file)
+    return tuple(map_files)
@@ -130,6 +130,10 @@ def init_mrtrix3_tensor_wf(name: str = "mrtrix3_tensor_wf") -> Workflow:
         iterfield=["input_image"],
         name="normalize_tensor_wf",
     )
+    split_standard_params = pe.Node(
+        niu.Split(splits=[1] * len(TENSOR_PARAMETERS), squeeze=True),
+        name="split_standard_params",
+    )
     mni_tensor_entities = DIFFUSION_WF_OUTPUT_ENTITIES.get(  # type: ignore[union-attr]
         "dti_derived_parameters"
     ).copy()
@@ -174,9 +178,12 @@ def init_mrtrix3_tensor_wf(name: str = "mrtrix3_tensor_wf") -> Workflow:
                 [(f"out_{param}", param) for param in TENSOR_PARAMETERS],
             ),
             (
-                outputnode,
+                tensor2metric_wf,
                 listify_metrics_wf,
-                [(param, f"in{i+1}") for i, param in enumerate(TENSOR_PARAMETERS)],
+                [
+                    (f"out_{param}", f"in{i+1}")
+                    for i, param in enumerate(TENSOR_PARAMETERS)
+                ],
             ),
             (
                 listify_metrics_wf,
@@ -252,6 +259,19 @@ def init_mrtrix3_tensor_wf(name: str = "mrtrix3_tensor_wf") -> Workflow:
                 ],
             ),
             (acq_label, ds_tensor_mni_wf, [("acq_label", "acquisition")]),
+            (
+                normalize_tensor_wf,
+                split_standard_params,
+                [("output_image", "inlist")],
+            ),
+            (
+                split_standard_params,
+                outputnode,
+                [
+                    (f"out{i+1}", f"standard_{param}")
+                    for i, param in enumerate(TENSOR_PARAMETERS)
+                ],
+            ),
         ]
     )
     return workflow
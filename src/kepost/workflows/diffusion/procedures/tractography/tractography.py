@@ -75,6 +75,29 @@ def format_algorithm(algorithm: str) -> str:
     return algorithm.replace("_", "")
 
 
+def tractography_algorithms() -> list:
+    """
+    The (configured) deterministic and probabilistic tractography algorithms.
+    """
+    return [
+        config.workflow.det_tracking_algorithm,
+        config.workflow.prob_tracking_algorithm,
+    ]
+
+
+def tractography_maps() -> list:
+    """
+    The names of the tractography-derived maps that are parcellated: the
+    apparent fiber density (the l=0 term of the WM FOD), and the
+    (SIFT2-weighted) track density of every tractography algorithm.
+    """
+    maps = ["afd"]
+    for algorithm in tractography_algorithms():
+        maps += [f"tdi{format_algorithm(algorithm)}"]
+        maps += [f"sift2tdi{format_algorithm(algorithm)}"]
+    return maps
+
+
 def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
     """
     Build the SDC and motion correction workflow.
@@ -127,7 +150,18 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
         name="inputnode",
     )
 
-    outputnode = pe.Node(
+    # one output per tractography algorithm (see tractography_algorithms)
+    algorithm_outputs = [
+        "unsifted_tck",
+        "sifted_tck",
+        "sift2_weights",
+        "tdi_map",
+        "tdi_maps",
+        "sift2_tdi_maps",
+    ]
+    # the outputnode gathers the algorithms' iterable, so that its consumers
+    # are not replicated per algorithm
+    outputnode = pe.JoinNode(
         niu.IdentityInterface(
             fields=[
                 "wm_response",
@@ -137,12 +171,12 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
                 "gm_fod",
                 "csf_fod",
                 "predicted_signal",
-                "unsifted_tck",
-                "sifted_tck",
-                "sift2_weights",
-                "tdi_map",
+                "afd",
             ]
+            + algorithm_outputs
         ),
+        joinsource="tractography_algorithm",
+        joinfield=algorithm_outputs,
         name="outputnode",
     )
 
@@ -203,6 +237,15 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
         ),
         name="mtnormalize",
     )
+    # the apparent fiber density is the l=0 term of the normalized WM FOD
+    extract_afd_node = pe.Node(
+        mrt.MRConvert(
+            coord=[3, 0],
+            out_file="afd.nii.gz",
+            nthreads=config.nipype.omp_nthreads,
+        ),
+        name="extract_afd",
+    )
 
     workflow.connect(
         [
@@ -272,6 +315,8 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
                     ("out_csf_odf", "csf_fod"),
                 ],
             ),
+            (mtnormalize_node, extract_afd_node, [("out_wm_odf", "in_file")]),
+            (extract_afd_node, outputnode, [("out_file", "afd")]),
             (
                 dwi2fod_node,
                 outputnode,
@@ -286,13 +331,7 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
         niu.IdentityInterface(fields=["algorithm"]),
         name="tractography_algorithm",
     )
-    tractography_algorithm.iterables = (
-        "algorithm",
-        [
-            config.workflow.det_tracking_algorithm,
-            config.workflow.prob_tracking_algorithm,
-        ],
-    )
+    tractography_algorithm.iterables = ("algorithm", tractography_algorithms())
 
     tractography = pe.Node(
         mrt.Tractography(
@@ -460,6 +499,40 @@ def init_tractography_wf(name: str = "tractography_wf") -> Workflow:
         ]
     )
 
+    # track density maps to parcellate, unweighted and SIFT2-weighted
+    tckmap_tdi_node = pe.Node(
+        TckMap(
+            nthreads=config.nipype.omp_nthreads,
+            out_file="tdi.nii.gz",
+            contrast="tdi",
+            precise=True,
+        ),
+        name="tckmap_tdi",
+    )
+    tckmap_sift2_tdi_node = pe.Node(
+        TckMap(
+            nthreads=config.nipype.omp_nthreads,
+            out_file="sift2_tdi.nii.gz",
+            contrast="tdi",
+            precise=True,
+        ),
+        name="tckmap_sift2_tdi",
+    )
+    for tckmap in [tckmap_tdi_node, tckmap_sift2_tdi_node]:
+        workflow.connect(
+            [
+                (inputnode, tckmap, [("dwi_reference", "template")]),
+                (tractography, tckmap, [("out_file", "in_file")]),
+            ]
+        )
+    workflow.connect(
+        [
+            (tcksift2_node, tckmap_sift2_tdi_node, [("out_file", "tck_weights_in")]),
+            (tckmap_tdi_node, outputnode, [("out_file", "tdi_maps")]),
+            (tckmap_sift2_tdi_node, outputnode, [("out_file", "sift2_tdi_maps")]),
+        ]
+    )
+
     format_algorithm_node = pe.Node(
         niu.Function(
             input_names=["algorithm"],
@@ -8,14 +8,14 @@ DIFFUSION_WF_OUTPUT_ENTITIES = dict(
         "suffix": "dseg",
         "extension": ".nii.gz",
     },
-    gm_cropped_parcellation={
+    wholebrain_parcellation_index={
         "space": "dwi",
         "desc": "",
         "direction": "",
-        "label": "GM",
+        "label": "WholeBrain",
         "subtype": "atlases",
         "suffix": "dseg",
-        "extension": ".nii.gz",
+        "extension": ".npz",
     },
     t1w_in_dwi_space={
         "space": "dwi",
@@ -78,4 +78,26 @@ DIFFUSION_WF_OUTPUT_ENTITIES = dict(
         "suffix": "parc",
         "extension": ".pkl",
     },
+    parcellation_summaries={
+        "space": "dwi",
+        "desc": "summary",
+        "subtype": "parcellations",
+        "suffix": "parc",
+        "extension": ".pkl",
+    },
+    parcellation_samples={
+        "space": "dwi",
+        "desc": "samples",
+        "subtype": "parcellations",
+        "suffix": "parc",
+        "extension": ".pkl",
+    },
+    volumes_signal={
+        "space": "dwi",
+        "desc": "volumes",
+        "measure": "signal",
+        "subtype": "parcellations",
+        "suffix": "parc",
+        "extension": ".pkl",
+    },
 )
@@ -1,3 +1,5 @@
+import nibabel as nib
+import numpy as np
 import pytest
 
 from kepost.workflows.diffusion.procedures.coregisterations import (
@@ -49,10 +51,37 @@ def test_coregistration_inputnode_fields(atlas_coregistration_wf):
         "t1w_to_dwi_transform",
         "atlas_name",
         "whole_brain_parcellation",
-        "gm_cropped_parcellation",
+        "t1w_lookup",
+        "mni_to_native_transform",
     ]
 
 
+def test_coregistration_atlas_resolution(atlas_coregistration_wf, tmp_path):
+    from nipype.utils.functions import create_function_from_source
+
+    workflow = atlas_coregistration_wf
+    select_resolution = workflow.get_node("select_resolution")
+    # the atlas is resampled once, from MNI to DWI, at the DWI grid's resolution
+    assert workflow._graph.get_edge_data(
+        workflow.get_node("inputnode"), select_resolution
+    )["connect"] == [("atlas_name", "atlas_name"), ("dwi_reference", "reference_image")]
+    apply_transforms = workflow.get_node("apply_transforms_wholebrain")
+    assert workflow._graph.has_edge(select_resolution, apply_transforms)
+    assert workflow._graph.has_edge(
+        workflow.get_node("mni_to_dwi_transforms"), apply_transforms
+    )
+    dwi_reference = tmp_path / "dwi_reference.nii.gz"
+    nib.save(
+        nib.Nifti1Image(np.zeros((4, 4, 4)), np.diag([2.0, 2.0, 2.0, 1.0])),
+        dwi_reference,
+    )
+    select_atlas_resolution = create_function_from_source(
+        select_resolution.inputs.function_str
+    )
+    atlas_nifti = select_atlas_resolution("schaefer2018_100_7", str(dwi_reference))
+    assert "_res-2mm_" in atlas_nifti
+
+
 def test_init_tissue_coregistration_wf(tissue_coregistration_wf):
     assert tissue_coregistration_wf.name == "tissues_coregistration_wf"
     assert tissue_coregistration_wf.base_dir is None
@@ -0,0 +1,175 @@
+from collections import Counter
+
+import networkx as nx
+import neuromaps.datasets
+import pytest
+from nipype.interfaces import utility as niu
+from nipype.pipeline import engine as pe
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+from kepost import config
+from kepost.workflows.diffusion.diffusion import ATLAS_INPUTS, init_diffusion_wf
+
+#: Sub-workflows of the diffusion workflow that depend on the atlas
+ATLAS_DEPENDENT_WFS = [
+    "atlas_coregistration_wf",
+    "parcellations_wf",
+    "tract_parcellations_wf",
+]
+
+
+def _expanded_graph(tmp_path, atlases: list) -> nx.DiGraph:
+    """
+    Expand a session's diffusion workflow fed by an atlas iterable (as in the
+    single-subject workflow).
+    """
+    fields = [
+        "dwi_nifti",
+        "dwi_bvec",
+        "dwi_bval",
+        "dwi_grad",
+        "dwi_mask",
+        "dwi_reference",
+        "t1w_to_dwi_transform",
+        "dwi_to_t1w_transform",
+        "eddy_qc",
+    ]
+    dwi_data = {
+        field: str(tmp_path / f"sub-01_ses-01_{field}.nii.gz") for field in fields
+    }
+    dwi_data["dwi_nifti"] = str(tmp_path / "sub-01_ses-01_dwi.nii.gz")
+    for in_file in dwi_data.values():
+        open(in_file, "w").close()
+    workflow = pe.Workflow(name="single_subject_wf")
+    atlases_node = pe.Node(niu.IdentityInterface(fields=["atlas_name"]), name="atlases")
+    atlases_node.iterables = ("atlas_name", atlases)
+    five_tissue_type = pe.Node(
+        niu.IdentityInterface(fields=["five_tissue_type"]), name="five_tissue_type"
+    )
+    five_tissue_type.inputs.five_tissue_type = dwi_data["dwi_mask"]
+    register = pe.Node(
+        niu.Function(
+            input_names=["atlas_name"],
+            output_names=["parcellation"],
+            function=lambda atlas_name: atlas_name,
+        ),
+        name="register",
+    )
+    session_wf = init_diffusion_wf(dwi_data)
+    workflow.connect(
+        [
+            (atlases_node, register, [("atlas_name", "atlas_name")]),
+            (
+                atlases_node,
+                session_wf,
+                [("atlas_name", "atlas_inputnode.atlas_name")],
+            ),
+            (
+                register,
+                session_wf,
+                [("parcellation", "atlas_inputnode.whole_brain_t1w_parcellation")],
+            ),
+            (
+                five_tissue_type,
+                session_wf,
+                [("five_tissue_type", "inputnode.five_tissue_type")],
+            ),
+        ]
+    )
+    return generate_expanded_graph(workflow._create_flat_graph())
+
+
+def _expanded_nodes(tmp_path, atlases: list) -> Counter:
+    """Count the copies of every node of an expanded session workflow."""
+    graph = _expanded_graph(tmp_path, atlases)
+    return Counter(node.fullname for node in graph.nodes())
+
+
+@pytest.fixture
+def offline_templates(tmp_path, monkeypatch):
+    template = tmp_path / "tpl-MNI152NLin2009cAsym_T1w.nii.gz"
+    template.touch()
+    # the normalized FODs are set (as existing files) when the workflow is built
+    monkeypatch.chdir(tmp_path)
+    for tissue in ["wm", "gm", "csf"]:
+        (tmp_path / f"{tissue}.mif").touch()
+    monkeypatch.setattr(
+        neuromaps.datasets,
+        "fetch_atlas",
+        lambda **kwargs: {"2009cAsym_T1w": str(template)},
+    )
+
+
+def _per_atlas_nodes(tmp_path, monkeypatch, atlases: list) -> list:
+    monkeypatch.setattr(config.workflow, "atlases", atlases)
+    one = _expanded_nodes(tmp_path, atlases[:1])
+    several = _expanded_nodes(tmp_path, atlases)
+    return sorted(name for name in several if several[name] > one[name])
+
+
+def test_atlas_inputs():
+    assert ATLAS_INPUTS == ["atlas_name", "whole_brain_t1w_parcellation"]
+
+
+@pytest.mark.usefixtures("offline_templates")
+def test_atlas_fan_out(tmp_path, monkeypatch):
+    per_atlas = _per_atlas_nodes(tmp_path, monkeypatch, ["fan2016", "huang2022"])
+    # only the atlas-dependent nodes are replicated, not the tensor fits,
+    # QC, FODs or tractography
+    assert per_atlas
+    assert all(
+        any(f".{wf}." in name for wf in ATLAS_DEPENDENT_WFS)
+        or name.endswith(".register")
+        for name in per_atlas
+    )
+    assert any(name.endswith("parcellations_wf.parcellate_node") for name in per_atlas)
+
+
+@pytest.mark.usefixtures("offline_templates")
+def test_atlas_fan_out_batched(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.workflow, "batch_atlases", True)
+    per_atlas = _per_atlas_nodes(tmp_path, monkeypatch, ["fan2016", "huang2022"])
+    # the atlases are joined upstream of the parcellation
+    assert not any(
+        name.split(".")[-2] in ["parcellations_wf", "tract_parcellations_wf"]
+        for name in per_atlas
+    )
+
+
+@pytest.mark.usefixtures("offline_templates")
+def test_tract_maps_parcellation(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.workflow, "atlases", ["fan2016"])
+    graph = _expanded_graph(tmp_path, ["fan2016"])
+    nodes = {node.fullname.split(".", 2)[-1]: node for node in graph.nodes()}
+    # the AFD is extracted from the (.mif) WM FOD as a NIfTI image
+    extract_afd = nodes["tractography_wf.extract_afd"]
+    assert extract_afd.inputs.coord == [3, 0]
+    assert extract_afd.inputs.out_file == "afd.nii.gz"
+    tract_parcellation = nodes["tract_parcellations_wf.parcellate_node"]
+    assert nx.has_path(graph, extract_afd, tract_parcellation)
+    assert "tract_parcellations_wf.volumes_node" not in nodes
+    # the tensor maps' parcellation does not wait for the tractography
+    tensor_parcellation = nodes["parcellations_wf.parcellate_node"]
+    assert "afd" not in tensor_parcellation.inputs.metrics
+    assert "afd" in tract_parcellation.inputs.metrics
+    assert not any(
+        nx.has_path(graph, node, tensor_parcellation)
+        for name, node in nodes.items()
+        if name.startswith("tractography_wf.")
+    )
+    # the tract maps are gathered by the tractography's outputnode, so their
+    # parcellation is not replicated per tractography algorithm
+    names = Counter(node.fullname.split(".", 2)[-1] for node in graph.nodes())
+    assert names["tract_parcellations_wf.parcellate_node"] == 1
+    assert names["tractography_wf.outputnode"] == 1
+
+
+@pytest.mark.usefixtures("offline_templates")
+def test_tractography_wf_boundary(tmp_path):
+    graph = _expanded_graph(tmp_path, ["fan2016"])
+    # the session workflow connects to the tractography through its outputnode
+    for source, target in graph.edges():
+        source_wf = source.fullname.split(".")[-2]
+        target_wf = target.fullname.split(".")[-2]
+        if source_wf == "tractography_wf" and target_wf != source_wf:
+            assert source.name == "outputnode", target.fullname
@@ -1,6 +1,52 @@
+import time
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
 import pytest
 
-from kepost.workflows.diffusion.procedures.parcellations import init_parcellations_wf
+from kepost import config
+from kepost.atlases.utils import get_atlas_properties, group_labels, parcellate
+from kepost.workflows.diffusion.procedures.parcellations import (
+    aggregate,
+    aggregate_parcellations,
+    init_parcellations_wf,
+    init_session_parcellations_wf,
+    read_parcellations,
+)
+from kepost.workflows.diffusion.procedures.parcellations.atoms import (
+    build_atoms,
+    parcellate_atlases,
+)
+from kepost.workflows.diffusion.procedures.parcellations.available_measures import (
+    AVAILABLE_MEASURES,
+    MEASURES_REGISTRY,
+    SEGMENTED_MEASURES,
+    WEIGHTED_MEASURES,
+    SegmentedValues,
+    compute_measures,
+    get_measures,
+    register_measure,
+)
+from kepost.workflows.diffusion.procedures.parcellations.bootstrap import (
+    bootstrap_measures,
+)
+from kepost.workflows.diffusion.procedures.parcellations.dataset import (
+    PARCELLATION_COLUMNS,
+)
+from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+    parcellate_metrics,
+    parcellate_metrics_atlases,
+)
+from kepost.workflows.diffusion.procedures.parcellations.samples import (
+    evaluate_samples,
+    read_samples,
+    sample_regions,
+)
+from kepost.workflows.diffusion.procedures.parcellations.summaries import (
+    rollup,
+    summarize_regions,
+)
 from kepost.workflows.diffusion.procedures.tensor_estimations.dipy.dipy import (
     TENSOR_PARAMETERS as DIPY_,
 )
@@ -33,6 +79,9 @@ def test_dipy_parcellation_inputnode_fields(dipy_parcellation_wf):
             "source_file",
             "atlas_name",
             "atlas_nifti",
+            "atlas_index",
+            "gm_probseg",
+            "dwi_nifti",
         ]
         + DIPY_
     )
@@ -52,6 +101,739 @@ def test_mrtrix3_parcellation_inputnode_fields(mrtrix3_parcellation_wf):
             "source_file",
             "atlas_name",
             "atlas_nifti",
+            "atlas_index",
+            "gm_probseg",
+            "dwi_nifti",
         ]
         + MRTRIX3_
     )
+
+
+@pytest.fixture
+def session_parcellation_wf():
+    return init_session_parcellations_wf(inputs={"dipy": DIPY_, "mrtrix3": MRTRIX3_})
+
+
+def test_session_parcellation_inputnode_fields(session_parcellation_wf):
+    assert list(session_parcellation_wf.get_node("inputnode").inputs.get().keys()) == [
+        "base_directory",
+        "acq_label",
+        "source_file",
+        "atlas_name",
+        "atlas_nifti",
+        "atlas_index",
+        "gm_probseg",
+        "dwi_nifti",
+    ] + [f"dipy_{param}" for param in DIPY_] + [
+        f"mrtrix3_{param}" for param in MRTRIX3_
+    ]
+
+
+def test_session_parcellation_batched(monkeypatch):
+    monkeypatch.setattr(config.workflow, "batch_atlases", True)
+    monkeypatch.setattr(config.workflow, "atlases", ["fan2016", "huang2022"])
+    monkeypatch.setattr(config.workflow, "parcellate_gm", False)
+    workflow = init_session_parcellations_wf(inputs={"mrtrix3": MRTRIX3_})
+    join_node = workflow.get_node("join_atlases")
+    assert join_node.joinsource == "atlases"
+    parcellate_node = workflow.get_node("parcellate_node")
+    assert "atlas_niftis" in parcellate_node.inputs.get()
+    # one table per atlas and metric, all sunk by the same nodes
+    ds_node = workflow.get_node("ds_parcellation_node")
+    assert "atlas" in ds_node.iterfield
+    assert ds_node.inputs.measure == MRTRIX3_ * 2
+
+
+@pytest.mark.parametrize("batch_atlases", [False, True])
+def test_parcellation_node_function(monkeypatch, batch_atlases):
+    from nipype.utils.functions import create_function_from_source
+
+    monkeypatch.setattr(config.workflow, "batch_atlases", batch_atlases)
+    workflow = init_session_parcellations_wf(inputs={"mrtrix3": MRTRIX3_})
+    parcellate_node = workflow.get_node("parcellate_node")
+    # the node's function runs without the module's globals
+    create_function_from_source(
+        parcellate_node.inputs.function_str, parcellate_node.interface.imports
+    )
+    assert parcellate_node.inputs.options["output_format"] == "pickle"
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_parcellate_metrics(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    in_files = []
+    for metric in ["fa", "md"]:
+        in_files.append(str(tmp_path / f"{metric}.nii.gz"))
+        metric_data = rng.random(atlas_data.shape).astype(np.float32)
+        nib.save(nib.Nifti1Image(metric_data, np.eye(4)), in_files[-1])
+    gm_probseg = str(tmp_path / "gm_probseg.nii.gz")
+    gm_data = rng.random(atlas_data.shape).astype(np.float32)
+    nib.save(nib.Nifti1Image(gm_data, np.eye(4)), gm_probseg)
+
+    out_file, out_files, _, atlas_name, _ = parcellate_metrics(
+        in_files=in_files,
+        softwares=["dipy", "dipy"],
+        metrics=["fa", "md"],
+        atlas_nifti=str(atlas_nifti),
+        gm_probseg=gm_probseg,
+        options={"gm_threshold": 0.5},
+    )
+    assert atlas_name == "huang2022"
+    assert len(out_files) == 4
+    parcellations = pd.read_pickle(out_file)
+    _, description, region_col, index_col = get_atlas_properties("huang2022")
+    # the GM-cropped parcellation, as previously written by the workflow
+    gm_atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_label-GM_dseg.nii"
+    nib.save(
+        nib.Nifti1Image(np.where(gm_data >= 0.5, atlas_data, 0), np.eye(4)),
+        gm_atlas_nifti,
+    )
+    for i, (in_file, metric) in enumerate(zip(in_files, ["fa", "md"])):
+        for label, label_atlas, metric_file in zip(
+            ["WholeBrain", "GM"],
+            [atlas_nifti, gm_atlas_nifti],
+            out_files[2 * i : 2 * i + 2],
+        ):
+            metric_df = pd.read_pickle(metric_file)
+            for measure_name, measure_func in AVAILABLE_MEASURES.items():
+                expected = parcellate(
+                    atlas_description=description,
+                    index_col=index_col,
+                    atlas_nifti=label_atlas,
+                    region_col=region_col,
+                    metric_image=in_file,
+                    measure=measure_func,
+                )["value"].to_numpy()
+                np.testing.assert_allclose(metric_df[measure_name], expected)
+                np.testing.assert_allclose(
+                    parcellations[(label, "dipy", metric, measure_name)], expected
+                )
+        metric_df = pd.read_pickle(out_files[2 * i])
+        metric_data = nib.load(in_file).get_fdata()
+        expected = [
+            (
+                np.average(
+                    metric_data[atlas_data == region],
+                    weights=gm_data[atlas_data == region],
+                )
+                if (atlas_data == region).any()
+                else np.nan
+            )
+            for region in metric_df[region_col]
+        ]
+        np.testing.assert_allclose(metric_df["weighted_mean"], expected, rtol=1e-6)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_segmented_measures():
+    rng = np.random.default_rng(42)
+    segments = []
+    for size in rng.integers(0, 50, size=30):
+        data = rng.normal(size=size)
+        if rng.random() < 0.3:
+            data = np.round(data, 1)  # ties
+        if rng.random() < 0.3:
+            data[rng.random(size) < 0.3] = np.nan
+        segments.append(data)
+    # long enough for numpy's pairwise summation to recurse
+    segments += [np.array([]), np.full(5, np.nan), np.ones(7), rng.normal(size=1000)]
+    offsets = np.concatenate([[0], np.cumsum([len(s) for s in segments])])
+    values = SegmentedValues(np.concatenate(segments), offsets)
+    assert set(SEGMENTED_MEASURES) == set(AVAILABLE_MEASURES)
+    for measure_name, measure_func in SEGMENTED_MEASURES.items():
+        expected = np.array(
+            [AVAILABLE_MEASURES[measure_name](s) for s in segments], dtype=float
+        )
+        if measure_name in ["madmedian", "nanmedian", "n_voxels"]:
+            # order statistics (and counts) involve no floating-point sums
+            np.testing.assert_array_equal(measure_func(values), expected)
+        else:
+            np.testing.assert_allclose(
+                measure_func(values), expected, rtol=1e-12, atol=1e-15
+            )
+
+
+def test_parcellate_metrics_parquet(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    metric_file = str(tmp_path / "fa.nii.gz")
+    nib.save(
+        nib.Nifti1Image(rng.random(atlas_data.shape).astype(np.float32), np.eye(4)),
+        metric_file,
+    )
+    derivatives = tmp_path / "kepost"
+    for subject in ["01", "02"]:
+        work_dir = tmp_path / "work" / subject
+        work_dir.mkdir(parents=True)
+        monkeypatch.chdir(work_dir)
+        _, out_files, _, atlas_name, _ = parcellate_metrics(
+            in_files=[metric_file],
+            softwares=["dipy"],
+            metrics=["fa"],
+            atlas_nifti=str(atlas_nifti),
+            source_file=str(
+                tmp_path / f"sub-{subject}/ses-01/dwi/sub-{subject}_ses-01_dwi.nii.gz"
+            ),
+            options={"output_format": "parquet"},
+        )
+        out_dir = (
+            derivatives
+            / f"sub-{subject}/ses-01/dwi/software-dipy/subtype-parcellations"
+            / f"atlas-{atlas_name}"
+        )
+        out_dir.mkdir(parents=True)
+        (out_dir / f"sub-{subject}_ses-01_meas-fa_parc.parquet").write_bytes(
+            open(out_files[0], "rb").read()
+        )
+
+    cohort = read_parcellations(derivatives, metric="fa", measure="nanmean")
+    assert list(cohort.columns) == PARCELLATION_COLUMNS
+    assert set(cohort["subject"]) == {"01", "02"}
+    assert set(cohort["measure"]) == {"nanmean"}
+    subject_01 = read_parcellations(derivatives, subject="01", measure="nanmean")
+    np.testing.assert_array_equal(
+        subject_01["value"], cohort.loc[cohort["subject"] == "01", "value"]
+    )
+
+    cohort_file = aggregate_parcellations(derivatives, output_format="parquet")[
+        (atlas_name, "dipy")
+    ]
+    aggregated = pd.read_parquet(cohort_file)
+    assert set(aggregated.index.get_level_values("subject")) == {"01", "02"}
+    assert len(aggregated) == len(read_parcellations(derivatives))
+
+
+def test_aggregate_parcellations(tmp_path, monkeypatch):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    derivatives = tmp_path / "kepost"
+
+    def _add_session(subject):
+        metric_file = str(tmp_path / f"fa_{subject}.nii.gz")
+        nib.save(
+            nib.Nifti1Image(rng.random(atlas_data.shape).astype(np.float32), np.eye(4)),
+            metric_file,
+        )
+        work_dir = tmp_path / "work" / subject
+        work_dir.mkdir(parents=True, exist_ok=True)
+        monkeypatch.chdir(work_dir)
+        _, out_files, _, _, _ = parcellate_metrics(
+            in_files=[metric_file],
+            softwares=["dipy"],
+            metrics=["fa"],
+            atlas_nifti=str(atlas_nifti),
+            options={"measures": ["nanmean", "n_voxels"]},
+        )
+        out_dir = (
+            derivatives
+            / f"sub-{subject}/ses-01/dwi/software-dipy/subtype-parcellations"
+            / "atlas-huang2022"
+        )
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out_file = out_dir / f"sub-{subject}_ses-01_atlas-huang2022_meas-fa_parc.pkl"
+        out_file.write_bytes(open(out_files[0], "rb").read())
+        return out_file
+
+    read_files = []
+    read_long = aggregate._read_long
+
+    def _spy(path):
+        read_files.append(path.name.split("_")[0])
+        return read_long(path)
+
+    monkeypatch.setattr(aggregate, "_read_long", _spy)
+    session_files = {"01": _add_session("01")}
+    tables = aggregate_parcellations(derivatives)
+    assert list(tables) == [("huang2022", "dipy")]
+    session_files["02"] = _add_session("02")
+    cohort_file = aggregate_parcellations(derivatives)[("huang2022", "dipy")]
+    # only the new session is read again
+    assert read_files == ["sub-01", "sub-02"]
+    cohort = pd.read_pickle(cohort_file)
+    assert cohort.index.names == [
+        "subject",
+        "session",
+        "acquisition",
+        "label",
+        "metric",
+        "measure",
+        "region",
+    ]
+    assert set(cohort.index.get_level_values("measure")) == {"nanmean", "n_voxels"}
+    expected = pd.read_pickle(session_files["02"])
+    np.testing.assert_allclose(
+        cohort.loc[("02", "01", None, "WholeBrain", "fa", "nanmean"), "value"],
+        expected.sort_values("HCPex_label")["nanmean"],
+    )
+
+    # nothing changed
+    aggregate_parcellations(derivatives)
+    assert read_files == ["sub-01", "sub-02"]
+    # a reprocessed session replaces its rows, a deleted one is dropped
+    _add_session("01")
+    session_files["02"].unlink()
+    aggregate_parcellations(derivatives)
+    assert read_files == ["sub-01", "sub-02", "sub-01"]
+    cohort = pd.read_pickle(cohort_file)
+    assert set(cohort.index.get_level_values("subject")) == {"01"}
+    assert not cohort.index.duplicated().any()
+
+
+def test_aggregate_parcellations_acquisitions(tmp_path, monkeypatch):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    metric_file = str(tmp_path / "fa.nii.gz")
+    nib.save(
+        nib.Nifti1Image(rng.random(atlas_data.shape).astype(np.float32), np.eye(4)),
+        metric_file,
+    )
+    monkeypatch.chdir(tmp_path)
+    _, out_files, _, _, _ = parcellate_metrics(
+        in_files=[metric_file],
+        softwares=["dipy"],
+        metrics=["fa"],
+        atlas_nifti=str(atlas_nifti),
+        options={"measures": ["nanmean"]},
+    )
+    derivatives = tmp_path / "kepost"
+    out_dir = (
+        derivatives
+        / "sub-01/ses-01/dwi/software-dipy/subtype-parcellations/atlas-huang2022"
+    )
+    out_dir.mkdir(parents=True)
+    parcellation = open(out_files[0], "rb").read()
+    for entities in ["acq-ap", "acq-pa"]:
+        out_file = (
+            out_dir / f"sub-01_ses-01_{entities}_atlas-huang2022_meas-fa_parc.pkl"
+        )
+        out_file.write_bytes(parcellation)
+
+    cohort_file = aggregate_parcellations(derivatives)[("huang2022", "dipy")]
+    cohort = pd.read_pickle(cohort_file)
+    assert set(cohort.index.get_level_values("acquisition")) == {"ap", "pa"}
+    assert not cohort.index.duplicated().any()
+
+    # runs of the same acquisition would collapse onto the same rows
+    out_file = out_dir / "sub-01_ses-01_acq-ap_run-2_atlas-huang2022_meas-fa_parc.pkl"
+    out_file.write_bytes(parcellation)
+    with pytest.raises(ValueError, match="share rows"):
+        aggregate_parcellations(derivatives)
+
+
+def test_parcellate_atlases():
+    rng = np.random.default_rng(42)
+    shape = (12, 12, 12)
+    atlases = {
+        "coarse": rng.integers(0, 4, size=shape),
+        "fine": rng.integers(0, 30, size=shape),
+        "blocks": np.repeat(np.arange(12) // 3 + 1, 144).reshape(shape),
+    }
+    metric_data = rng.normal(size=shape)
+    metric_data[rng.random(shape) < 0.05] = np.nan
+
+    voxel_index, offsets, atom_labels = build_atoms(list(atlases.values()))
+    assert len(atom_labels) == len(np.unique(atom_labels, axis=0))
+    for i, labels in enumerate(atom_labels):
+        atom = np.zeros(np.prod(shape), dtype=bool)
+        atom[voxel_index[offsets[i] : offsets[i + 1]]] = True
+        for j, atlas in enumerate(atlases.values()):
+            assert (atlas.ravel()[atom] == labels[j]).all()
+
+    tables = parcellate_atlases(metric_data, atlases)
+    for name, atlas in atlases.items():
+        labels, atlas_index, atlas_offsets = group_labels(atlas)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            expected = summarize_regions(
+                SegmentedValues(metric_data.ravel()[atlas_index], atlas_offsets)
+            )
+        table = tables[name]
+        assert list(table.index) == list(labels)
+        # exact for counts, means and standard deviations
+        np.testing.assert_array_equal(table["n_voxels"], expected["count"])
+        np.testing.assert_allclose(
+            table["nanmean"], expected["sum"] / expected["count"]
+        )
+        np.testing.assert_array_equal(table["min"], expected["min"])
+        np.testing.assert_array_equal(table["max"], expected["max"])
+        regions = [metric_data[atlas == label] for label in labels]
+        np.testing.assert_allclose(table["nanstd"], [np.nanstd(r) for r in regions])
+        # approximate for quantiles
+        assert (table["nanmedian"] >= table["min"]).all()
+        assert (table["nanmedian"] <= table["max"]).all()
+    # regions made of a single atom keep their exact quantiles
+    blocks = parcellate_atlases(metric_data, {"blocks": atlases["blocks"]})["blocks"]
+    np.testing.assert_allclose(
+        blocks["nanmedian"],
+        [
+            np.nanmedian(metric_data[atlases["blocks"] == label])
+            for label in range(1, 5)
+        ],
+    )
+
+
+def test_rollup_by_network():
+    _, description, region_col, index_col = get_atlas_properties("schaefer2018_100_7")
+    df = pd.read_csv(description, index_col=index_col)
+    rng = np.random.default_rng(42)
+    atlas_data = rng.choice(df[region_col].to_numpy(), size=(20, 20, 20))
+    metric_data = rng.normal(size=atlas_data.shape)
+    labels, voxel_index, offsets = group_labels(atlas_data)
+    summaries = summarize_regions(
+        SegmentedValues(metric_data.ravel()[voxel_index], offsets)
+    ).set_axis(pd.Index(labels, name=region_col))
+    networks = rollup(summaries, "schaefer2018_100_7", by="network")
+    assert set(networks.index) == set(df["network"])
+    for network, row in networks.iterrows():
+        regions = df.loc[df["network"] == network, region_col]
+        values = metric_data[np.isin(atlas_data, regions)]
+        assert row["count"] == len(values)
+        np.testing.assert_allclose(row["nanmean"], np.mean(values))
+        np.testing.assert_allclose(row["nanstd"], np.std(values))
+        assert row["min"] == values.min() and row["max"] == values.max()
+        # the merged median is approximate
+        assert abs(row["nanmedian"] - np.median(values)) < 0.05
+
+    hemispheres = rollup(summaries, "schaefer2018_100_7", by=["hemisphere", "network"])
+    assert hemispheres.index.names == ["hemisphere", "network"]
+    assert hemispheres["count"].sum() == len(voxel_index)
+
+
+def test_parcellate_metrics_grid_mismatch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(np.ones((10, 10, 10), np.int16), np.eye(4)), atlas_nifti)
+    metric_file = str(tmp_path / "fa.nii.gz")
+    nib.save(nib.Nifti1Image(np.ones((8, 8, 8), np.float32), np.eye(4)), metric_file)
+    with pytest.raises(ValueError, match="grid"):
+        parcellate_metrics(
+            in_files=[metric_file],
+            softwares=["dipy"],
+            metrics=["fa"],
+            atlas_nifti=str(atlas_nifti),
+        )
+    with pytest.raises(ValueError, match="Unknown parcellation option"):
+        parcellate_metrics(
+            in_files=[metric_file],
+            softwares=["dipy"],
+            metrics=["fa"],
+            atlas_nifti=str(atlas_nifti),
+            options={"gm_treshold": 0.5},
+        )
+
+
+def test_parcellate_metrics_fod(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    fod_data = rng.random(atlas_data.shape + (45,)).astype(np.float32)
+    nib.save(nib.Nifti1Image(fod_data, np.eye(4)), tmp_path / "wm_fod.nii.gz")
+    nib.save(nib.Nifti1Image(fod_data[..., 0], np.eye(4)), tmp_path / "afd.nii.gz")
+    parcellations = [
+        pd.read_pickle(
+            parcellate_metrics(
+                in_files=[str(tmp_path / in_file)],
+                softwares=["mrtrix3"],
+                metrics=["afd"],
+                atlas_nifti=str(atlas_nifti),
+                options={"measures": ["nanmean", "nanmedian"]},
+            )[0]
+        )
+        for in_file in ["wm_fod.nii.gz", "afd.nii.gz"]
+    ]
+    # the l=0 volume of the FOD is parcellated
+    pd.testing.assert_frame_equal(*parcellations)
+
+
+def test_register_measure(monkeypatch):
+    monkeypatch.setattr(
+        "kepost.workflows.diffusion.procedures.parcellations.available_measures."
+        "MEASURES_REGISTRY",
+        dict(MEASURES_REGISTRY),
+    )
+    offsets = np.array([0, 3, 7])
+    values = SegmentedValues(np.array([1, 2, 3, 4, 5, np.nan, 6.0]), offsets)
+
+    # a scalar-only measure falls back to one region at a time
+    register_measure("nanmax", scalar=np.nanmax)
+    with pytest.raises(ValueError, match="already registered"):
+        register_measure("nanmax", scalar=np.nanmax)
+    register_measure(
+        "nanmax",
+        segmented=lambda s: s.take_sorted(s.offsets[:-1] + s.counts - 1),
+        scalar=np.nanmax,
+        overwrite=True,
+    )
+    with pytest.raises(ValueError, match="not available"):
+        get_measures(["nanmean", "unknown"])
+
+    results = compute_measures(values, ["nanmean", "nanmax"])
+    assert list(results) == ["nanmean", "nanmax"]
+    np.testing.assert_array_equal(results["nanmax"], [3, 6])
+    register_measure("nanmin", scalar=np.nanmin)
+    np.testing.assert_array_equal(compute_measures(values, "nanmin")["nanmin"], [1, 4])
+    assert set(get_measures("all")) == set(MEASURES_REGISTRY) | {"nanmax", "nanmin"}
+
+
+def _weighted_median(data, weights):
+    keep = ~np.isnan(data) & (weights > 0)
+    order = np.argsort(data[keep])
+    data, cumulative = data[keep][order], np.cumsum(weights[keep][order])
+    return data[np.searchsorted(cumulative, cumulative[-1] / 2)]
+
+
+def test_weighted_measures():
+    rng = np.random.default_rng(42)
+    sizes = rng.integers(1, 50, size=20)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    data = rng.normal(size=offsets[-1])
+    data[rng.random(len(data)) < 0.1] = np.nan
+    weights = rng.random(len(data))
+    values = SegmentedValues(data, offsets, weights)
+    results = compute_measures(values, list(WEIGHTED_MEASURES))
+    for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+        x, w = data[start:stop], weights[start:stop]
+        keep = ~np.isnan(x)
+        mean = np.average(x[keep], weights=w[keep])
+        np.testing.assert_allclose(results["weighted_mean"][i], mean)
+        np.testing.assert_allclose(
+            results["weighted_std"][i],
+            np.sqrt(np.average((x[keep] - mean) ** 2, weights=w[keep])),
+        )
+        assert results["weighted_median"][i] == _weighted_median(x, w)
+
+    # uniform weights reduce to the unweighted measures
+    uniform = compute_measures(
+        SegmentedValues(data, offsets, np.ones_like(data)),
+        ["weighted_mean", "weighted_std"],
+    )
+    np.testing.assert_allclose(
+        uniform["weighted_mean"], SEGMENTED_MEASURES["nanmean"](values)
+    )
+    np.testing.assert_allclose(
+        uniform["weighted_std"], SEGMENTED_MEASURES["nanstd"](values)
+    )
+    # without weights, they are not defined
+    unweighted = SegmentedValues(data, offsets)
+    assert not set(WEIGHTED_MEASURES) & set(compute_measures(unweighted, "all"))
+    for name, result in compute_measures(unweighted, list(WEIGHTED_MEASURES)).items():
+        assert np.isnan(result).all(), name
+
+
+def _naive_bootstrap(values, measures, n_resamples, seed):
+    """Bootstrap one resample and region at a time, with the scalar measures."""
+    rng = np.random.default_rng(seed)
+    sizes = np.diff(values.offsets)
+    starts = np.repeat(values.offsets[:-1], sizes)
+    resamples = {measure: [] for measure in measures}
+    for _ in range(n_resamples):
+        # the same draws: positions within each region's sorted values
+        resample = values.sorted_values[
+            starts + rng.integers(0, np.repeat(sizes, sizes))
+        ]
+        for measure in measures:
+            resamples[measure].append(
+                [
+                    AVAILABLE_MEASURES[measure](resample[start:stop])
+                    for start, stop in zip(values.offsets[:-1], values.offsets[1:])
+                ]
+            )
+    return {
+        measure: np.nanpercentile(
+            np.array(resamples[measure], dtype=float), [2.5, 97.5], axis=0
+        )
+        for measure in measures
+    }
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_bootstrap_measures():
+    rng = np.random.default_rng(42)
+    sizes = np.array([30, 0, 12, 1, 25])
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    data = rng.normal(size=offsets[-1])
+    data[offsets[4] : offsets[4] + 5] = np.nan
+    values = SegmentedValues(data, offsets)
+    measures = ["nanmedian", "zfmean", "madmedian", "qfmean"]
+    expected = _naive_bootstrap(values, measures, n_resamples=50, seed=0)
+    # one resample per batch, and all resamples in one batch
+    for max_batch_values in [1, 2**24]:
+        intervals = bootstrap_measures(
+            values, measures, n_resamples=50, seed=0, max_batch_values=max_batch_values
+        )
+        for measure in measures:
+            lower, upper = intervals[measure]
+            np.testing.assert_allclose(lower, expected[measure][0])
+            np.testing.assert_allclose(upper, expected[measure][1])
+            assert np.isnan(lower[1]) and np.isnan(upper[1])
+            assert np.all((lower <= upper)[~np.isnan(lower)])
+    # a single voxel always resamples to itself
+    assert intervals["nanmedian"][0][3] == intervals["nanmedian"][1][3] == data[42]
+
+    # seeded results are deterministic
+    again = bootstrap_measures(values, measures, n_resamples=50, seed=0)
+    for measure in measures:
+        np.testing.assert_array_equal(intervals[measure][0], again[measure][0])
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_bootstrap_measures_speed():
+    rng = np.random.default_rng(42)
+    offsets = np.concatenate([[0], np.cumsum(rng.integers(50, 500, size=100))])
+    values = SegmentedValues(rng.normal(size=offsets[-1]), offsets)
+    measures = ["nanmedian", "zfmean", "madmedian"]
+    start = time.perf_counter()
+    _naive_bootstrap(values, measures, n_resamples=20, seed=0)
+    naive = time.perf_counter() - start
+    batched = np.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        bootstrap_measures(values, measures, n_resamples=20, seed=0)
+        batched = min(batched, time.perf_counter() - start)
+    # batching must not bring back a per-resample sort (or per-region loop)
+    assert batched < naive / 2
+
+
+def test_sample_regions():
+    rng = np.random.default_rng(42)
+    values = rng.random(100)
+    values[::7] = np.nan
+    offsets = np.array([0, 5, 5, 60, 100])
+    segments = SegmentedValues(values, offsets)
+    samples = sample_regions(segments, size=10, seed=42)
+    np.testing.assert_array_equal(
+        np.diff(samples.offsets), np.minimum(segments.counts, 10)
+    )
+    assert not samples.isnan.any()
+    for i in range(segments.n_segments):
+        sampled = samples.values[samples.offsets[i] : samples.offsets[i + 1]]
+        region = values[offsets[i] : offsets[i + 1]]
+        assert np.isin(sampled, region).all()
+        assert len(np.unique(sampled)) == len(sampled)
+    # small regions are kept whole
+    np.testing.assert_array_equal(
+        samples.values[: samples.offsets[1]], values[:5][~np.isnan(values[:5])]
+    )
+    np.testing.assert_array_equal(
+        sample_regions(segments, size=10, seed=42).values, samples.values
+    )
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_parcellation_samples(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    atlas_nifti = tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz"
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    metric_file = str(tmp_path / "fa.nii.gz")
+    nib.save(
+        nib.Nifti1Image(rng.random(atlas_data.shape).astype(np.float32), np.eye(4)),
+        metric_file,
+    )
+    _, out_files, _, _, sample_files = parcellate_metrics(
+        in_files=[metric_file],
+        softwares=["dipy"],
+        metrics=["fa"],
+        atlas_nifti=str(atlas_nifti),
+        options={"seed": 42, "sample_size": 1000},
+    )
+    out_dir = (
+        tmp_path
+        / "kepost/sub-01/ses-01/dwi/software-dipy/subtype-parcellations/atlas-huang2022"
+    )
+    out_dir.mkdir(parents=True)
+    (out_dir / "sub-01_ses-01_desc-samples_meas-fa_parc.pkl").write_bytes(
+        open(sample_files[0], "rb").read()
+    )
+    samples = read_samples(tmp_path / "kepost", metric="fa")
+    assert set(samples["subject"]) == {"01"}
+    assert samples["value"].dtype == np.float32
+    # the regions are smaller than the samples, which hold all their voxels
+    evaluated = evaluate_samples(samples, ["nanmean", "n_voxels"])
+    _, _, region_col, _ = get_atlas_properties("huang2022")
+    expected = pd.read_pickle(out_files[0]).set_index(region_col)
+    regions = evaluated.index.get_level_values("region")
+    np.testing.assert_allclose(
+        evaluated["nanmean"], expected.loc[regions, "nanmean"], rtol=1e-6
+    )
+    np.testing.assert_array_equal(
+        evaluated["n_voxels"], expected.loc[regions, "n_voxels"]
+    )
+    # unweighted samples have no weights, nor weighted measures
+    assert samples["weight"].isna().all()
+    evaluated = evaluate_samples(samples)
+    assert not [column for column in evaluated if column.startswith("weighted_")]
+    np.testing.assert_allclose(
+        evaluated["nanmean"], expected.loc[regions, "nanmean"], rtol=1e-6
+    )
+
+
+def test_evaluate_samples_weighted():
+    samples = pd.DataFrame(
+        {
+            "region": [1, 1, 1, 2, 2],
+            "value": [1.0, 2.0, 4.0, 3.0, 5.0],
+            "weight": [1.0, 1.0, 2.0, np.nan, np.nan],
+        }
+    )
+    evaluated = evaluate_samples(samples)
+    assert list(evaluated.index) == [1, 2]
+    assert evaluated.loc[1, "weighted_mean"] == 11 / 4
+    assert np.isnan(evaluated.loc[2, "weighted_mean"])
+    np.testing.assert_array_equal(evaluated["nanmean"], [7 / 3, 4])
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_parcellate_metrics_atlases(tmp_path, monkeypatch):
+    rng = np.random.default_rng(42)
+    atlas_niftis = []
+    for atlas, n_labels in [("huang2022", 20), ("fan2016", 30)]:
+        atlas_niftis.append(str(tmp_path / f"sub-01_space-dwi_atlas-{atlas}_dseg.nii"))
+        atlas_data = rng.integers(0, n_labels, size=(10, 10, 10)).astype(np.int16)
+        nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_niftis[-1])
+    in_files = []
+    for metric in ["fa", "md"]:
+        in_files.append(str(tmp_path / f"{metric}.nii.gz"))
+        metric_data = rng.random((10, 10, 10)).astype(np.float32)
+        nib.save(nib.Nifti1Image(metric_data, np.eye(4)), in_files[-1])
+    options = {"seed": 42, "sample_size": 8, "bootstrap": ["nanmean"]}
+    options.update(n_resamples=20)
+    inputs = dict(softwares=["dipy", "dipy"], metrics=["fa", "md"], options=options)
+
+    (tmp_path / "batched").mkdir()
+    monkeypatch.chdir(tmp_path / "batched")
+    out_file, out_files, _, atlas_name, sample_files = parcellate_metrics_atlases(
+        in_files=in_files, atlas_niftis=atlas_niftis, n_threads=2, **inputs
+    )
+    assert len(out_file) == 2
+    assert atlas_name == ["huang2022"] * 2 + ["fan2016"] * 2
+    # the same tables (and samples) as parcellating atlas by atlas
+    for i, atlas_nifti in enumerate(atlas_niftis):
+        (tmp_path / str(i)).mkdir()
+        monkeypatch.chdir(tmp_path / str(i))
+        expected_file, expected_files, _, _, expected_samples = parcellate_metrics(
+            in_files=in_files, atlas_nifti=atlas_nifti, **inputs
+        )
+        pd.testing.assert_frame_equal(
+            pd.read_pickle(out_file[i]), pd.read_pickle(expected_file)
+        )
+        for batched, expected in zip(
+            out_files[2 * i : 2 * i + 2] + sample_files[2 * i : 2 * i + 2],
+            expected_files + expected_samples,
+        ):
+            pd.testing.assert_frame_equal(
+                pd.read_pickle(batched), pd.read_pickle(expected)
+            )
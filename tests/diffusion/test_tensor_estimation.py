@@ -1,8 +1,15 @@
+import nibabel as nib
+import numpy as np
 import pytest
 
+from kepost import config
 from kepost.workflows.diffusion.procedures.tensor_estimations.dipy import (
+    TENSOR_PARAMETERS,
     init_dipy_tensor_wf,
 )
+from kepost.workflows.diffusion.procedures.tensor_estimations.dipy.utils import (
+    fit_tensor,
+)
 from kepost.workflows.diffusion.procedures.tensor_estimations.mrtrix3 import (
     init_mrtrix3_tensor_wf,
 )
@@ -44,6 +51,9 @@ def test_inputnode_fields(tensor_wf):
         "native_to_mni_transform",
         "dwi_to_t1w_transform",
         "t1w_reference",
+        "atlas_nifti",
+        "atlas_index",
+        "gm_probseg",
     ]
 
 
@@ -66,6 +76,9 @@ def test_dipy_inputnode_fields(dipy_wf):
         "native_to_mni_transform",
         "dwi_to_t1w_transform",
         "t1w_reference",
+        "atlas_nifti",
+        "atlas_index",
+        "gm_probseg",
     ]
 
 
@@ -86,3 +99,68 @@ def test_mrtrix3_inputnode_fields(mrtrix3_wf):
         "max_bval",
         "wm_mask",
     ]
+
+
+def test_dipy_uncompressed_tensor_maps(tmp_path, monkeypatch):
+    from neuromaps import datasets
+
+    # any existing image serves as the standard-space reference
+    reference = tmp_path / "mni.nii.gz"
+    nib.save(nib.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4)), reference)
+    monkeypatch.setattr(
+        datasets, "fetch_atlas", lambda **kwargs: {"2009cAsym_T1w": str(reference)}
+    )
+    monkeypatch.setattr(config.workflow, "uncompressed_tensor_maps", True)
+    workflow = init_dipy_tensor_wf()
+    tensor_node = workflow.get_node("dipy_tensor_wf")
+    assert "def fit_tensor(" in tensor_node.inputs.function_str
+    # the sinks compress the maps instead
+    assert workflow.get_node("ds_tensor_wf").inputs.compress == [True]
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_fit_tensor(tmp_path, monkeypatch):
+    from dipy.workflows.reconst import ReconstDtiFlow
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    shape = (8, 8, 8)
+    bvals = np.array([0] + [1000] * 12)
+    bvecs = np.vstack([np.zeros(3), rng.normal(size=(12, 3))])
+    bvecs[1:] /= np.linalg.norm(bvecs[1:], axis=1, keepdims=True)
+    np.savetxt(tmp_path / "dwi.bval", bvals[None], fmt="%d")
+    np.savetxt(tmp_path / "dwi.bvec", bvecs.T)
+    # axis-aligned tensors of varying diffusivities
+    evals = np.array([1.5e-3, 0.4e-3, 0.4e-3]) * rng.uniform(0.5, 1.5, shape + (1,))
+    signal = 1000 * np.exp(-bvals * np.einsum("ij,...j->...i", bvecs**2, evals))
+    dwi = (signal + rng.normal(0, 5, signal.shape)).astype(np.float32)
+    dwi_nifti = str(tmp_path / "dwi.nii.gz")
+    nib.save(nib.Nifti1Image(dwi, np.eye(4)), dwi_nifti)
+    mask_file = str(tmp_path / "mask.nii.gz")
+    nib.save(nib.Nifti1Image(np.ones(shape, dtype=np.uint8), np.eye(4)), mask_file)
+
+    map_files = fit_tensor(
+        in_file=dwi_nifti,
+        in_bvec=str(tmp_path / "dwi.bvec"),
+        in_bval=str(tmp_path / "dwi.bval"),
+        mask_file=mask_file,
+        fit_method="WLS",
+    )
+    assert len(map_files) == len(TENSOR_PARAMETERS)
+    # the maps are left uncompressed, for the parcellation to memory-map
+    assert all(map_file.endswith(".nii") for map_file in map_files)
+    # the same maps as the (compressed) tensor fit
+    ReconstDtiFlow().run(
+        input_files=dwi_nifti,
+        bvalues_files=str(tmp_path / "dwi.bval"),
+        bvectors_files=str(tmp_path / "dwi.bvec"),
+        mask_files=mask_file,
+        fit_method="WLS",
+        out_dir=str(tmp_path / "reference"),
+    )
+    for param, map_file in zip(TENSOR_PARAMETERS, map_files):
+        np.testing.assert_allclose(
+            nib.load(map_file).get_fdata(),
+            nib.load(tmp_path / "reference" / f"{param}.nii.gz").get_fdata(),
+            rtol=1e-5,
+        )
@@ -1,6 +1,10 @@
 import pytest
 
+from kepost import config
 from kepost.workflows.diffusion.procedures import init_tractography_wf
+from kepost.workflows.diffusion.procedures.tractography.tractography import (
+    tractography_maps,
+)
 
 
 @pytest.fixture
@@ -24,3 +28,15 @@ def test_tractography_inputnode_fields(tractography_wf):
         "dwi_mask",
         "five_tissue_type",
     ]
+
+
+def test_tractography_maps(monkeypatch):
+    monkeypatch.setattr(config.workflow, "det_tracking_algorithm", "SD_Stream")
+    monkeypatch.setattr(config.workflow, "prob_tracking_algorithm", "iFOD2")
+    assert tractography_maps() == [
+        "afd",
+        "tdiSDStream",
+        "sift2tdiSDStream",
+        "tdiiFOD2",
+        "sift2tdiiFOD2",
+    ]
@@ -1,7 +1,37 @@
 from pathlib import Path
 
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
 from kepost.atlases.available_atlases import AVAILABLE_ATLASES
-from kepost.atlases.utils import get_atlas_properties
+from kepost.atlases.available_atlases.available_atlases import (
+    AtlasStore,
+    pack_atlases,
+)
+from kepost.atlases.utils import (
+    LOOKUP_AFFINE,
+    LOOKUP_SHAPE,
+    cache_key,
+    cached_file,
+    fsl_to_itk,
+    gather_labels,
+    get_atlas_index,
+    get_atlas_overlap,
+    get_atlas_properties,
+    get_atlas_resolution,
+    group_labels,
+    load_label_index,
+    overlap_matrices,
+    parcellate,
+    parcellate_volumes,
+    save_label_index,
+    select_atlas_resolution,
+    select_labels,
+    warp_labels,
+    write_lookup_source,
+)
 
 
 def test_available_atlases():
@@ -29,3 +59,450 @@ def test_atlas_properties():
         assert isinstance(region_col, str)
         if index_col is not None:
             assert isinstance(index_col, int)
+
+
+def test_group_labels():
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 6, size=(8, 9, 10)).astype(float)
+    labels, voxel_index, offsets = group_labels(atlas_data, [1, 2, 3, 4, 5, 7])
+    assert list(labels) == [1, 2, 3, 4, 5, 7]
+    for i, label in enumerate(labels):
+        region_voxels = voxel_index[offsets[i] : offsets[i + 1]]
+        assert np.array_equal(region_voxels, np.flatnonzero(atlas_data == label))
+
+
+def test_parcellate_matches_region_masks(tmp_path):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 6, size=(8, 9, 10)).astype(np.int16)
+    metric_data = rng.normal(size=atlas_data.shape)
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(metric_data, np.eye(4)), tmp_path / "metric.nii.gz")
+    pd.DataFrame({"index": [1, 2, 3, 4, 5, 7]}).to_csv(tmp_path / "atlas.csv")
+    df = parcellate(
+        atlas_description=tmp_path / "atlas.csv",
+        index_col=0,
+        atlas_nifti=tmp_path / "atlas.nii.gz",
+        region_col="index",
+        metric_image=tmp_path / "metric.nii.gz",
+        measure=np.nanmedian,
+    )
+    expected = [np.nanmedian(metric_data[atlas_data == i]) for i in [1, 2, 3, 4, 5]]
+    assert np.array_equal(df["value"].to_numpy()[:5], expected)
+    assert np.isnan(df["value"].to_numpy()[5])
+
+
+def test_label_index(tmp_path):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 6, size=(8, 9, 10)).astype(np.int16)
+    metric_data = rng.normal(size=atlas_data.shape)
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), tmp_path / "atlas.nii.gz")
+    nib.save(nib.Nifti1Image(metric_data, np.eye(4)), tmp_path / "metric.nii.gz")
+    index_file = save_label_index(tmp_path / "atlas.nii.gz", tmp_path / "index.npz")
+    labels, voxel_index, offsets, shape = load_label_index(index_file)
+    assert isinstance(voxel_index, np.memmap)
+    assert shape == atlas_data.shape
+    for loaded, expected in zip(
+        [labels, voxel_index, offsets], group_labels(atlas_data)
+    ):
+        np.testing.assert_array_equal(loaded, expected)
+
+    selected, selected_index, selected_offsets = select_labels(
+        labels, voxel_index, offsets, [2, 4, 7]
+    )
+    np.testing.assert_array_equal(selected, [2, 4, 7])
+    for i, label in enumerate(selected):
+        np.testing.assert_array_equal(
+            selected_index[selected_offsets[i] : selected_offsets[i + 1]],
+            np.flatnonzero(atlas_data.ravel() == label),
+        )
+
+    pd.DataFrame({"index": [1, 2, 3, 4, 5, 7]}).to_csv(tmp_path / "atlas.csv")
+    kwargs = dict(
+        atlas_description=tmp_path / "atlas.csv",
+        index_col=0,
+        atlas_nifti=tmp_path / "atlas.nii.gz",
+        region_col="index",
+        metric_image=tmp_path / "metric.nii.gz",
+        measure=np.nanmedian,
+    )
+    pd.testing.assert_frame_equal(
+        parcellate(**kwargs, atlas_index=index_file), parcellate(**kwargs)
+    )
+
+
+def test_get_atlas_index(tmp_path):
+    index_file = get_atlas_index("huang2022", cache_dir=tmp_path)
+    assert Path(index_file).parent == tmp_path
+    mtime = Path(index_file).stat().st_mtime_ns
+    # cached: the index is not computed again
+    assert get_atlas_index("huang2022", cache_dir=tmp_path) == index_file
+    assert Path(index_file).stat().st_mtime_ns == mtime
+    nifti, _, _, _ = get_atlas_properties("huang2022")
+    atlas_data = np.asanyarray(nib.load(nifti).dataobj)
+    labels, voxel_index, offsets, shape = load_label_index(index_file)
+    assert shape == atlas_data.shape
+    np.testing.assert_array_equal(offsets, group_labels(atlas_data)[2])
+
+
+def test_parcellate_volumes(tmp_path):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 6, size=(8, 9, 10)).astype(np.int16)
+    dwi_data = rng.normal(size=atlas_data.shape + (7,)).astype(np.float32)
+    dwi_data[0, 0, 0, 2] = np.nan
+    nib.save(nib.Nifti1Image(dwi_data, np.eye(4)), tmp_path / "dwi.nii.gz")
+    labels, voxel_index, offsets = group_labels(atlas_data, [1, 2, 3, 4, 5, 7])
+
+    expected = np.array(
+        [
+            [
+                np.nanmean(dwi_data[..., volume][atlas_data == label])
+                for volume in range(dwi_data.shape[-1])
+            ]
+            for label in labels[:-1]
+        ]
+    )
+    for slab_size in [1, 3, 7]:
+        signal = parcellate_volumes(
+            tmp_path / "dwi.nii.gz", voxel_index, offsets, slab_size=slab_size
+        )
+        assert signal.shape == (len(labels), dwi_data.shape[-1])
+        np.testing.assert_allclose(signal[:-1], expected, rtol=1e-5)
+        # label 7 has no voxels
+        assert np.isnan(signal[-1]).all()
+
+
+def test_parcellate_volumes_compressed(tmp_path, monkeypatch):
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 4, size=(6, 7, 5)).astype(np.int16)
+    dwi_data = rng.integers(-1000, 1000, size=atlas_data.shape + (9,))
+    img = nib.Nifti1Image(dwi_data.astype(np.int16), np.eye(4))
+    img.header.set_slope_inter(0.5, 10.0)
+    nib.save(img, tmp_path / "dwi.nii.gz")
+    expected = np.asanyarray(nib.load(tmp_path / "dwi.nii.gz").dataobj)
+    labels, voxel_index, offsets = group_labels(atlas_data)
+
+    # the series is read in one pass instead of one proxy slice per slab
+    def no_slicing(self, slicer):
+        raise AssertionError("the proxy was sliced")
+
+    monkeypatch.setattr(nib.arrayproxy.ArrayProxy, "__getitem__", no_slicing)
+    signal = parcellate_volumes(tmp_path / "dwi.nii.gz", voxel_index, offsets, 4)
+    np.testing.assert_allclose(
+        signal,
+        [expected[atlas_data == label].mean(axis=0) for label in labels],
+    )
+
+
+def test_overlap_matrices():
+    rng = np.random.default_rng(42)
+    atlases = {
+        "a": rng.integers(0, 5, size=(8, 9, 10)),
+        "b": rng.integers(0, 7, size=(8, 9, 10)),
+        "c": np.zeros((8, 9, 10), dtype=int),
+    }
+    labels, overlaps = overlap_matrices(atlases)
+    assert list(overlaps) == [("a", "b"), ("a", "c"), ("b", "c")]
+    assert overlaps[("a", "c")].shape == (4, 0)
+    expected = np.array(
+        [
+            [np.sum((atlases["a"] == i) & (atlases["b"] == j)) for j in labels["b"]]
+            for i in labels["a"]
+        ]
+    )
+    np.testing.assert_array_equal(overlaps[("a", "b")].toarray(), expected)
+
+
+def test_get_atlas_overlap(tmp_path):
+    overlap, labels_a, labels_b = get_atlas_overlap(
+        "schaefer2018_100_7", "schaefer2018_100_17", cache_dir=tmp_path
+    )
+    (overlap_file,) = tmp_path.iterdir()
+    mtime = overlap_file.stat().st_mtime_ns
+    cached, cached_a, cached_b = get_atlas_overlap(
+        "schaefer2018_100_7", "schaefer2018_100_17", cache_dir=tmp_path
+    )
+    assert overlap_file.stat().st_mtime_ns == mtime
+    assert (overlap != cached).nnz == 0
+    np.testing.assert_array_equal(labels_a, cached_a)
+    # both atlases label the same voxels
+    nifti, _, _, _ = get_atlas_properties("schaefer2018_100_7")
+    atlas_data = np.asanyarray(nib.load(nifti).dataobj)
+    assert overlap.sum() == np.count_nonzero(atlas_data)
+    np.testing.assert_array_equal(
+        np.asarray(overlap.sum(axis=1)).ravel(),
+        np.bincount(atlas_data.ravel().astype(int))[1:],
+    )
+
+
+def test_atlas_lookup(tmp_path, monkeypatch):
+    from nibabel.processing import resample_from_to
+
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    lookup_source = nib.load(write_lookup_source())
+    # a (rotated, coarser) target grid; nearest-neighbour resampling stands in
+    # for the subject's transforms
+    rotation = np.array([[0.98, -0.2, 0], [0.2, 0.98, 0], [0, 0, 1]]) * 2.5
+    target_affine = np.eye(4)
+    target_affine[:3, :3] = rotation
+    target_affine[:3, 3] = [-40, -60, -50]
+    target = ((40, 40, 40), target_affine)
+    lookup_file = str(tmp_path / "lookup.nii.gz")
+    nib.save(resample_from_to(lookup_source, target, order=0), lookup_file)
+    # atlases on the lookup grid, and on another (flipped) one
+    fsl_affine = np.diag([-1.0, 1.0, 1.0, 1.0])
+    fsl_affine[:3, 3] = [90, -126, -72]
+    grids = [(LOOKUP_SHAPE, LOOKUP_AFFINE), ((182, 218, 182), fsl_affine)]
+    for i, (shape, affine) in enumerate(grids):
+        atlas_img = nib.Nifti1Image(
+            rng.integers(0, 50, size=shape).astype(np.int16), affine
+        )
+        atlas_nifti = str(tmp_path / f"atlas-{i}_dseg.nii.gz")
+        nib.save(atlas_img, atlas_nifti)
+        expected = resample_from_to(
+            resample_from_to(atlas_img, (LOOKUP_SHAPE, LOOKUP_AFFINE), order=0),
+            target,
+            order=0,
+        )
+        out_file = warp_labels(atlas_nifti, lookup_file)
+        assert Path(out_file).name == f"atlas-{i}_dseg_trans.nii.gz"
+        warped = nib.load(out_file)
+        np.testing.assert_allclose(warped.affine, target_affine)
+        np.testing.assert_array_equal(
+            np.asanyarray(warped.dataobj), np.asanyarray(expected.dataobj)
+        )
+    # outside of the lookup's field of view
+    assert (gather_labels(np.ones(LOOKUP_SHAPE), LOOKUP_AFFINE, np.zeros(3)) == 0).all()
+
+
+def test_atlas_cache(tmp_path, monkeypatch):
+    import os
+
+    cache_dir = tmp_path / "cache"
+    inputs = []
+    for i in range(3):
+        inputs.append(tmp_path / f"input-{i}.txt")
+        inputs[-1].write_text(f"input {i}")
+    writes = []
+
+    def write(out_file):
+        writes.append(out_file)
+        Path(out_file).write_bytes(b"x" * 1024)
+
+    keys = [cache_key([in_file]) for in_file in inputs]
+    assert keys[0] == cache_key([tmp_path / "input-0.txt"])
+    assert cache_key([inputs[0]], tool="ants") != keys[0]
+    # a re-run (in another working directory) reuses the cached output
+    for run in ["run-1", "run-2"]:
+        (tmp_path / run).mkdir()
+        monkeypatch.chdir(tmp_path / run)
+        out_file = cached_file(keys[0], "atlas_trans.nii.gz", write, cache_dir)
+        assert out_file == str(tmp_path / run / "atlas_trans.nii.gz")
+        assert Path(out_file).read_bytes() == b"x" * 1024
+    assert len(writes) == 1
+    # the least recently used entries are evicted beyond the cache's size
+    entries = {}
+    for i, key in enumerate(keys):
+        cached_file(key, "atlas_trans.nii.gz", write, cache_dir)
+        entries[i] = cache_dir / f"{key[:16]}_atlas_trans.nii.gz"
+        os.utime(entries[i], (i, i))
+    cached_file(keys[1], "atlas_trans.nii.gz", write, cache_dir, 2.5 / 1024**2)
+    assert not entries[0].exists()
+    assert entries[1].exists() and entries[2].exists()
+    assert len(writes) == 3
+    # an entry evicted (by another run) right after it is used is a miss
+    utime = os.utime
+
+    def evicting_utime(path, *args):
+        utime(path, *args)
+        Path(path).unlink()
+
+    monkeypatch.setattr(os, "utime", evicting_utime)
+    out_file = cached_file(keys[2], "atlas_trans.nii.gz", write, cache_dir)
+    assert Path(out_file).read_bytes() == b"x" * 1024
+    assert len(writes) == 4
+
+
+def test_atlas_cache_nodes(tmp_path, monkeypatch):
+    from nipype.utils.functions import create_function_from_source
+
+    from kepost import config
+    from kepost.workflows.anatomical.procedures.register_atlas import (
+        init_registration_wf,
+    )
+    from kepost.workflows.diffusion.procedures.coregisterations import (
+        init_coregistration_wf,
+    )
+
+    monkeypatch.setattr(config.execution, "atlas_cache_dir", tmp_path / "cache")
+    for workflow, name in [
+        (init_registration_wf(), "apply_transforms"),
+        (init_coregistration_wf(), "apply_transforms_wholebrain"),
+    ]:
+        node = workflow.get_node(name)
+        assert node.inputs.cache_dir == str(tmp_path / "cache")
+        # the node's function runs without the module's globals
+        create_function_from_source(node.inputs.function_str, node.interface.imports)
+
+
+def test_fsl_to_itk(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # a RAS-oriented T1w (flipped by FSL) and an LAS-oriented DWI reference
+    t1w_affine = np.array(
+        [[1, 0, 0, -90], [0, 1, 0, -120], [0, 0, 1, -70], [0, 0, 0, 1]]
+    )
+    dwi_affine = np.array(
+        [[-2, 0, 0, 100], [0, 2, 0, -110], [0, 0, 2, -60], [0, 0, 0, 1]]
+    )
+    nib.save(nib.Nifti1Image(np.zeros((180, 220, 160)), t1w_affine), "t1w.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((96, 110, 70)), dwi_affine), "dwi.nii.gz")
+    angle = np.deg2rad(8)
+    matrix = np.array(
+        [
+            [np.cos(angle), -np.sin(angle), 0, 4],
+            [np.sin(angle), np.cos(angle), 0, -6],
+            [0, 0, 1, 3],
+            [0, 0, 0, 1],
+        ]
+    )
+    np.savetxt("t1w_to_dwi.mat", matrix)
+    itk_file = fsl_to_itk("t1w_to_dwi.mat", "dwi.nii.gz", "t1w.nii.gz")
+
+    # FSL maps the T1w's scaled voxel coordinates to the DWI's ones
+    def scaled(affine, shape):
+        scaling = np.diag(list(np.abs(np.diag(affine)[:3])) + [1])
+        if np.linalg.det(affine[:3, :3]) > 0:
+            flip = np.diag([-1, 1, 1, 1])
+            flip[0, 3] = shape[0] - 1
+            scaling = scaling @ flip
+        return scaling
+
+    voxels = np.array([[10, 20, 30, 1], [50, 5, 60, 1], [0, 0, 0, 1]]).T
+    expected = (
+        t1w_affine
+        @ np.linalg.inv(scaled(t1w_affine, (180, 220, 160)))
+        @ np.linalg.inv(matrix)
+        @ scaled(dwi_affine, (96, 110, 70))
+        @ voxels
+    )
+    # ANTs maps the DWI's (LPS) points to the T1w's ones
+    line = Path(itk_file).read_text().split("Parameters: ")[1].splitlines()[0]
+    parameters = np.array(line.split(), dtype=float)
+    itk = np.eye(4)
+    itk[:3, :3] = parameters[:9].reshape(3, 3)
+    itk[:3, 3] = parameters[9:]
+    lps = np.diag([-1, -1, 1, 1])
+    np.testing.assert_allclose(
+        lps @ itk @ lps @ dwi_affine @ voxels, expected, atol=1e-3
+    )
+
+
+def test_atlas_store(tmp_path):
+    rng = np.random.default_rng(42)
+    atlases = {}
+    for name in ["a", "b"]:
+        niftis = {}
+        for resolution, shape in [(1.0, (6, 7, 8)), (2.0, (3, 4, 4))]:
+            niftis[resolution] = (
+                tmp_path / f"space-MNI152_atlas-{name}_res-{resolution:g}mm_dseg.nii.gz"
+            )
+            labels = rng.integers(0, 300, shape).astype(float)
+            nib.save(
+                nib.Nifti1Image(labels, np.diag([resolution] * 3 + [1])),
+                niftis[resolution],
+            )
+        description = tmp_path / f"space-MNI152_atlas-{name}_res-1mm_dseg.csv"
+        description.write_text("index,name\n1,region\n")
+        atlases[name] = {
+            "nifti": niftis[1.0],
+            "resolutions": niftis,
+            "description_file": description,
+            "region_col": "index",
+            "index_col": 0,
+        }
+    archive = pack_atlases({"a": atlases["a"]}, tmp_path / "atlases.npz")
+    cache_dir = tmp_path / "cache"
+    built = []
+    loose = {"a": atlases["a"], "b": lambda: built.append("b") or atlases["b"]}
+    store = AtlasStore(loose, archive=archive, cache_dir=cache_dir)
+    assert list(store) == ["a", "b"] and store.packed == {"a"}
+    # listed without being built, resolved (and unpacked) lazily
+    assert not built and not cache_dir.exists()
+    assert store["b"] == atlases["b"] and built == ["b"]
+    assert not cache_dir.exists()
+    entry = store["a"]
+    assert entry["nifti"].parent.parent == cache_dir
+    assert entry["nifti"].name == "space-MNI152_atlas-a_res-1mm_dseg.nii"
+    # every resolution is packed, the finest one once
+    assert entry["resolutions"][1.0] == entry["nifti"]
+    assert len(list(entry["nifti"].parent.glob("*.nii"))) == 2
+    for resolution, nifti in atlases["a"]["resolutions"].items():
+        unpacked = nib.load(entry["resolutions"][resolution])
+        assert unpacked.get_data_dtype() == np.int16
+        np.testing.assert_array_equal(
+            np.asanyarray(unpacked.dataobj), nib.load(nifti).get_fdata()
+        )
+        np.testing.assert_array_equal(unpacked.affine, nib.load(nifti).affine)
+    assert entry["description_file"].read_text() == "index,name\n1,region\n"
+    assert {k: entry[k] for k in ["region_col", "index_col"]} == {
+        "region_col": "index",
+        "index_col": 0,
+    }
+    # unpacked once, for all stores sharing the cache
+    assert AtlasStore(atlases, archive=archive, cache_dir=cache_dir)["a"] == entry
+
+
+def test_atlas_resolution():
+    resolutions = AVAILABLE_ATLASES["schaefer2018_100_7"]["resolutions"]
+    assert sorted(resolutions) == [1.0, 2.0]
+    assert all(nifti.is_file() for nifti in resolutions.values())
+    # the coarsest resolution that is not coarser than the target's voxels
+    for voxel_size, expected in [(0.8, 1.0), (1.0, 1.0), (1.5, 1.0), (2.0, 2.0)]:
+        nifti = get_atlas_resolution("schaefer2018_100_7", voxel_size)
+        assert nifti == resolutions[expected]
+        assert nib.load(nifti).header.get_zooms()[0] == expected
+    # atlases shipped at a single resolution
+    assert get_atlas_resolution("fan2016", 2.0) == AVAILABLE_ATLASES["fan2016"]["nifti"]
+
+
+def test_atlas_resolution_packed(tmp_path, monkeypatch):
+    from kepost.atlases.available_atlases import available_atlases
+
+    rng = np.random.default_rng(42)
+    resolutions = {}
+    for resolution, shape in [(1.0, (8, 8, 8)), (2.0, (4, 4, 4))]:
+        resolutions[resolution] = tmp_path / f"atlas-a_res-{resolution:g}mm_dseg.nii.gz"
+        nib.save(
+            nib.Nifti1Image(
+                rng.integers(0, 10, shape).astype(np.int16),
+                np.diag([resolution] * 3 + [1]),
+            ),
+            resolutions[resolution],
+        )
+    description = tmp_path / "atlas-a_dseg.csv"
+    description.write_text("index,name\n1,region\n")
+    entry = {
+        "nifti": resolutions[1.0],
+        "resolutions": resolutions,
+        "description_file": description,
+        "region_col": "index",
+        "index_col": 0,
+    }
+    unlisted = {k: v for k, v in entry.items() if k != "resolutions"}
+    atlases = {"a": entry, "b": unlisted}
+    archive = pack_atlases(atlases, tmp_path / "atlases.npz")
+    store = AtlasStore(atlases, archive=archive, cache_dir=tmp_path / "cache")
+    monkeypatch.setattr(available_atlases, "AVAILABLE_ATLASES", store)
+    # selected among the unpacked resolutions, by the reference's grid
+    for voxel_size, expected in [(1.0, 1.0), (2.5, 2.0)]:
+        reference = tmp_path / f"reference_{voxel_size:g}.nii.gz"
+        nib.save(
+            nib.Nifti1Image(np.zeros((2, 2, 2)), np.diag([voxel_size] * 3 + [1])),
+            reference,
+        )
+        nifti = select_atlas_resolution("a", str(reference))
+        assert Path(nifti).parent.parent == tmp_path / "cache"
+        assert nib.load(nifti).header.get_zooms()[:3] == (expected,) * 3
+    # without listed resolutions, the selection fails loudly
+    with pytest.raises(ValueError, match="resolutions"):
+        get_atlas_resolution("b", 1.0)
@@ -0,0 +1,59 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+
+from kepost import parcellation
+from kepost.atlases.utils import get_atlas_properties
+from kepost.workflows.diffusion.procedures.parcellations.parcellations import (
+    parcellate_arrays,
+)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_compute(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(42)
+    atlas_data = rng.integers(0, 20, size=(10, 10, 10)).astype(np.int16)
+    metric_arrays = {
+        "fa": rng.random(atlas_data.shape).astype(np.float32),
+        "md": rng.random(atlas_data.shape).astype(np.float32),
+    }
+    weights = rng.random(atlas_data.shape)
+    _, description, region_col, index_col = get_atlas_properties("huang2022")
+    regions = pd.read_csv(description, index_col=index_col)[region_col].to_numpy()
+    table = parcellation.compute(
+        metric_arrays, atlas_data, regions=regions, weights=weights
+    )
+    assert table.columns.names == ["metric", "measure"]
+    assert (table.index == regions).all()
+    # regions without voxels
+    assert np.isnan(table.loc[25, ("fa", "nanmean")])
+    assert table.loc[25, ("fa", "n_voxels")] == 0
+    # the same values as the workflows' parcellation nodes
+    atlas_nifti = str(tmp_path / "sub-01_space-dwi_atlas-huang2022_dseg.nii.gz")
+    nib.save(nib.Nifti1Image(atlas_data, np.eye(4)), atlas_nifti)
+    gm_probseg = str(tmp_path / "gm_probseg.nii.gz")
+    nib.save(nib.Nifti1Image(weights, np.eye(4)), gm_probseg)
+    out_file, *_ = parcellate_arrays(
+        metric_arrays.values(),
+        softwares=["dipy", "dipy"],
+        metrics=list(metric_arrays),
+        atlas_nifti=atlas_nifti,
+        gm_probseg=gm_probseg,
+    )
+    expected = pd.read_pickle(out_file)["WholeBrain"]["dipy"]
+    for metric in metric_arrays:
+        pd.testing.assert_frame_equal(
+            table[metric], expected[metric], check_names=False, check_dtype=False
+        )
+
+
+def test_compute_single_array():
+    labels = np.array([[[0, 1], [1, 2]]])
+    values = np.array([[[5.0, 1.0], [3.0, 4.0]]])
+    table = parcellation.compute(values, labels, measures=["nanmean", "n_voxels"])
+    assert list(table.columns) == ["nanmean", "n_voxels"]
+    np.testing.assert_allclose(table["nanmean"], [2.0, 4.0])
+    with pytest.raises(ValueError):
+        parcellation.compute(values[..., :1], labels)